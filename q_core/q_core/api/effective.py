@@ -0,0 +1,252 @@
+import json
+from collections import ChainMap
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+
+from api import reference, state
+from api.models import Host, HostTemplate, Observable, ObservableTemplate, GlobalVariable, GenericKVP, \
+    OrderedListItem, EffectiveConfig
+
+REFRESH_BATCH_SIZE = 2000
+
+
+class ConfigResolver:
+    """Resolves the effective configuration of hosts and observables.
+
+    Templates, checks, scheduling intervals and global variables are loaded once on construction, so one resolver
+    should be used for a whole batch of objects.
+
+    An attribute is taken from the object itself if set, else from its templates in list order, where every template
+    is followed by its own templates. Variables are merged in the same order and the first definition of a key wins.
+    Global variables have the lowest priority, observables inherit the variables of their host right above them.
+    """
+
+    def __init__(self):
+        self.chost = ContentType.objects.get_for_model(Host).id
+        self.chost_template = ContentType.objects.get_for_model(HostTemplate).id
+        self.cobservable = ContentType.objects.get_for_model(Observable).id
+        self.cobservable_template = ContentType.objects.get_for_model(ObservableTemplate).id
+
+        self.host_templates = {x.id: x for x in HostTemplate.objects.all()}
+        self.host_template_relations = self._load_relations(HostTemplate.host_templates.through, "hosttemplate")
+        self.host_template_variables = self._load_variables(self.chost_template)
+        self.observable_templates = {x.id: x for x in ObservableTemplate.objects.all()}
+        self.observable_template_relations = self._load_relations(
+            ObservableTemplate.observable_templates.through, "observabletemplate"
+        )
+        self.observable_template_variables = self._load_variables(self.cobservable_template)
+        self.checks = reference.checks.all()
+        self.scheduling_intervals = {x.id: x.interval for x in reference.scheduling_intervals.all().values()}
+        self.global_variables = dict(GenericKVP.objects.filter(
+            content_type=ContentType.objects.get_for_model(GlobalVariable)
+        ).order_by("id").values_list("key__label", "value__label"))
+
+    @staticmethod
+    def _load_relations(through, owner, ids=None) -> dict:
+        """Returns a mapping of owner id -> template ids ordered by their index"""
+        qs = through.objects.all() if ids is None else through.objects.filter(**{f"{owner}_id__in": ids})
+        relations = {}
+        for owner_id, template_id in qs.order_by(f"{owner}_id", "orderedlistitem__index").values_list(
+                f"{owner}_id", "orderedlistitem__object_id"
+        ):
+            relations.setdefault(owner_id, []).append(template_id)
+        return relations
+
+    @staticmethod
+    def _load_variables(content_type_id, ids=None) -> dict:
+        qs = GenericKVP.objects.filter(content_type_id=content_type_id)
+        if ids is not None:
+            qs = qs.filter(object_id__in=ids)
+        variables = {}
+        for object_id, key, value in qs.order_by("id").values_list("object_id", "key__label", "value__label"):
+            variables.setdefault(object_id, {})[key] = value
+        return variables
+
+    @staticmethod
+    def _linearize(template_ids, templates, relations) -> list:
+        """Returns the template ids in order of precedence. Unknown ids and cycles are skipped."""
+        chain = []
+        stack = list(reversed(template_ids))
+        while stack:
+            x = stack.pop()
+            if x in chain or x not in templates:
+                continue
+            chain.append(x)
+            stack.extend(reversed(relations.get(x, [])))
+        return chain
+
+    @staticmethod
+    def _resolve_attr(obj, chain, templates, attr_name):
+        if obj.__getattribute__(attr_name):
+            return obj.__getattribute__(attr_name)
+        for x in chain:
+            if templates[x].__getattribute__(attr_name):
+                return templates[x].__getattribute__(attr_name)
+        return None
+
+    def _resolve(self, obj, content_type_id, chain, templates, variables: dict) -> EffectiveConfig:
+        check_id = self._resolve_attr(obj, chain, templates, "linked_check_id")
+        check = self.checks.get(check_id)
+        return EffectiveConfig(
+            content_type_id=content_type_id,
+            object_id=obj.id,
+            linked_proxy_id=obj.linked_proxy_id,
+            linked_check_id=check.id if check else None,
+            check_command=check.to_export(variables) if check else "",
+            scheduling_interval=self.scheduling_intervals.get(
+                self._resolve_attr(obj, chain, templates, "scheduling_interval_id")
+            ),
+            retry_interval=self.scheduling_intervals.get(
+                self._resolve_attr(obj, chain, templates, "retry_interval_id")
+            ),
+            max_attempts=self._resolve_attr(obj, chain, templates, "max_attempts"),
+            scheduling_period_id=self._resolve_attr(obj, chain, templates, "scheduling_period_id"),
+            notification_period_id=self._resolve_attr(obj, chain, templates, "notification_period_id"),
+            variables=json.dumps(variables)
+        )
+
+    def resolve_hosts(self, hosts) -> dict:
+        """Returns a mapping of host id -> unsaved EffectiveConfig"""
+        hosts = list(hosts)
+        ids = [x.id for x in hosts]
+        relations = self._load_relations(Host.host_templates.through, "host", ids)
+        variables = self._load_variables(self.chost, ids)
+        configs = {}
+        for host in hosts:
+            chain = self._linearize(relations.get(host.id, []), self.host_templates, self.host_template_relations)
+            address = self._resolve_attr(host, chain, self.host_templates, "address") or ""
+            host_vars = {"$host_address$": address}
+            host_vars.update(ChainMap(
+                variables.get(host.id, {}),
+                *[self.host_template_variables.get(x, {}) for x in chain],
+                self.global_variables
+            ))
+            config = self._resolve(host, self.chost, chain, self.host_templates, host_vars)
+            config.address = address
+            config.disabled = bool(host.disabled)
+            configs[host.id] = config
+        return configs
+
+    def resolve_observables(self, observables, host_configs: dict) -> dict:
+        """Returns a mapping of observable id -> unsaved EffectiveConfig
+
+        :param observables: Iterable of observables
+        :param host_configs: Mapping of host id -> EffectiveConfig, has to contain the hosts of all observables
+        """
+        observables = list(observables)
+        ids = [x.id for x in observables]
+        relations = self._load_relations(Observable.observable_templates.through, "observable", ids)
+        variables = self._load_variables(self.cobservable, ids)
+        host_vars = {}
+        configs = {}
+        for observable in observables:
+            host_config = host_configs[observable.linked_host_id]
+            if observable.linked_host_id not in host_vars:
+                host_vars[observable.linked_host_id] = json.loads(host_config.variables)
+            chain = self._linearize(
+                relations.get(observable.id, []), self.observable_templates, self.observable_template_relations
+            )
+            observable_vars = dict(ChainMap(
+                variables.get(observable.id, {}),
+                *[self.observable_template_variables.get(x, {}) for x in chain],
+                host_vars[observable.linked_host_id]
+            ))
+            config = self._resolve(observable, self.cobservable, chain, self.observable_templates, observable_vars)
+            config.linked_host_id = observable.linked_host_id
+            config.address = host_config.address
+            config.disabled = bool(observable.disabled) or host_config.disabled
+            configs[observable.id] = config
+        return configs
+
+    def _inheriting(self, template_id, relations) -> set:
+        """Returns template_id and the ids of all templates inheriting from it"""
+        children = {}
+        for owner, template_ids in relations.items():
+            for x in template_ids:
+                children.setdefault(x, []).append(owner)
+        found = {template_id}
+        stack = [template_id]
+        while stack:
+            for x in children.get(stack.pop(), []):
+                if x not in found:
+                    found.add(x)
+                    stack.append(x)
+        return found
+
+    def hosts_inheriting(self, host_template_id) -> list:
+        items = OrderedListItem.objects.filter(
+            content_type_id=self.chost_template,
+            object_id__in=self._inheriting(host_template_id, self.host_template_relations)
+        )
+        return list(Host.host_templates.through.objects.filter(
+            orderedlistitem__in=items
+        ).values_list("host_id", flat=True).distinct())
+
+    def observables_inheriting(self, observable_template_id) -> list:
+        items = OrderedListItem.objects.filter(
+            content_type_id=self.cobservable_template,
+            object_id__in=self._inheriting(observable_template_id, self.observable_template_relations)
+        )
+        return list(Observable.observable_templates.through.objects.filter(
+            orderedlistitem__in=items
+        ).values_list("observable_id", flat=True).distinct())
+
+
+def _store(configs):
+    with transaction.atomic():
+        for content_type_id in {x.content_type_id for x in configs}:
+            EffectiveConfig.objects.filter(
+                content_type_id=content_type_id,
+                object_id__in=[x.object_id for x in configs if x.content_type_id == content_type_id]
+            ).delete()
+        EffectiveConfig.objects.bulk_create(configs)
+        state.update_metadata(configs)
+
+
+def refresh_hosts(host_ids, resolver: ConfigResolver = None):
+    """Refreshes the effective configuration of the hosts and all of their observables"""
+    resolver = resolver if resolver else ConfigResolver()
+    host_ids = list(host_ids)
+    for i in range(0, len(host_ids), REFRESH_BATCH_SIZE):
+        batch = host_ids[i:i + REFRESH_BATCH_SIZE]
+        host_configs = resolver.resolve_hosts(Host.objects.filter(id__in=batch))
+        observable_configs = resolver.resolve_observables(
+            Observable.objects.filter(linked_host_id__in=host_configs.keys()), host_configs
+        )
+        _store([*host_configs.values(), *observable_configs.values()])
+
+
+def refresh_observables(observable_ids, resolver: ConfigResolver = None):
+    resolver = resolver if resolver else ConfigResolver()
+    observable_ids = list(observable_ids)
+    for i in range(0, len(observable_ids), REFRESH_BATCH_SIZE):
+        observables = list(Observable.objects.filter(id__in=observable_ids[i:i + REFRESH_BATCH_SIZE]))
+        host_ids = {x.linked_host_id for x in observables}
+        host_configs = {x.object_id: x for x in EffectiveConfig.objects.filter(
+            content_type_id=resolver.chost, object_id__in=host_ids
+        )}
+        missing = host_ids - host_configs.keys()
+        if missing:
+            resolved = resolver.resolve_hosts(Host.objects.filter(id__in=missing))
+            _store(list(resolved.values()))
+            host_configs.update(resolved)
+        _store(list(resolver.resolve_observables(observables, host_configs).values()))
+
+
+def refresh_check(check_id):
+    """Refreshes all objects whose effective check is check_id"""
+    resolver = ConfigResolver()
+    affected = list(
+        EffectiveConfig.objects.filter(linked_check_id=check_id).values_list("content_type_id", "object_id")
+    )
+    refresh_hosts([x[1] for x in affected if x[0] == resolver.chost], resolver)
+    refresh_observables([x[1] for x in affected if x[0] == resolver.cobservable], resolver)
+
+
+def refresh_all():
+    refresh_hosts(Host.objects.order_by("id").values_list("id", flat=True))
+
+
+def remove(obj):
+    EffectiveConfig.objects.filter(content_type=ContentType.objects.get_for_model(obj), object_id=obj.id).delete()
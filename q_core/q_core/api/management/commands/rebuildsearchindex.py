@@ -0,0 +1,11 @@
+from django.core.management import BaseCommand
+
+from api.search import rebuild_index
+from api.signals import searchable_models
+
+
+class Command(BaseCommand):
+    def handle(self, *args, **options):
+        for model in searchable_models:
+            rebuild_index(model)
+            print(f"Rebuilt search index of {model.__name__}")
@@ -0,0 +1,9 @@
+from django.core.management import BaseCommand
+
+from api.effective import refresh_all
+
+
+class Command(BaseCommand):
+    def handle(self, *args, **options):
+        refresh_all()
+        print("Refreshed effective configurations")
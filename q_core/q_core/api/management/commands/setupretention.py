@@ -0,0 +1,38 @@
+from django.core.management import BaseCommand
+from influxdb_client import BucketRetentionRules, TaskCreateRequest, TaskUpdateRequest
+
+from q_core import settings
+from utils.influx_db import create_client
+from utils.retention import get_tiers, downsampling_task, task_name
+
+
+class Command(BaseCommand):
+    help = "Creates or updates the buckets and downsampling tasks of the retention tiers"
+
+    def handle(self, *args, **options):
+        org = settings.DATABASES["influxdb"]["ORG"]
+        tiers = get_tiers()
+        with create_client() as client:
+            buckets_api = client.buckets_api()
+            tasks_api = client.tasks_api()
+            for tier in tiers:
+                rules = BucketRetentionRules(type="expire", every_seconds=tier.retention)
+                bucket = buckets_api.find_bucket_by_name(tier.bucket)
+                if bucket is None:
+                    buckets_api.create_bucket(bucket_name=tier.bucket, retention_rules=rules, org=org)
+                    print(f"Created bucket {tier.bucket}")
+                else:
+                    bucket.retention_rules = [rules]
+                    buckets_api.update_bucket(bucket)
+                    print(f"Updated retention of bucket {tier.bucket}")
+            for source, tier in zip(tiers, tiers[1:]):
+                flux = downsampling_task(tier, source, org)
+                existing = tasks_api.find_tasks(name=task_name(tier))
+                if existing:
+                    tasks_api.update_task_request(
+                        task_id=existing[0].id, task_update_request=TaskUpdateRequest(flux=flux, status="active")
+                    )
+                    print(f"Updated task {task_name(tier)}")
+                else:
+                    tasks_api.create_task(task_create_request=TaskCreateRequest(flux=flux, org=org, status="active"))
+                    print(f"Created task {task_name(tier)}")
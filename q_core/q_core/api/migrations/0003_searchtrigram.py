@@ -0,0 +1,33 @@
+# Generated by Django 4.0.10 on 2026-10-19 08:46
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('api', '0002_remove_contact_linked_metric_notification_period_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SearchTrigram',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('trigram', models.CharField(max_length=3)),
+                ('weight', models.PositiveIntegerField(default=1)),
+                ('object_id', models.PositiveIntegerField()),
+                ('content_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='contenttypes.contenttype')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='searchtrigram',
+            index=models.Index(fields=['content_type', 'trigram', 'object_id'], name='api_searcht_content_2ef782_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='searchtrigram',
+            index=models.Index(fields=['content_type', 'object_id'], name='api_searcht_content_d14e5e_idx'),
+        ),
+    ]
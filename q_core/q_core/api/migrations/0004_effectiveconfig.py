@@ -0,0 +1,41 @@
+# Generated by Django 4.0.10 on 2026-10-19 08:49
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('api', '0003_searchtrigram'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EffectiveConfig',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('object_id', models.PositiveIntegerField()),
+                ('disabled', models.BooleanField(default=False)),
+                ('address', models.CharField(blank=True, default='', max_length=255)),
+                ('check_command', models.TextField(blank=True, default='')),
+                ('scheduling_interval', models.PositiveIntegerField(blank=True, null=True)),
+                ('variables', models.TextField(default='{}')),
+                ('content_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='contenttypes.contenttype')),
+                ('linked_check', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='api.check')),
+                ('linked_host', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='api.host')),
+                ('linked_proxy', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='api.proxy')),
+                ('notification_period', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='notification_ec', to='api.timeperiod')),
+                ('scheduling_period', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='scheduling_ec', to='api.timeperiod')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='effectiveconfig',
+            index=models.Index(fields=['linked_proxy', 'disabled'], name='api_effecti_linked__d7fb37_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='effectiveconfig',
+            unique_together={('content_type', 'object_id')},
+        ),
+    ]
@@ -0,0 +1,68 @@
+# Generated by Django 4.0.10 on 2026-10-19 08:53
+
+from django.db import migrations, models
+from django.db.models import Count, Min
+
+
+def _duplicates(model, fields):
+    """Yields the ids of all rows except the first one for every duplicated combination of fields"""
+    for x in model.objects.values(*fields).annotate(count=Count("id"), first=Min("id")).filter(count__gt=1):
+        yield from model.objects.filter(**{y: x[y] for y in fields}).exclude(id=x["first"]).values_list("id", flat=True)
+
+
+def remove_duplicates(apps, schema_editor):
+    GenericKVP = apps.get_model("api", "GenericKVP")
+    ScheduledObject = apps.get_model("api", "ScheduledObject")
+    Observable = apps.get_model("api", "Observable")
+    ACLModel = apps.get_model("api", "ACLModel")
+    ACLGroupModel = apps.get_model("api", "ACLGroupModel")
+
+    GenericKVP.objects.filter(id__in=list(_duplicates(GenericKVP, ["content_type", "object_id", "key"]))).delete()
+    ScheduledObject.objects.filter(
+        id__in=list(_duplicates(ScheduledObject, ["content_type", "object_id"]))
+    ).delete()
+
+    # Observables are referenced elsewhere, so duplicates are renamed instead of deleted
+    for x in Observable.objects.filter(id__in=list(_duplicates(Observable, ["linked_host", "name"]))):
+        x.name = f"{x.name}_{x.id}"
+        x.save(update_fields=["name"])
+
+    through = ACLGroupModel.linked_acls.through
+    for x in ACLModel.objects.values("name", "allow").annotate(count=Count("id"), first=Min("id")).filter(
+            count__gt=1
+    ):
+        duplicates = ACLModel.objects.filter(name=x["name"], allow=x["allow"]).exclude(id=x["first"])
+        for group_id in set(through.objects.filter(aclmodel__in=duplicates).values_list("aclgroupmodel_id", flat=True)):
+            through.objects.get_or_create(aclgroupmodel_id=group_id, aclmodel_id=x["first"])
+        duplicates.delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0005_cacheversion'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicates, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='orderedlistitem',
+            index=models.Index(fields=['content_type', 'object_id'], name='orderedlistitem_referent_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='aclmodel',
+            constraint=models.UniqueConstraint(fields=('name', 'allow'), name='aclmodel_name_allow_uniq'),
+        ),
+        migrations.AddConstraint(
+            model_name='generickvp',
+            constraint=models.UniqueConstraint(fields=('content_type', 'object_id', 'key'), name='generickvp_referent_key_uniq'),
+        ),
+        migrations.AddConstraint(
+            model_name='observable',
+            constraint=models.UniqueConstraint(fields=('linked_host', 'name'), name='observable_host_name_uniq'),
+        ),
+        migrations.AddConstraint(
+            model_name='scheduledobject',
+            constraint=models.UniqueConstraint(fields=('content_type', 'object_id'), name='scheduledobject_referent_uniq'),
+        ),
+    ]
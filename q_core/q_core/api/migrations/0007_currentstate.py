@@ -0,0 +1,36 @@
+# Generated by Django 4.0.10 on 2026-10-19 08:59
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('api', '0006_lookup_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CurrentState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('object_id', models.PositiveIntegerField()),
+                ('proxy_id', models.PositiveIntegerField(blank=True, null=True)),
+                ('host_id', models.PositiveIntegerField(blank=True, null=True)),
+                ('labels', models.TextField(default='[]')),
+                ('state', models.CharField(default='', max_length=16)),
+                ('output', models.TextField(blank=True, default='')),
+                ('last_check', models.FloatField(default=0)),
+                ('last_change', models.FloatField(default=0)),
+                ('updated', models.FloatField(db_index=True, default=0)),
+                ('removed', models.BooleanField(default=False)),
+                ('content_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='contenttypes.contenttype')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='currentstate',
+            constraint=models.UniqueConstraint(fields=('content_type', 'object_id'), name='currentstate_referent_uniq'),
+        ),
+    ]
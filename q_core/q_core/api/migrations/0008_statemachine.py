@@ -0,0 +1,33 @@
+# Generated by Django 4.0.10 on 2026-10-19 09:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0007_currentstate'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='currentstate',
+            name='attempt',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='currentstate',
+            name='flapping',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='currentstate',
+            name='hard_state',
+            field=models.CharField(default='', max_length=16),
+        ),
+        migrations.AddField(
+            model_name='currentstate',
+            name='history',
+            field=models.CharField(blank=True, default='', max_length=32),
+        ),
+    ]
@@ -0,0 +1,69 @@
+# Generated by Django 4.0.10 on 2026-10-19 09:18
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0008_statemachine'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='currentstate',
+            name='max_attempts',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='effectiveconfig',
+            name='max_attempts',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='effectiveconfig',
+            name='retry_interval',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='host',
+            name='max_attempts',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='host',
+            name='retry_interval',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='api.schedulinginterval'),
+        ),
+        migrations.AddField(
+            model_name='hosttemplate',
+            name='max_attempts',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='hosttemplate',
+            name='retry_interval',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='api.schedulinginterval'),
+        ),
+        migrations.AddField(
+            model_name='observable',
+            name='max_attempts',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='observable',
+            name='retry_interval',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='api.schedulinginterval'),
+        ),
+        migrations.AddField(
+            model_name='observabletemplate',
+            name='max_attempts',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='observabletemplate',
+            name='retry_interval',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='api.schedulinginterval'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.0.10 on 2026-10-19 09:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0009_retry_interval'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NotificationRate',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('contact_id', models.PositiveIntegerField(unique=True)),
+                ('period_start', models.FloatField(default=0)),
+                ('sent', models.PositiveIntegerField(default=0)),
+                ('suppressed', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+    ]
@@ -103,6 +103,11 @@ class TimePeriod(models.Model):
         "time_periods": "time_periods"
     }
 
+    search_fields = {
+        "name": 4,
+        "comment": 1
+    }
+
     def __str__(self):
         return self.name
 
@@ -144,6 +149,12 @@ class Check(models.Model):
         "comment": "comment"
     }
 
+    search_fields = {
+        "name": 4,
+        "cmd": 2,
+        "comment": 1
+    }
+
     def __str__(self):
         return self.name
 
@@ -208,6 +219,13 @@ class Contact(models.Model):
         "variables": "variables"
     }
 
+    search_fields = {
+        "name": 4,
+        "mail": 3,
+        "comment": 1,
+        "variables": 2
+    }
+
     def __str__(self):
         return self.name
 
@@ -261,6 +279,11 @@ class ContactGroup(models.Model):
         "linked_contacts": "linked_contacts",
     }
 
+    search_fields = {
+        "name": 4,
+        "comment": 1
+    }
+
     def __str__(self):
         return self.name
 
@@ -308,6 +331,12 @@ class Proxy(models.Model):
         "comment": "comment"
     }
 
+    search_fields = {
+        "name": 4,
+        "address": 3,
+        "comment": 1
+    }
+
     def __str__(self):
         return self.name
 
@@ -348,6 +377,11 @@ class OrderedListItem(models.Model):
     content_type = ForeignKey(ContentType, on_delete=models.CASCADE)
     object_id = PositiveIntegerField()
 
+    class Meta:
+        indexes = [
+            models.Index(fields=["content_type", "object_id"], name="orderedlistitem_referent_idx"),
+        ]
+
 
 class HostTemplate(models.Model):
     """Template of a host"""
@@ -358,6 +392,12 @@ class HostTemplate(models.Model):
     linked_contacts = ManyToManyField(Contact, blank=True)
     linked_contact_groups = ManyToManyField(ContactGroup, blank=True)
     scheduling_interval = ForeignKey(SchedulingInterval, on_delete=models.DO_NOTHING, blank=True, null=True)
+    retry_interval = ForeignKey(
+        SchedulingInterval, on_delete=models.DO_NOTHING,
+        blank=True, null=True,
+        related_name="+"
+    )
+    max_attempts = PositiveIntegerField(blank=True, null=True)
     scheduling_period = ForeignKey(
         TimePeriod, on_delete=models.DO_NOTHING,
         blank=True, null=True,
@@ -380,11 +420,20 @@ class HostTemplate(models.Model):
         "linked_contacts": "linked_contacts",
         "linked_contact_groups": "linked_contact_groups",
         "scheduling_interval": "scheduling_interval",
+        "retry_interval": "retry_interval",
+        "max_attempts": "max_attempts",
         "notification_period": "notification_period",
         "comment": "comment",
         "variables": "variables"
     }
 
+    search_fields = {
+        "name": 4,
+        "address": 3,
+        "comment": 1,
+        "variables": 2
+    }
+
     def __str__(self):
         return self.name
 
@@ -409,6 +458,10 @@ class HostTemplate(models.Model):
             ret["linked_contact_groups"] = [x.id for x in self.linked_contact_groups.all().only("id")]
         if "scheduling_interval" in values:
             ret["scheduling_interval"] = self.scheduling_interval.interval if self.scheduling_interval else ""
+        if "retry_interval" in values:
+            ret["retry_interval"] = self.retry_interval.interval if self.retry_interval else ""
+        if "max_attempts" in values:
+            ret["max_attempts"] = self.max_attempts if self.max_attempts else ""
         if "scheduling_period" in values:
             ret["scheduling_period"] = self.scheduling_period_id if self.scheduling_period else ""
         if "notification_period" in values:
@@ -438,6 +491,12 @@ class Host(models.Model):
     linked_contacts = ManyToManyField(Contact, blank=True)
     linked_contact_groups = ManyToManyField(ContactGroup, blank=True)
     scheduling_interval = ForeignKey(SchedulingInterval, on_delete=models.DO_NOTHING, blank=True, null=True)
+    retry_interval = ForeignKey(
+        SchedulingInterval, on_delete=models.DO_NOTHING,
+        blank=True, null=True,
+        related_name="+"
+    )
+    max_attempts = PositiveIntegerField(blank=True, null=True)
     scheduling_period = ForeignKey(
         TimePeriod, on_delete=models.DO_NOTHING,
         blank=True, null=True,
@@ -461,12 +520,21 @@ class Host(models.Model):
         "linked_contacts": "linked_contacts",
         "linked_contact_groups": "linked_contact_groups",
         "scheduling_interval": "scheduling_interval",
+        "retry_interval": "retry_interval",
+        "max_attempts": "max_attempts",
         "notification_period": "notification_period",
         "comment": "comment",
         "variables": "variables",
         "disabled": "disabled"
     }
 
+    search_fields = {
+        "name": 4,
+        "address": 3,
+        "comment": 1,
+        "variables": 2
+    }
+
     def __str__(self):
         return self.name
 
@@ -495,6 +563,10 @@ class Host(models.Model):
             ret["linked_contact_groups"] = [x.id for x in self.linked_contact_groups.all().only("id")]
         if "scheduling_interval" in values:
             ret["scheduling_interval"] = self.scheduling_interval.interval if self.scheduling_interval else ""
+        if "retry_interval" in values:
+            ret["retry_interval"] = self.retry_interval.interval if self.retry_interval else ""
+        if "max_attempts" in values:
+            ret["max_attempts"] = self.max_attempts if self.max_attempts else ""
         if "scheduling_period" in values:
             ret["scheduling_period"] = self.scheduling_period_id if self.scheduling_period else ""
         if "notification_period" in values:
@@ -521,6 +593,12 @@ class ObservableTemplate(models.Model):
     linked_contacts = ManyToManyField(Contact, blank=True)
     linked_contact_groups = ManyToManyField(ContactGroup, blank=True)
     scheduling_interval = ForeignKey(SchedulingInterval, on_delete=models.DO_NOTHING, blank=True, null=True)
+    retry_interval = ForeignKey(
+        SchedulingInterval, on_delete=models.DO_NOTHING,
+        blank=True, null=True,
+        related_name="+"
+    )
+    max_attempts = PositiveIntegerField(blank=True, null=True)
     scheduling_period = ForeignKey(
         TimePeriod, on_delete=models.DO_NOTHING,
         blank=True, null=True,
@@ -542,12 +620,20 @@ class ObservableTemplate(models.Model):
         "linked_contacts": "linked_contacts",
         "linked_contact_groups": "linked_contact_groups",
         "scheduling_interval": "scheduling_interval",
+        "retry_interval": "retry_interval",
+        "max_attempts": "max_attempts",
         "scheduling_period": "scheduling_period",
         "notification_period": "notification_period",
         "comment": "comment",
         "variables": "variables"
     }
 
+    search_fields = {
+        "name": 4,
+        "comment": 1,
+        "variables": 2
+    }
+
     def __str__(self):
         return self.name
 
@@ -570,6 +656,10 @@ class ObservableTemplate(models.Model):
             ret["linked_contact_groups"] = [x.id for x in self.linked_contact_groups.all().only("id")]
         if "scheduling_interval" in values:
             ret["scheduling_interval"] = self.scheduling_interval.interval if self.scheduling_interval else ""
+        if "retry_interval" in values:
+            ret["retry_interval"] = self.retry_interval.interval if self.retry_interval else ""
+        if "max_attempts" in values:
+            ret["max_attempts"] = self.max_attempts if self.max_attempts else ""
         if "scheduling_period" in values:
             ret["scheduling_period"] = self.scheduling_period_id if self.scheduling_period else ""
         if "notification_period" in values:
@@ -599,6 +689,12 @@ class Observable(models.Model):
     linked_contacts = ManyToManyField(Contact, blank=True)
     linked_contact_groups = ManyToManyField(ContactGroup, blank=True)
     scheduling_interval = ForeignKey(SchedulingInterval, on_delete=models.DO_NOTHING, blank=True, null=True)
+    retry_interval = ForeignKey(
+        SchedulingInterval, on_delete=models.DO_NOTHING,
+        blank=True, null=True,
+        related_name="+"
+    )
+    max_attempts = PositiveIntegerField(blank=True, null=True)
     scheduling_period = ForeignKey(
         TimePeriod, on_delete=models.DO_NOTHING,
         blank=True, null=True,
@@ -612,6 +708,11 @@ class Observable(models.Model):
     comment = CharField(default="", max_length=1024, blank=True, null=True)
     variables = GenericRelation("GenericKVP")
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["linked_host", "name"], name="observable_host_name_uniq"),
+        ]
+
     allowed_values = {
         "id": "id",
         "name": "name",
@@ -622,6 +723,8 @@ class Observable(models.Model):
         "linked_contacts": "linked_contacts",
         "linked_contact_groups": "linked_contact_groups",
         "scheduling_interval": "scheduling_interval",
+        "retry_interval": "retry_interval",
+        "max_attempts": "max_attempts",
         "scheduling_period": "scheduling_period",
         "notification_period": "notification_period",
         "comment": "comment",
@@ -629,6 +732,12 @@ class Observable(models.Model):
         "disabled": "disabled"
     }
 
+    search_fields = {
+        "name": 4,
+        "comment": 1,
+        "variables": 2
+    }
+
     def __str__(self):
         return self.name
 
@@ -657,6 +766,10 @@ class Observable(models.Model):
             ret["linked_contact_groups"] = [x.id for x in self.linked_contact_groups.all().only("id")]
         if "scheduling_interval" in values:
             ret["scheduling_interval"] = self.scheduling_interval.interval if self.scheduling_interval else ""
+        if "retry_interval" in values:
+            ret["retry_interval"] = self.retry_interval.interval if self.retry_interval else ""
+        if "max_attempts" in values:
+            ret["max_attempts"] = self.max_attempts if self.max_attempts else ""
         if "scheduling_period" in values:
             ret["scheduling_period"] = self.scheduling_period_id if self.scheduling_interval else ""
         if "notification_period" in values:
@@ -686,6 +799,11 @@ class GenericKVP(models.Model):
     content_type = ForeignKey(ContentType, on_delete=models.CASCADE)
     object_id = PositiveIntegerField()
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["content_type", "object_id", "key"], name="generickvp_referent_key_uniq"),
+        ]
+
     def __str__(self):
         return f"{self.referent} - {self.key}: {self.value}"
 
@@ -703,6 +821,11 @@ class ACLModel(models.Model):
     name = CharField(default="", max_length=255)
     allow = BooleanField(default=False)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["name", "allow"], name="aclmodel_name_allow_uniq"),
+        ]
+
     def __str__(self):
         return f"{self.name}:{self.allow}"
 
@@ -748,3 +871,151 @@ class ScheduledObject(models.Model):
     referent = GenericForeignKey('content_type', 'object_id')
     content_type = ForeignKey(ContentType, on_delete=models.CASCADE)
     object_id = PositiveIntegerField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["content_type", "object_id"], name="scheduledobject_referent_uniq"),
+        ]
+
+
+class SearchTrigram(models.Model):
+    """Trigram of the searchable attributes of an object.
+
+    Substring queries are answered by an index lookup of the trigrams of the query instead of scanning the table.
+    """
+    trigram = CharField(max_length=3)
+    weight = PositiveIntegerField(default=1)
+    referent = GenericForeignKey('content_type', 'object_id')
+    content_type = ForeignKey(ContentType, on_delete=models.CASCADE)
+    object_id = PositiveIntegerField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["content_type", "trigram", "object_id"]),
+            models.Index(fields=["content_type", "object_id"]),
+        ]
+
+
+class EffectiveConfig(models.Model):
+    """Resolved configuration of a host or an observable.
+
+    Contains the values inherited from templates, the host and global variables. Rows are refreshed whenever one of
+    their sources changes, so readers do not need to resolve the template chains themselves.
+    """
+    referent = GenericForeignKey('content_type', 'object_id')
+    content_type = ForeignKey(ContentType, on_delete=models.CASCADE)
+    object_id = PositiveIntegerField()
+    linked_proxy = ForeignKey(Proxy, on_delete=models.CASCADE)
+    linked_host = ForeignKey(Host, on_delete=models.CASCADE, blank=True, null=True)
+    disabled = BooleanField(default=False)
+    address = CharField(default="", max_length=255, blank=True)
+    linked_check = ForeignKey(Check, on_delete=models.SET_NULL, blank=True, null=True)
+    check_command = models.TextField(default="", blank=True)
+    scheduling_interval = PositiveIntegerField(blank=True, null=True)
+    retry_interval = PositiveIntegerField(blank=True, null=True)
+    max_attempts = PositiveIntegerField(blank=True, null=True)
+    scheduling_period = ForeignKey(
+        TimePeriod, on_delete=models.SET_NULL,
+        blank=True, null=True,
+        related_name="scheduling_ec"
+    )
+    notification_period = ForeignKey(
+        TimePeriod, on_delete=models.SET_NULL,
+        blank=True, null=True,
+        related_name="notification_ec"
+    )
+    variables = models.TextField(default="{}")
+
+    class Meta:
+        unique_together = [("content_type", "object_id")]
+        indexes = [
+            models.Index(fields=["linked_proxy", "disabled"]),
+        ]
+
+    def __str__(self):
+        return f"{self.referent}"
+
+    def is_schedulable(self):
+        return not self.disabled and \
+            bool(self.linked_check_id and self.scheduling_interval and self.scheduling_period_id)
+
+    def to_dict(self):
+        return {
+            "id": self.object_id,
+            "linked_proxy": self.linked_proxy_id,
+            "linked_host": self.linked_host_id if self.linked_host_id else "",
+            "disabled": self.disabled,
+            "address": self.address,
+            "linked_check": self.linked_check_id if self.linked_check_id else "",
+            "check_command": self.check_command,
+            "scheduling_interval": self.scheduling_interval if self.scheduling_interval else "",
+            "retry_interval": self.retry_interval if self.retry_interval else "",
+            "max_attempts": self.max_attempts if self.max_attempts else "",
+            "scheduling_period": self.scheduling_period_id if self.scheduling_period_id else "",
+            "notification_period": self.notification_period_id if self.notification_period_id else "",
+            "variables": json.loads(self.variables)
+        }
+
+
+class CacheVersion(models.Model):
+    """Version of a process local cache.
+
+    Bumped whenever the cached data changes, so every process can tell whether its copy is outdated.
+    """
+    name = CharField(max_length=255, unique=True)
+    version = PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.name}:{self.version}"
+
+
+class CurrentState(models.Model):
+    """Latest check result of a host or an observable.
+
+    Written in batches by the result ingestion and read by the process local StateStore in api/state.py, which picks
+    up every row whose updated timestamp changed. Deleted objects are kept as removed rows, so the stores of all
+    processes notice the deletion.
+    """
+    referent = GenericForeignKey('content_type', 'object_id')
+    content_type = ForeignKey(ContentType, on_delete=models.CASCADE)
+    object_id = PositiveIntegerField()
+    proxy_id = PositiveIntegerField(blank=True, null=True)
+    host_id = PositiveIntegerField(blank=True, null=True)
+    labels = models.TextField(default="[]")
+    # Effective max_attempts of the object, the default of api/statemachine.py if null
+    max_attempts = PositiveIntegerField(blank=True, null=True)
+    state = CharField(default="", max_length=16)
+    hard_state = CharField(default="", max_length=16)
+    attempt = PositiveIntegerField(default=0)
+    # Codes of the recent states, see api/statemachine.py
+    history = CharField(default="", max_length=32, blank=True)
+    flapping = BooleanField(default=False)
+    output = models.TextField(default="", blank=True)
+    last_check = models.FloatField(default=0)
+    last_change = models.FloatField(default=0)
+    updated = models.FloatField(default=0, db_index=True)
+    removed = BooleanField(default=False)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["content_type", "object_id"], name="currentstate_referent_uniq"),
+        ]
+
+    def __str__(self):
+        return f"{self.referent}:{self.state}"
+
+
+class NotificationRate(models.Model):
+    """Notifications sent to a contact in the current rate period.
+
+    Shared by the dispatchers of all processes, see api/notifications.py, so the rate limit of a contact holds across
+    processes.
+    """
+    contact_id = PositiveIntegerField(unique=True)
+    period_start = models.FloatField(default=0)
+    sent = PositiveIntegerField(default=0)
+    # Notifications suppressed since the last delivery to the contact
+    suppressed = PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.contact_id}:{self.sent}"
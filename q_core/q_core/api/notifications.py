@@ -0,0 +1,428 @@
+"""Notifications of state changes.
+
+The transitions of the state machines are turned into notifications of the contacts of an object. Recipients are
+answered from a precomputed index of object -> contacts, which contains the members of the contact groups and the
+contacts inherited from templates. A notification is only sent if its time lies inside the notification period of the
+object and the notification period of the contact.
+
+Notifications are handed to a dispatcher, which collects them per contact and delivers them in batches to the
+configured sinks from a background thread. Every contact may receive at most rate_limit notifications per rate_period
+seconds, notifications above the limit are counted and reported with the next batch. The counts are kept in the
+NotificationRate table, so the limit holds for the dispatchers of all processes together.
+
+Sinks are configured by NOTIFICATIONS in the settings, nothing is sent if no sink is configured.
+"""
+import atexit
+import collections
+import json
+import logging
+import os
+import smtplib
+import threading
+import time
+from email.message import EmailMessage
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+from django.utils.module_loading import import_string
+
+from api import reference
+from api.effective import ConfigResolver
+from api.models import Contact, ContactGroup, Host, HostTemplate, Observable, ObservableTemplate, EffectiveConfig, \
+    CurrentState, NotificationRate
+from q_core import settings
+
+logger = logging.getLogger("notifications")
+
+DEFAULT_BATCH_INTERVAL = 10.0
+DEFAULT_RATE_LIMIT = 20
+DEFAULT_RATE_PERIOD = 3600.0
+
+
+class ContactRecord:
+    __slots__ = ("id", "name", "mail", "host_notification_period_id", "observable_notification_period_id")
+
+    def __init__(self, id, name, mail, host_notification_period_id, observable_notification_period_id):
+        self.id = id
+        self.name = name
+        self.mail = mail
+        self.host_notification_period_id = host_notification_period_id
+        self.observable_notification_period_id = observable_notification_period_id
+
+
+class Notification:
+    __slots__ = ("contact_id", "kind", "context", "object_id", "name", "host", "previous", "state", "output",
+                 "timestamp")
+
+    def __init__(self, contact_id, kind, context, object_id, name, host, previous, state, output, timestamp):
+        self.contact_id = contact_id
+        self.kind = kind
+        self.context = context
+        self.object_id = object_id
+        self.name = name
+        self.host = host
+        self.previous = previous
+        self.state = state
+        self.output = output
+        self.timestamp = timestamp
+
+    def __str__(self):
+        name = f"{self.host}/{self.name}" if self.context == "observable" else self.name
+        if self.kind == "flap_start":
+            return f"{name} started flapping"
+        if self.kind == "flap_stop":
+            return f"{name} stopped flapping"
+        return f"{name} is {self.state.upper()}: {self.output}"
+
+    def to_dict(self):
+        return {
+            "kind": self.kind,
+            "context": self.context,
+            "object_id": self.object_id,
+            "name": self.name,
+            "host": self.host,
+            "previous": self.previous,
+            "state": self.state,
+            "output": self.output,
+            "timestamp": self.timestamp
+        }
+
+
+def _load_members(through, owner, member) -> dict:
+    """Returns a mapping of owner id -> list of member ids"""
+    members = {}
+    for owner_id, member_id in through.objects.order_by(f"{owner}_id", f"{member}_id").values_list(
+            f"{owner}_id", f"{member}_id"
+    ):
+        members.setdefault(owner_id, []).append(member_id)
+    return members
+
+
+class RecipientCache(reference.ReferenceCache):
+    """Index of (content type id, object id) -> tuple of contact ids.
+
+    Contacts and contact groups are taken from the object itself if it has any, else from the first of its templates
+    having any, in the order of the effective configuration. Groups are expanded to their members.
+    """
+    name = "recipients"
+
+    def __init__(self):
+        super(RecipientCache, self).__init__()
+        self.contacts = {}
+
+    def _load_model(self, model, template_model, relations, template_relations, groups) -> dict:
+        contacts = _load_members(model.linked_contacts.through, model.__name__.lower(), "contact")
+        contact_groups = _load_members(model.linked_contact_groups.through, model.__name__.lower(), "contactgroup")
+        template_name = template_model.__name__.lower()
+        template_contacts = _load_members(template_model.linked_contacts.through, template_name, "contact")
+        template_contact_groups = _load_members(
+            template_model.linked_contact_groups.through, template_name, "contactgroup"
+        )
+        templates = {x: None for x in template_model.objects.values_list("id", flat=True)}
+
+        def expand(own_contacts, own_groups) -> tuple:
+            found = dict.fromkeys(own_contacts)
+            for x in own_groups:
+                found.update(dict.fromkeys(groups.get(x, [])))
+            return tuple(found)
+
+        # Objects sharing their templates share one tuple
+        resolved = {}
+        index = {}
+        for object_id in {*contacts, *contact_groups, *relations}:
+            if object_id in contacts or object_id in contact_groups:
+                recipients = expand(contacts.get(object_id, []), contact_groups.get(object_id, []))
+            else:
+                recipients = ()
+                for x in ConfigResolver._linearize(relations[object_id], templates, template_relations):
+                    if x in template_contacts or x in template_contact_groups:
+                        recipients = expand(template_contacts.get(x, []), template_contact_groups.get(x, []))
+                        break
+            if recipients:
+                index[object_id] = resolved.setdefault(recipients, recipients)
+        return index
+
+    def load(self) -> dict:
+        self.contacts = {
+            x[0]: ContactRecord(*x) for x in Contact.objects.values_list(
+                "id", "name", "mail", "linked_host_notification_period_id",
+                "linked_observable_notification_period_id"
+            )
+        }
+        groups = _load_members(ContactGroup.linked_contacts.through, "contactgroup", "contact")
+        records = {}
+        for model, template_model, through, template_through in [
+            (Host, HostTemplate, Host.host_templates.through, HostTemplate.host_templates.through),
+            (Observable, ObservableTemplate, Observable.observable_templates.through,
+             ObservableTemplate.observable_templates.through),
+        ]:
+            content_type_id = ContentType.objects.get_for_model(model).id
+            index = self._load_model(
+                model, template_model,
+                ConfigResolver._load_relations(through, model.__name__.lower()),
+                ConfigResolver._load_relations(template_through, template_model.__name__.lower()),
+                groups
+            )
+            records.update({(content_type_id, x): y for x, y in index.items()})
+        return records
+
+    def get(self, content_type_id, object_id) -> list:
+        """Returns the ContactRecords of an object"""
+        self._validate()
+        return [self.contacts[x] for x in self.records.get((content_type_id, object_id), ()) if x in self.contacts]
+
+
+recipients = RecipientCache()
+
+
+def _in_period(period_id, timestamp) -> bool:
+    if not period_id:
+        return True
+    period = reference.time_periods.get(period_id)
+    return period is None or period.contains(timestamp)
+
+
+def _details(content_type_id, object_ids) -> dict:
+    """Returns a mapping of object id -> (name, host name, notification period id, output)"""
+    object_ids = list(object_ids)
+    if content_type_id == ContentType.objects.get_for_model(Host).id:
+        names = {x[0]: (x[1], x[1]) for x in Host.objects.filter(id__in=object_ids).values_list("id", "name")}
+    else:
+        names = {x[0]: (x[1], x[2]) for x in Observable.objects.filter(id__in=object_ids).values_list(
+            "id", "name", "linked_host__name"
+        )}
+    periods = dict(EffectiveConfig.objects.filter(
+        content_type_id=content_type_id, object_id__in=object_ids
+    ).values_list("object_id", "notification_period_id"))
+    outputs = dict(CurrentState.objects.filter(
+        content_type_id=content_type_id, object_id__in=object_ids
+    ).values_list("object_id", "output"))
+    return {x: (*y, periods.get(x), outputs.get(x, "")) for x, y in names.items()}
+
+
+def notify(transitions) -> list:
+    """Creates the notifications of transitions and hands them to the dispatcher.
+
+    A change of the hard state is only notified if the object is not flapping, the start and the end of flapping are
+    always notified. The initial ok state of a new object is not notified.
+
+    :param transitions: List of Transition
+    :return: List of Notification
+    """
+    dispatcher = get_dispatcher()
+    if dispatcher is None:
+        return []
+    transitions = [
+        x for x in transitions
+        if x.kind != "state" or (not x.flapping and (x.previous or x.state != "ok"))
+    ]
+    chost = ContentType.objects.get_for_model(Host).id
+    by_content_type = {}
+    for x in transitions:
+        by_content_type.setdefault(x.content_type_id, set()).add(x.object_id)
+    details = {}
+    for content_type_id, object_ids in by_content_type.items():
+        details.update({(content_type_id, x): y for x, y in _details(content_type_id, object_ids).items()})
+
+    notifications = []
+    for x in transitions:
+        key = (x.content_type_id, x.object_id)
+        if key not in details:
+            continue
+        name, host, period_id, output = details[key]
+        if not _in_period(period_id, x.timestamp):
+            continue
+        is_host = x.content_type_id == chost
+        for contact in recipients.get(*key):
+            contact_period_id = contact.host_notification_period_id if is_host \
+                else contact.observable_notification_period_id
+            if _in_period(contact_period_id, x.timestamp):
+                notifications.append(Notification(
+                    contact.id, x.kind, "host" if is_host else "observable", x.object_id, name, host, x.previous,
+                    x.state, output, x.timestamp
+                ))
+    if notifications:
+        dispatcher.put(notifications)
+    return notifications
+
+
+class FileSink:
+    """Appends every notification as line of JSON to a file"""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def send(self, contact: ContactRecord, notifications: list, suppressed: int):
+        lines = [
+            json.dumps({"contact": contact.name, "mail": contact.mail, **x.to_dict()}) for x in notifications
+        ]
+        if suppressed:
+            lines.append(json.dumps({"contact": contact.name, "mail": contact.mail, "suppressed": suppressed}))
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with self.lock, open(self.path, "a", encoding="utf-8") as fh:
+            fh.write("".join(f"{x}\n" for x in lines))
+
+
+class SmtpSink:
+    """Sends one mail per batch to the mail address of the contact. Contacts without mail address are skipped."""
+
+    def __init__(self, host="localhost", port=25, sender="q@localhost", username=None, password=None, starttls=False,
+                 timeout=10):
+        self.host = host
+        self.port = port
+        self.sender = sender
+        self.username = username
+        self.password = password
+        self.starttls = starttls
+        self.timeout = timeout
+
+    def send(self, contact: ContactRecord, notifications: list, suppressed: int):
+        if not contact.mail:
+            return
+        message = EmailMessage()
+        message["From"] = self.sender
+        message["To"] = contact.mail
+        if len(notifications) == 1:
+            message["Subject"] = f"[Q] {notifications[0]}"
+        else:
+            message["Subject"] = f"[Q] {len(notifications)} notifications"
+        body = [
+            f"{time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(x.timestamp))} UTC  {x}" for x in notifications
+        ]
+        if suppressed:
+            body.append(f"{suppressed} further notification(s) were suppressed by the rate limit")
+        message.set_content("\n".join(body))
+        with smtplib.SMTP(self.host, self.port, timeout=self.timeout) as smtp:
+            if self.starttls:
+                smtp.starttls()
+            if self.username:
+                smtp.login(self.username, self.password)
+            smtp.send_message(message)
+
+
+class NotificationDispatcher:
+    """Batching and rate limiting delivery of notifications.
+
+    Notifications are queued by put() and delivered by a background thread every batch_interval seconds, one batch
+    per contact and sink. A failing sink does not affect the other sinks. The rate of a contact starts a new period
+    with the first notification after rate_period seconds.
+    """
+
+    def __init__(self, sinks: list, batch_interval=DEFAULT_BATCH_INTERVAL, rate_limit=DEFAULT_RATE_LIMIT,
+                 rate_period=DEFAULT_RATE_PERIOD):
+        self.sinks = sinks
+        self.batch_interval = batch_interval
+        self.rate_limit = rate_limit
+        self.rate_period = rate_period
+
+        self.queue = collections.deque()
+        self.condition = threading.Condition()
+        self.running = True
+
+        self.delivered = 0
+        self.dropped = 0
+        self.errors = 0
+
+        self.thread = threading.Thread(target=self._run, name="notification-dispatcher", daemon=True)
+        self.thread.start()
+
+    def put(self, notifications: list):
+        with self.condition:
+            self.queue.extend(notifications)
+
+    def _run(self):
+        while self.running:
+            with self.condition:
+                self.condition.wait(self.batch_interval)
+            try:
+                self.flush()
+            except Exception as err:
+                logger.exception(f"Unexpected error while dispatching notifications: {err}")
+
+    def _limit(self, contact_id, notifications: list, now) -> (list, int):
+        """Returns the notifications within the rate limit of the contact and the number of notifications suppressed
+        before, which are reported with them"""
+        with transaction.atomic():
+            rate, _ = NotificationRate.objects.select_for_update().get_or_create(contact_id=contact_id)
+            if rate.period_start <= now - self.rate_period:
+                rate.period_start = now
+                rate.sent = 0
+            allowed = notifications[:max(self.rate_limit - rate.sent, 0)]
+            rate.sent += len(allowed)
+            suppressed = 0
+            if allowed:
+                suppressed, rate.suppressed = rate.suppressed, 0
+            rate.suppressed += len(notifications) - len(allowed)
+            rate.save()
+        self.dropped += len(notifications) - len(allowed)
+        return allowed, suppressed
+
+    def flush(self):
+        """Delivers all queued notifications"""
+        with self.condition:
+            queued = list(self.queue)
+            self.queue.clear()
+        batches = {}
+        for x in queued:
+            batches.setdefault(x.contact_id, []).append(x)
+        now = time.time()
+        for contact_id, notifications in batches.items():
+            contact = recipients.contacts.get(contact_id)
+            if contact is None:
+                continue
+            allowed, suppressed = self._limit(contact_id, notifications, now)
+            if not allowed:
+                continue
+            for sink in self.sinks:
+                try:
+                    sink.send(contact, allowed, suppressed)
+                except Exception as err:
+                    self.errors += 1
+                    logger.error(f"{sink.__class__.__name__} could not notify {contact.name}: {err}")
+            self.delivered += len(allowed)
+
+    def metrics(self) -> dict:
+        return {
+            "queue_depth": len(self.queue),
+            "delivered": self.delivered,
+            "dropped": self.dropped,
+            "errors": self.errors
+        }
+
+    def close(self):
+        self.running = False
+        with self.condition:
+            self.condition.notify()
+        self.thread.join(timeout=self.batch_interval + 1)
+        self.flush()
+
+
+def _create_sink(config: dict):
+    config = dict(config)
+    sink_class = import_string(config.pop("CLASS"))
+    return sink_class(**{x.lower(): y for x, y in config.items()})
+
+
+_dispatcher = None
+_dispatcher_pid = None
+_dispatcher_lock = threading.Lock()
+
+
+def get_dispatcher():
+    """Returns the dispatcher of this process or None, if no sink is configured"""
+    global _dispatcher, _dispatcher_pid
+    config = getattr(settings, "NOTIFICATIONS", {})
+    if not config.get("SINKS"):
+        return None
+    with _dispatcher_lock:
+        if _dispatcher is None or _dispatcher_pid != os.getpid():
+            _dispatcher = NotificationDispatcher(
+                [_create_sink(x) for x in config["SINKS"]],
+                batch_interval=config.get("BATCH_INTERVAL", DEFAULT_BATCH_INTERVAL),
+                rate_limit=config.get("RATE_LIMIT", DEFAULT_RATE_LIMIT),
+                rate_period=config.get("RATE_PERIOD", DEFAULT_RATE_PERIOD),
+            )
+            _dispatcher_pid = os.getpid()
+            atexit.register(_dispatcher.close)
+        return _dispatcher
@@ -0,0 +1,295 @@
+"""Process local read-through caches for small reference tables.
+
+Every cache has a row in CacheVersion, which is bumped by the save and delete signals of the cached models. A process
+compares its versions with the database at most every VERSION_CHECK_INTERVAL seconds and reloads outdated caches.
+Callers which must not see stale data, like the declaration export, call versions.refresh() first, views validating
+references before a write use get_current().
+"""
+import time
+
+from django.db.models import F
+
+from api.models import CacheVersion, Label, TimePeriod, DayTimePeriod, SchedulingInterval, Check, Proxy, ScheduledObject
+
+VERSION_CHECK_INTERVAL = 1.0
+
+# Labels are cached on demand, the cache is emptied if it grows larger than this
+LABEL_CACHE_SIZE = 100000
+
+MINUTES_PER_DAY = 1440
+MINUTES_PER_WEEK = 7 * MINUTES_PER_DAY
+# The unix epoch was a thursday
+EPOCH_MINUTE_OF_WEEK = 3 * MINUTES_PER_DAY
+WEEKDAYS = ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"]
+
+
+class Versions:
+    def __init__(self):
+        self.versions = {}
+        self.checked = None
+
+    def refresh(self):
+        self.versions = dict(CacheVersion.objects.values_list("name", "version"))
+        self.checked = time.monotonic()
+
+    def get(self, name):
+        if self.checked is None or time.monotonic() - self.checked >= VERSION_CHECK_INTERVAL:
+            self.refresh()
+        return self.versions.get(name, 0)
+
+    def bump(self, name):
+        if not CacheVersion.objects.filter(name=name).update(version=F("version") + 1):
+            CacheVersion.objects.get_or_create(name=name, defaults={"version": 1})
+        self.checked = None
+
+
+versions = Versions()
+
+
+def _to_id(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class LabelRecord:
+    __slots__ = ("id", "label")
+
+    def __init__(self, id, label):
+        self.id = id
+        self.label = label
+
+
+def _minute(value: str) -> int:
+    """Converts a time of the form HHMM to the minute of the day, 2400 is the last minute"""
+    value = int(value)
+    return min(value // 100 * 60 + value % 100, MINUTES_PER_DAY - 1)
+
+
+class TimePeriodRecord:
+    __slots__ = ("id", "name", "comment", "time_periods", "bitmap", "exported")
+
+    def __init__(self, id, name, comment, time_periods):
+        self.id = id
+        self.name = name
+        self.comment = comment
+        # Day name -> list of (start_time, stop_time)
+        self.time_periods = time_periods
+        self.bitmap = None
+        self.exported = None
+
+    def compile(self) -> int:
+        """Returns the period as bitmap of the minutes of a week, bit 0 is monday 00:00 UTC.
+
+        Start and stop time are both included, like the scheduler does.
+        """
+        bitmap = 0
+        for day, periods in self.time_periods.items():
+            if day.lower() not in WEEKDAYS:
+                continue
+            offset = WEEKDAYS.index(day.lower()) * MINUTES_PER_DAY
+            for start_time, stop_time in periods:
+                start, stop = _minute(start_time), _minute(stop_time)
+                if start <= stop:
+                    bitmap |= ((1 << (stop - start + 1)) - 1) << (offset + start)
+        return bitmap
+
+    def contains(self, timestamp) -> bool:
+        """Checks if a unix timestamp is inside the period"""
+        if self.bitmap is None:
+            self.bitmap = self.compile()
+        return bool(self.bitmap >> ((int(timestamp) // 60 + EPOCH_MINUTE_OF_WEEK) % MINUTES_PER_WEEK) & 1)
+
+    def to_dict(self):
+        """Returns the exported form of the period. Records are replaced on change, so it is built only once."""
+        if self.exported is None:
+            self.exported = self._to_dict()
+        return self.exported
+
+    def _to_dict(self):
+        return {
+            "id": self.id,
+            "name": self.name,
+            "comment": self.comment,
+            "time_periods": {
+                x: [{"start_time": y[0], "stop_time": y[1]} for y in periods]
+                for x, periods in self.time_periods.items()
+            }
+        }
+
+
+class SchedulingIntervalRecord:
+    __slots__ = ("id", "interval")
+
+    def __init__(self, id, interval):
+        self.id = id
+        self.interval = interval
+
+
+class CheckRecord:
+    __slots__ = ("id", "name", "cmd", "comment")
+
+    def __init__(self, id, name, cmd, comment):
+        self.id = id
+        self.name = name
+        self.cmd = cmd
+        self.comment = comment
+
+    def to_export(self, kvp: dict):
+        if not self.cmd:
+            return ""
+        cmd = self.cmd
+        for x in kvp:
+            cmd = cmd.replace(x, kvp[x])
+        return cmd
+
+
+class ProxyRecord:
+    __slots__ = ("id", "core_secret", "disabled")
+
+    def __init__(self, id, core_secret, disabled):
+        self.id = id
+        self.core_secret = core_secret
+        self.disabled = disabled
+
+
+class ReferenceCache:
+    """Cache of all rows of a model. The rows are loaded on first access after a version change."""
+    name = ""
+
+    def __init__(self):
+        self.version = None
+        self.records = {}
+
+    def load(self) -> dict:
+        return NotImplemented
+
+    def invalidate(self):
+        versions.bump(self.name)
+
+    def _validate(self):
+        version = versions.get(self.name)
+        if version != self.version:
+            self.records = self.load()
+            self.version = version
+
+    def all(self) -> dict:
+        self._validate()
+        return self.records
+
+    def get(self, record_id):
+        self._validate()
+        return self.records.get(_to_id(record_id))
+
+    def get_current(self, record_id):
+        """Like get, but compares the version with the database first. Used to validate references before a write,
+        as another process may have created or deleted the record within the last VERSION_CHECK_INTERVAL seconds."""
+        versions.refresh()
+        return self.get(record_id)
+
+
+class TimePeriodCache(ReferenceCache):
+    name = "time_periods"
+
+    def load(self) -> dict:
+        periods = {}
+        for day_time_period_id, start_time, stop_time in DayTimePeriod.periods.through.objects.order_by(
+                "daytimeperiod_id", "period_id"
+        ).values_list("daytimeperiod_id", "period__start_time", "period__stop_time"):
+            periods.setdefault(day_time_period_id, []).append((start_time, stop_time))
+        records = {
+            x[0]: TimePeriodRecord(x[0], x[1], x[2], {})
+            for x in TimePeriod.objects.values_list("id", "name", "comment")
+        }
+        for time_period_id, day_time_period_id, day in TimePeriod.time_periods.through.objects.order_by(
+                "timeperiod_id", "daytimeperiod_id"
+        ).values_list("timeperiod_id", "daytimeperiod_id", "daytimeperiod__day__name"):
+            records[time_period_id].time_periods[day] = periods.get(day_time_period_id, [])
+        return records
+
+
+class SchedulingIntervalCache(ReferenceCache):
+    name = "scheduling_intervals"
+
+    def __init__(self):
+        super(SchedulingIntervalCache, self).__init__()
+        self.by_interval = {}
+
+    def load(self) -> dict:
+        records = {x[0]: SchedulingIntervalRecord(*x) for x in SchedulingInterval.objects.values_list("id", "interval")}
+        self.by_interval = {x.interval: x for x in records.values()}
+        return records
+
+    def get_or_create(self, interval) -> SchedulingIntervalRecord:
+        self._validate()
+        interval = int(interval)
+        if interval not in self.by_interval:
+            scheduling_interval, _ = SchedulingInterval.objects.get_or_create(interval=interval)
+            record = SchedulingIntervalRecord(scheduling_interval.id, scheduling_interval.interval)
+            self.records[record.id] = record
+            self.by_interval[record.interval] = record
+        return self.by_interval[interval]
+
+
+class CheckCache(ReferenceCache):
+    name = "checks"
+
+    def load(self) -> dict:
+        return {x[0]: CheckRecord(*x) for x in Check.objects.values_list("id", "name", "cmd", "comment")}
+
+
+class ProxyCache(ReferenceCache):
+    name = "proxies"
+
+    def load(self) -> dict:
+        return {x[0]: ProxyRecord(*x) for x in Proxy.objects.values_list("id", "core_secret", "disabled")}
+
+
+class ScheduledObjectCache(ReferenceCache):
+    """Measurements of the scheduled objects, keyed by (content type id, object id)"""
+    name = "scheduled_objects"
+
+    def load(self) -> dict:
+        return {
+            (x[0], x[1]): x[2]
+            for x in ScheduledObject.objects.values_list("content_type_id", "object_id", "measurement")
+        }
+
+    def get(self, content_type_id, object_id):
+        self._validate()
+        return self.records.get((content_type_id, _to_id(object_id)))
+
+
+class LabelCache:
+    """Read-through cache of label -> LabelRecord. Only labels which were requested are held."""
+    name = "labels"
+
+    def __init__(self):
+        self.version = None
+        self.records = {}
+
+    def invalidate(self):
+        versions.bump(self.name)
+
+    def _validate(self):
+        version = versions.get(self.name)
+        if version != self.version or len(self.records) > LABEL_CACHE_SIZE:
+            self.records = {}
+            self.version = version
+
+    def lookup(self, names) -> dict:
+        """Returns a mapping of label -> id for every cached name in names"""
+        self._validate()
+        return {x: self.records[x].id for x in names if x in self.records}
+
+    def add(self, labels: dict):
+        self.records.update({x: LabelRecord(y, x) for x, y in labels.items()})
+
+
+labels = LabelCache()
+time_periods = TimePeriodCache()
+scheduling_intervals = SchedulingIntervalCache()
+checks = CheckCache()
+proxies = ProxyCache()
+scheduled_objects = ScheduledObjectCache()
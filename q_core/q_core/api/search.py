@@ -0,0 +1,152 @@
+from django.contrib.contenttypes.models import ContentType
+from django.db.models import Count, Sum
+
+from api.models import SearchTrigram, GenericKVP
+
+# Candidates of a query, which are loaded at once to verify that they contain it
+VERIFY_BATCH_SIZE = 1000
+
+
+def get_trigrams(text) -> set:
+    text = str(text).lower() if text else ""
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def _weighted_trigrams(texts) -> dict:
+    """Returns a mapping of trigram -> weight for an iterable of (text, weight).
+
+    If a trigram occurs in multiple texts, the highest weight is used.
+    """
+    trigrams = {}
+    for text, weight in texts:
+        for x in get_trigrams(text):
+            if trigrams.get(x, 0) < weight:
+                trigrams[x] = weight
+    return trigrams
+
+
+def _searchable_texts(obj, variables) -> list:
+    texts = [
+        (obj.__getattribute__(x), y) for x, y in obj.search_fields.items() if x != "variables"
+    ]
+    if "variables" in obj.search_fields:
+        texts.extend((x, obj.search_fields["variables"]) for x in variables)
+    return texts
+
+
+def _variables(content_type, object_ids=None) -> dict:
+    """Returns a mapping of object id -> labels of the keys and values of its variables"""
+    variables = {}
+    kvps = GenericKVP.objects.filter(content_type=content_type)
+    if object_ids is not None:
+        kvps = kvps.filter(object_id__in=object_ids)
+    for object_id, key, value in kvps.values_list("object_id", "key__label", "value__label"):
+        variables.setdefault(object_id, []).extend((key, value))
+    return variables
+
+
+def _contains(texts, query: str) -> bool:
+    return any(query in str(x).lower() for x, _ in texts if x)
+
+
+def index_object(obj):
+    """(Re)builds the index entries of obj"""
+    content_type = ContentType.objects.get_for_model(obj)
+    SearchTrigram.objects.filter(content_type=content_type, object_id=obj.id).delete()
+    variables = []
+    if "variables" in obj.search_fields:
+        [variables.extend(x) for x in obj.variables.values_list("key__label", "value__label")]
+    SearchTrigram.objects.bulk_create([
+        SearchTrigram(trigram=x, weight=y, content_type=content_type, object_id=obj.id)
+        for x, y in _weighted_trigrams(_searchable_texts(obj, variables)).items()
+    ])
+
+
+def remove_object(obj):
+    SearchTrigram.objects.filter(content_type=ContentType.objects.get_for_model(obj), object_id=obj.id).delete()
+
+
+def rebuild_index(model):
+    """Rebuilds the index of all objects of model"""
+    content_type = ContentType.objects.get_for_model(model)
+    SearchTrigram.objects.filter(content_type=content_type).delete()
+    variables = _variables(content_type) if "variables" in model.search_fields else {}
+
+    creation = []
+    fields = [x for x in model.search_fields if x != "variables"]
+    for obj in model.objects.all().only("id", *fields).iterator():
+        creation.extend(
+            SearchTrigram(trigram=x, weight=y, content_type=content_type, object_id=obj.id)
+            for x, y in _weighted_trigrams(_searchable_texts(obj, variables.get(obj.id, []))).items()
+        )
+        if len(creation) >= 5000:
+            SearchTrigram.objects.bulk_create(creation)
+            creation.clear()
+    SearchTrigram.objects.bulk_create(creation)
+
+
+class SearchResult:
+    """Ids of the objects of model matching query, best match first.
+
+    The candidates are verified in the order of their rank, only as far as the result is accessed. So a page of the
+    result costs the queries of verifying the candidates up to that page. count() is the number of matches verified so
+    far plus the number of candidates not verified yet, which is exact once all candidates were verified.
+    """
+
+    def __init__(self, model, query: str, candidates: list, verified=False):
+        self.model = model
+        self.query = str(query).lower()
+        self.candidates = candidates
+        self.matches = list(candidates) if verified else []
+        self.verified = len(candidates) if verified else 0
+
+    def _verify(self, stop: int):
+        """Verifies candidates until stop matches were found or no candidate is left"""
+        content_type = ContentType.objects.get_for_model(self.model)
+        fields = [x for x in self.model.search_fields if x != "variables"]
+        while len(self.matches) < stop and self.verified < len(self.candidates):
+            batch = self.candidates[self.verified:self.verified + VERIFY_BATCH_SIZE]
+            objects = self.model.objects.filter(id__in=batch).only("id", *fields).in_bulk()
+            variables = _variables(content_type, batch) if "variables" in self.model.search_fields else {}
+            self.matches.extend(
+                x for x in batch
+                if x in objects and _contains(_searchable_texts(objects[x], variables.get(x, [])), self.query)
+            )
+            self.verified += len(batch)
+
+    def count(self) -> int:
+        return len(self.matches) + len(self.candidates) - self.verified
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            stop = index.stop
+        else:
+            stop = index + 1
+        self._verify(len(self.candidates) if stop is None or stop < 0 else stop)
+        return self.matches[index]
+
+    def __iter__(self):
+        self._verify(len(self.candidates))
+        return iter(self.matches)
+
+
+def search(model, query) -> SearchResult:
+    """Returns the ids of the objects of model matching query, best match first.
+
+    An object matches if one of its searchable attributes contains query, ignoring the case. Candidates are the objects
+    having all trigrams of query in their index, each of them is verified against its attributes, as the trigrams may
+    come from different attributes or places. The rank is the sum of the weights of the attributes the trigrams were
+    found in, so a match in the name ranks higher than one in a comment. Queries shorter than three characters fall
+    back to a substring match on the name.
+    """
+    trigrams = get_trigrams(query)
+    if not trigrams:
+        return SearchResult(model, query, list(
+            model.objects.filter(name__icontains=query).order_by("name").values_list("id", flat=True)
+        ), verified=True)
+    content_type = ContentType.objects.get_for_model(model)
+    return SearchResult(model, query, list(
+        SearchTrigram.objects.filter(content_type=content_type, trigram__in=trigrams).values("object_id").annotate(
+            matched=Count("id"), score=Sum("weight")
+        ).filter(matched=len(trigrams)).order_by("-score", "object_id").values_list("object_id", flat=True)
+    ))
@@ -0,0 +1,170 @@
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+
+from api import effective, notifications, reference, state
+from api.models import Check, Contact, ContactGroup, Proxy, TimePeriod, Host, HostTemplate, Observable, \
+    ObservableTemplate, GlobalVariable, Label, DayTimePeriod, Period, SchedulingInterval, ScheduledObject, \
+    CurrentState, OrderedListItem
+from api.search import index_object, remove_object
+from api.statemachine import state_changed
+
+searchable_models = [
+    Check, Contact, ContactGroup, Proxy, TimePeriod, Host, HostTemplate, Observable, ObservableTemplate
+]
+
+
+def update_search_index(sender, instance, **kwargs):
+    index_object(instance)
+
+
+def delete_search_index(sender, instance, **kwargs):
+    remove_object(instance)
+
+
+for model in searchable_models:
+    post_save.connect(update_search_index, sender=model, dispatch_uid=f"search_save_{model.__name__}")
+    post_delete.connect(delete_search_index, sender=model, dispatch_uid=f"search_delete_{model.__name__}")
+
+
+def invalidate_labels(sender, **kwargs):
+    reference.labels.invalidate()
+
+
+def invalidate_time_periods(sender, **kwargs):
+    reference.time_periods.invalidate()
+
+
+def invalidate_time_periods_m2m(sender, action, **kwargs):
+    if action.startswith("post_"):
+        reference.time_periods.invalidate()
+
+
+def invalidate_scheduling_intervals(sender, **kwargs):
+    reference.scheduling_intervals.invalidate()
+
+
+def invalidate_checks(sender, **kwargs):
+    reference.checks.invalidate()
+
+
+def invalidate_proxies(sender, **kwargs):
+    reference.proxies.invalidate()
+
+
+def invalidate_scheduled_objects(sender, **kwargs):
+    reference.scheduled_objects.invalidate()
+
+
+# Fields of the models in the recipient cache besides the m2m relations, see api/notifications.py
+RECIPIENT_CONTACT_FIELDS = {"name", "mail", "linked_host_notification_period", "linked_observable_notification_period"}
+RECIPIENT_ITEM_FIELDS = {"index", "content_type", "object_id"}
+
+
+def _saves(kwargs, fields) -> bool:
+    """Returns whether a save may have changed one of fields"""
+    update_fields = kwargs.get("update_fields")
+    return update_fields is None or not fields.isdisjoint(update_fields)
+
+
+def invalidate_recipients(sender, **kwargs):
+    notifications.recipients.invalidate()
+
+
+def invalidate_recipients_contact(sender, **kwargs):
+    # New contacts are not linked to any object yet
+    if not kwargs.get("created") and _saves(kwargs, RECIPIENT_CONTACT_FIELDS):
+        notifications.recipients.invalidate()
+
+
+def invalidate_recipients_item(sender, instance, **kwargs):
+    # Items are created before they are added to an object, only the order of templates is cached
+    if not kwargs.get("created") and _saves(kwargs, RECIPIENT_ITEM_FIELDS) and \
+            instance.content_type.model_class() in (HostTemplate, ObservableTemplate):
+        notifications.recipients.invalidate()
+
+
+def invalidate_recipients_m2m(sender, action, **kwargs):
+    if action.startswith("post_"):
+        notifications.recipients.invalidate()
+
+
+cached_models = [
+    (Label, invalidate_labels),
+    (TimePeriod, invalidate_time_periods),
+    (DayTimePeriod, invalidate_time_periods),
+    (Period, invalidate_time_periods),
+    (SchedulingInterval, invalidate_scheduling_intervals),
+    (Check, invalidate_checks),
+    (Proxy, invalidate_proxies),
+    (ScheduledObject, invalidate_scheduled_objects),
+]
+for model, invalidate in cached_models:
+    post_save.connect(invalidate, sender=model, dispatch_uid=f"cache_save_{model.__name__}")
+    post_delete.connect(invalidate, sender=model, dispatch_uid=f"cache_delete_{model.__name__}")
+# Saved hosts, observables, templates and groups keep their recipients, their relations change by m2m_changed. Deletes
+# remove the rows of the relations without m2m_changed.
+post_save.connect(invalidate_recipients_contact, sender=Contact, dispatch_uid="cache_save_Contact")
+post_save.connect(invalidate_recipients_item, sender=OrderedListItem, dispatch_uid="cache_save_OrderedListItem")
+post_delete.connect(invalidate_recipients_item, sender=OrderedListItem, dispatch_uid="cache_delete_OrderedListItem")
+for model in [Contact, ContactGroup, HostTemplate, ObservableTemplate]:
+    post_delete.connect(invalidate_recipients, sender=model, dispatch_uid=f"cache_delete_{model.__name__}")
+for through in [TimePeriod.time_periods.through, DayTimePeriod.periods.through]:
+    m2m_changed.connect(invalidate_time_periods_m2m, sender=through, dispatch_uid=f"cache_m2m_{through.__name__}")
+for through in [
+    ContactGroup.linked_contacts.through,
+    *[x.linked_contacts.through for x in [Host, HostTemplate, Observable, ObservableTemplate]],
+    *[x.linked_contact_groups.through for x in [Host, HostTemplate, Observable, ObservableTemplate]],
+    Host.host_templates.through, HostTemplate.host_templates.through,
+    Observable.observable_templates.through, ObservableTemplate.observable_templates.through,
+]:
+    m2m_changed.connect(invalidate_recipients_m2m, sender=through, dispatch_uid=f"cache_m2m_{through.__name__}")
+
+
+@receiver(post_save, sender=Host)
+def update_host_config(sender, instance, **kwargs):
+    effective.refresh_hosts([instance.id])
+
+
+@receiver(post_save, sender=Observable)
+def update_observable_config(sender, instance, **kwargs):
+    effective.refresh_observables([instance.id])
+
+
+@receiver(post_delete, sender=Host)
+@receiver(post_delete, sender=Observable)
+def delete_config(sender, instance, **kwargs):
+    effective.remove(instance)
+    state.remove(instance)
+
+
+@receiver(post_save, sender=HostTemplate)
+@receiver(post_delete, sender=HostTemplate)
+def update_host_template_configs(sender, instance, **kwargs):
+    resolver = effective.ConfigResolver()
+    effective.refresh_hosts(resolver.hosts_inheriting(instance.id), resolver)
+
+
+@receiver(post_save, sender=ObservableTemplate)
+@receiver(post_delete, sender=ObservableTemplate)
+def update_observable_template_configs(sender, instance, **kwargs):
+    resolver = effective.ConfigResolver()
+    effective.refresh_observables(resolver.observables_inheriting(instance.id), resolver)
+
+
+@receiver(post_save, sender=Check)
+def update_check_configs(sender, instance, **kwargs):
+    if not kwargs["created"]:
+        effective.refresh_check(instance.id)
+
+
+@receiver(post_save, sender=GlobalVariable)
+@receiver(post_delete, sender=GlobalVariable)
+def update_all_configs(sender, instance, **kwargs):
+    # A new GlobalVariable has no value yet, it will be saved again after setting it
+    if not kwargs.get("created"):
+        effective.refresh_all()
+
+
+@receiver(state_changed, sender=CurrentState)
+def notify_contacts(sender, transitions, **kwargs):
+    notifications.notify(transitions)
@@ -0,0 +1,357 @@
+"""Latest state of every host and observable.
+
+The ingestion writes the states in batches to the CurrentState table. Every process holds a StateStore, which
+follows the table incrementally by the updated timestamp of the rows and indexes the states by state, proxy, host and
+label. Labels are the effective variables of an object in the form key=value.
+
+The store is snapshot to disk periodically, so a restarted process only has to read the rows changed since the
+snapshot was written.
+"""
+import gzip
+import json
+import logging
+import os
+import sys
+import time
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+
+from api.models import CurrentState, EffectiveConfig, Host
+from api.statemachine import StateMachine, Transition, state_changed, DEFAULT_MAX_ATTEMPTS
+from q_core import settings
+
+logger = logging.getLogger("state")
+
+# Minimum time between two synchronisations of a store with the database
+SYNC_INTERVAL = 1.0
+# Rows written up to this many seconds before the last synchronisation are read again, as concurrent transactions
+# may commit rows with an older updated timestamp
+SYNC_OVERLAP = 10.0
+SNAPSHOT_INTERVAL = 60.0
+DEFAULT_SNAPSHOT_PATH = "/var/lib/q/state-snapshot.json.gz"
+
+PROBLEM_STATES = ("warning", "critical", "unknown")
+
+
+def _labels(variables: str) -> list:
+    return [f"{x}={y}" for x, y in json.loads(variables).items() if x != "$host_address$"]
+
+
+def _by_content_type(keys) -> dict:
+    grouped = {}
+    for content_type_id, object_id in sorted(keys):
+        grouped.setdefault(content_type_id, []).append(object_id)
+    return grouped
+
+
+def _lock(keys) -> dict:
+    """Returns the CurrentState rows of keys, locked until the end of the transaction.
+
+    Rows are locked in the order of their content type and id, so batches sharing objects do not deadlock.
+    """
+    rows = {}
+    for content_type_id, object_ids in _by_content_type(keys).items():
+        rows.update({
+            (content_type_id, x.object_id): x for x in CurrentState.objects.select_for_update().filter(
+                content_type_id=content_type_id, object_id__in=object_ids
+            ).order_by("id")
+        })
+    return rows
+
+
+def _metadata(keys) -> dict:
+    """Returns a mapping of (content type id, object id) -> (host id, labels, max attempts) from the effective
+    configuration"""
+    chost = ContentType.objects.get_for_model(Host).id
+    metadata = {}
+    for content_type_id, object_ids in _by_content_type(keys).items():
+        for object_id, host_id, variables, max_attempts in EffectiveConfig.objects.filter(
+                content_type_id=content_type_id, object_id__in=object_ids
+        ).values_list("object_id", "linked_host_id", "variables", "max_attempts"):
+            metadata[(content_type_id, object_id)] = (
+                object_id if content_type_id == chost else host_id, json.dumps(_labels(variables)), max_attempts
+            )
+    return metadata
+
+
+def update_states(updates) -> list:
+    """Stores the latest states of a batch of check results with a constant number of queries.
+
+    Every result is fed to the state machine of its object, the resulting transitions are sent with the state_changed
+    signal once the states are stored. Results older than the stored state are ignored. The rows of the batch are
+    locked while the states are computed, so concurrent batches of the same objects are applied one after another.
+
+    :param updates: Iterable of (content type id, object id, proxy id, state, output, timestamp) in order of arrival
+    :return: List of Transition
+    """
+    latest = {}
+    for content_type_id, object_id, proxy_id, state, output, timestamp in updates:
+        latest.setdefault((content_type_id, int(object_id)), []).append((proxy_id, state, output, timestamp))
+    if not latest:
+        return []
+
+    now = time.time()
+    transitions = []
+    with transaction.atomic():
+        existing = _lock(latest.keys())
+        missing = [x for x in latest if x not in existing]
+        if missing:
+            # Rows of new objects are created first, so they are locked like the others. Rows created concurrently by
+            # another batch are waited for and locked instead.
+            metadata = _metadata(missing)
+            creation = []
+            for key in missing:
+                host_id, labels, max_attempts = metadata.get(key, (None, "[]", None))
+                creation.append(CurrentState(content_type_id=key[0], object_id=key[1], host_id=host_id, labels=labels,
+                                             max_attempts=max_attempts))
+            CurrentState.objects.bulk_create(creation, ignore_conflicts=True)
+            existing.update(_lock(missing))
+
+        changed = []
+        for key, results in latest.items():
+            current = existing[key]
+            if current.removed:
+                current.removed = False
+                current.hard_state = ""
+            machine = StateMachine(current.history, current.state, current.hard_state, current.attempt,
+                                   current.flapping)
+            pushed = False
+            for proxy_id, state, output, timestamp in sorted(results, key=lambda x: x[3]):
+                if current.last_check > timestamp:
+                    continue
+                pushed = True
+                if current.state != state:
+                    current.last_change = timestamp
+                transitions.extend(
+                    Transition(*key, kind, previous, hard_state, timestamp, machine.flapping)
+                    for kind, previous, hard_state in machine.push(state, current.max_attempts or DEFAULT_MAX_ATTEMPTS)
+                )
+                current.proxy_id = proxy_id
+                current.state = state
+                current.output = output
+                current.last_check = timestamp
+            if not pushed:
+                continue
+            current.hard_state = machine.hard_state
+            current.attempt = machine.attempt
+            current.history = machine.history
+            current.flapping = machine.flapping
+            current.updated = now
+            changed.append(current)
+        if changed:
+            CurrentState.objects.bulk_update(changed, [
+                "proxy_id", "state", "hard_state", "attempt", "history", "flapping", "output", "last_check",
+                "last_change", "removed", "updated"
+            ])
+    if transitions:
+        state_changed.send(sender=CurrentState, transitions=transitions)
+    return transitions
+
+
+def update_metadata(configs):
+    """Updates host, labels and max attempts of the stored states of freshly resolved EffectiveConfigs"""
+    chost = ContentType.objects.get_for_model(Host).id
+    configs = {(x.content_type_id, x.object_id): x for x in configs}
+    changed = []
+    now = time.time()
+    for content_type_id, object_ids in _by_content_type(configs.keys()).items():
+        for current in CurrentState.objects.filter(content_type_id=content_type_id, object_id__in=object_ids):
+            config = configs[(content_type_id, current.object_id)]
+            host_id = config.object_id if content_type_id == chost else config.linked_host_id
+            labels = json.dumps(_labels(config.variables))
+            if current.host_id != host_id or current.labels != labels or current.max_attempts != config.max_attempts:
+                current.host_id = host_id
+                current.labels = labels
+                current.max_attempts = config.max_attempts
+                current.updated = now
+                changed.append(current)
+    if changed:
+        CurrentState.objects.bulk_update(changed, ["host_id", "labels", "max_attempts", "updated"])
+
+
+def remove(obj):
+    CurrentState.objects.filter(
+        content_type=ContentType.objects.get_for_model(obj), object_id=obj.id
+    ).update(removed=True, updated=time.time())
+
+
+class StateRecord:
+    __slots__ = (
+        "content_type_id", "object_id", "proxy_id", "host_id", "labels", "state", "hard_state", "flapping", "output",
+        "last_check", "last_change"
+    )
+
+    def __init__(self, content_type_id, object_id, proxy_id, host_id, labels, state, hard_state, flapping, output,
+                 last_check, last_change):
+        self.content_type_id = content_type_id
+        self.object_id = object_id
+        self.proxy_id = proxy_id
+        self.host_id = host_id
+        self.labels = labels
+        self.state = state
+        self.hard_state = hard_state
+        self.flapping = flapping
+        self.output = output
+        self.last_check = last_check
+        self.last_change = last_change
+
+    def to_dict(self):
+        return {
+            "object_id": self.object_id,
+            "content_type": self.content_type_id,
+            "proxy": self.proxy_id if self.proxy_id else "",
+            "host": self.host_id if self.host_id else "",
+            "labels": list(self.labels),
+            "state": self.state,
+            "hard_state": self.hard_state,
+            "flapping": self.flapping,
+            "output": self.output,
+            "last_check": self.last_check,
+            "last_change": self.last_change
+        }
+
+
+class StateStore:
+    """Process local copy of the CurrentState table with indexes.
+
+    Records are keyed by (content type id, object id). Every index maps a value to the set of keys having it, so
+    filtered queries only visit the keys of the smallest matching set.
+    """
+
+    def __init__(self, snapshot_path=None):
+        self.snapshot_path = snapshot_path
+        self.records = {}
+        self.by_state = {}
+        self.by_proxy = {}
+        self.by_host = {}
+        self.by_label = {}
+        self.loaded = False
+        self.synced = 0.0
+        self.checked = None
+        self.snapshot_written = time.monotonic()
+
+    def _indexes(self, record):
+        yield self.by_state, record.state
+        yield self.by_proxy, record.proxy_id
+        yield self.by_host, record.host_id
+        for x in record.labels:
+            yield self.by_label, x
+
+    def discard(self, key):
+        record = self.records.pop(key, None)
+        if record is None:
+            return
+        for index, value in self._indexes(record):
+            keys = index.get(value)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del index[value]
+
+    def apply(self, record: StateRecord):
+        key = (record.content_type_id, record.object_id)
+        self.discard(key)
+        record.labels = tuple(sys.intern(x) for x in record.labels)
+        self.records[key] = record
+        for index, value in self._indexes(record):
+            index.setdefault(value, set()).add(key)
+
+    def _load_snapshot(self) -> bool:
+        if not self.snapshot_path or not os.path.isfile(self.snapshot_path):
+            return False
+        try:
+            with gzip.open(self.snapshot_path, "rt", encoding="utf-8") as fh:
+                snapshot = json.load(fh)
+        except (OSError, ValueError) as err:
+            logger.error(f"Could not read state snapshot {self.snapshot_path}: {err}")
+            return False
+        try:
+            [self.apply(StateRecord(*x)) for x in snapshot["records"]]
+        except TypeError:
+            # Snapshot of an older format, the store is loaded from the database instead
+            logger.warning(f"State snapshot {self.snapshot_path} has an unknown format")
+            [x.clear() for x in [self.records, self.by_state, self.by_proxy, self.by_host, self.by_label]]
+            return False
+        self.synced = snapshot["synced"]
+        return True
+
+    def snapshot(self):
+        """Writes the store to the snapshot path. The file is replaced atomically."""
+        if not self.snapshot_path:
+            return
+        data = {
+            "synced": self.synced,
+            "records": [
+                [x.content_type_id, x.object_id, x.proxy_id, x.host_id, x.labels, x.state, x.hard_state, x.flapping,
+                 x.output, x.last_check, x.last_change]
+                for x in self.records.values()
+            ]
+        }
+        tmp = f"{self.snapshot_path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(self.snapshot_path), exist_ok=True)
+            with gzip.open(tmp, "wt", encoding="utf-8") as fh:
+                json.dump(data, fh)
+            os.replace(tmp, self.snapshot_path)
+        except OSError as err:
+            logger.error(f"Could not write state snapshot {self.snapshot_path}: {err}")
+        self.snapshot_written = time.monotonic()
+
+    def sync(self, force=False):
+        """Applies all rows changed since the last synchronisation, at most every SYNC_INTERVAL seconds"""
+        if not force and self.checked is not None and time.monotonic() - self.checked < SYNC_INTERVAL:
+            return
+        if not self.loaded:
+            self.loaded = True
+            self._load_snapshot()
+        self.checked = time.monotonic()
+        rows = CurrentState.objects.filter(updated__gte=self.synced - SYNC_OVERLAP).values_list(
+            "content_type_id", "object_id", "proxy_id", "host_id", "labels", "state", "hard_state", "flapping",
+            "output", "last_check", "last_change", "removed", "updated"
+        )
+        for row in rows.iterator():
+            if row[11]:
+                self.discard((row[0], row[1]))
+            else:
+                self.apply(StateRecord(row[0], row[1], row[2], row[3], json.loads(row[4]), *row[5:11]))
+            self.synced = max(self.synced, row[12])
+        if time.monotonic() - self.snapshot_written >= SNAPSHOT_INTERVAL:
+            self.snapshot()
+
+    def select(self, states=None, proxy=None, host=None, label=None) -> set:
+        """Returns the keys of all records matching every given filter"""
+        self.sync()
+        candidates = []
+        if states:
+            candidates.append(set().union(*[self.by_state.get(x, set()) for x in states]))
+        if proxy is not None:
+            candidates.append(self.by_proxy.get(proxy, set()))
+        if host is not None:
+            candidates.append(self.by_host.get(host, set()))
+        if label is not None:
+            candidates.append(self.by_label.get(label, set()))
+        if not candidates:
+            return set(self.records)
+        candidates.sort(key=len)
+        return {x for x in candidates[0] if all(x in y for y in candidates[1:])}
+
+    def summary(self, proxy=None, host=None, label=None) -> dict:
+        """Returns a mapping of state -> number of objects in that state"""
+        self.sync()
+        if proxy is None and host is None and label is None:
+            return {x: len(y) for x, y in self.by_state.items()}
+        summary = {}
+        for key in self.select(proxy=proxy, host=host, label=label):
+            state = self.records[key].state
+            summary[state] = summary.get(state, 0) + 1
+        return summary
+
+    def problems(self, states=PROBLEM_STATES, proxy=None, host=None, label=None, limit=None) -> list:
+        """Returns the matching records, the most recently changed first"""
+        records = [self.records[x] for x in self.select(states=states, proxy=proxy, host=host, label=label)]
+        records.sort(key=lambda x: x.last_change, reverse=True)
+        return records[:limit] if limit else records
+
+
+store = StateStore(getattr(settings, "STATE_SNAPSHOT_PATH", DEFAULT_SNAPSHOT_PATH))
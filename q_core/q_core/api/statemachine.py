@@ -0,0 +1,105 @@
+"""State machine of a scheduled object.
+
+Every result is pushed into a ring buffer of the last HISTORY_SIZE states. The number of state changes inside the
+buffer is maintained on every push, so the flap percentage costs O(1) per result.
+
+A problem becomes hard once max_attempts non ok results were returned in a row, whichever problem states they have, as
+the retries of the scheduler count them. A recovery to ok is hard immediately.
+Transitions are only emitted when the hard state changes or flapping starts or stops. They are sent with the
+state_changed signal after the states are stored.
+"""
+from django.dispatch import Signal
+
+HISTORY_SIZE = 21
+# Flapping starts above the high and stops below the low threshold
+FLAP_HIGH_THRESHOLD = 50.0
+FLAP_LOW_THRESHOLD = 25.0
+DEFAULT_MAX_ATTEMPTS = 3
+
+STATE_CODES = {"ok": "o", "warning": "w", "critical": "c", "unknown": "u"}
+UNKNOWN_CODE = "?"
+
+# Sent with transitions, a list of Transition
+state_changed = Signal()
+
+
+class Transition:
+    """Event of a state machine.
+
+    kind is one of "state", "flap_start" and "flap_stop". For "state", previous and state are the hard states before
+    and after the change, previous is "" for a new object.
+    """
+    __slots__ = ("content_type_id", "object_id", "kind", "previous", "state", "timestamp", "flapping")
+
+    def __init__(self, content_type_id, object_id, kind, previous, state, timestamp, flapping):
+        self.content_type_id = content_type_id
+        self.object_id = object_id
+        self.kind = kind
+        self.previous = previous
+        self.state = state
+        self.timestamp = timestamp
+        self.flapping = flapping
+
+    def __repr__(self):
+        return f"Transition({self.content_type_id}:{self.object_id} {self.kind} {self.previous} -> {self.state})"
+
+
+class StateMachine:
+    __slots__ = ("buffer", "head", "size", "changes", "state", "hard_state", "attempt", "flapping")
+
+    def __init__(self, history="", state="", hard_state="", attempt=0, flapping=False):
+        self.buffer = [""] * HISTORY_SIZE
+        self.head = 0
+        self.size = 0
+        self.changes = 0
+        for x in history[-HISTORY_SIZE:]:
+            self._push(x)
+        self.state = state
+        self.hard_state = hard_state
+        self.attempt = attempt
+        self.flapping = flapping
+
+    def _push(self, code):
+        if self.size == HISTORY_SIZE:
+            if self.buffer[self.head] != self.buffer[(self.head + 1) % HISTORY_SIZE]:
+                self.changes -= 1
+            self.head = (self.head + 1) % HISTORY_SIZE
+            self.size -= 1
+        if self.size and self.buffer[(self.head + self.size - 1) % HISTORY_SIZE] != code:
+            self.changes += 1
+        self.buffer[(self.head + self.size) % HISTORY_SIZE] = code
+        self.size += 1
+
+    @property
+    def history(self) -> str:
+        """Codes of the buffered states, oldest first"""
+        return "".join(self.buffer[(self.head + x) % HISTORY_SIZE] for x in range(self.size))
+
+    @property
+    def flap_percentage(self) -> float:
+        return self.changes / (HISTORY_SIZE - 1) * 100
+
+    def push(self, state, max_attempts=DEFAULT_MAX_ATTEMPTS) -> list:
+        """Feeds a result to the machine
+
+        :return: List of (kind, previous, state) of the transitions caused by the result
+        """
+        self._push(STATE_CODES.get(state, UNKNOWN_CODE))
+        # Non ok results count as attempts of the same problem, a change between ok and a problem starts over
+        self.attempt = self.attempt + 1 if self.state and (state == "ok") == (self.state == "ok") else 1
+        self.state = state
+
+        transitions = []
+        # A new object, a recovery or a change between problem states is hard immediately
+        if not self.hard_state or state == "ok" or self.hard_state != "ok" or self.attempt >= max_attempts:
+            if state != self.hard_state:
+                transitions.append(("state", self.hard_state, state))
+                self.hard_state = state
+
+        if not self.flapping and self.flap_percentage > FLAP_HIGH_THRESHOLD:
+            self.flapping = True
+            transitions.append(("flap_start", self.hard_state, self.hard_state))
+        elif self.flapping and self.flap_percentage < FLAP_LOW_THRESHOLD:
+            self.flapping = False
+            transitions.append(("flap_stop", self.hard_state, self.hard_state))
+        return transitions
@@ -1,3 +1,184 @@
+from unittest import mock
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection, IntegrityError
+from django.db.models import F
 from django.test import TestCase
 
-# Create your tests here.
+from api import notifications, reference, state
+from api.models import ACLModel, CacheVersion, Check, Contact, CurrentState, GenericKVP, Host, Label, Observable, OrderedListItem, Proxy, \
+    ScheduledObject
+from api.notifications import NotificationDispatcher
+from api.search import search
+from api.statemachine import StateMachine
+
+
+class QueryPlanTests(TestCase):
+    """The hot lookups of the views and the export have to be answered by an index instead of a table scan"""
+
+    def assertUsesIndex(self, queryset, name):
+        plan = queryset.explain()
+        if connection.vendor == "sqlite":
+            # SQLite creates the indexes of unique constraints itself and names them sqlite_autoindex_<table>_<n>
+            self.assertRegex(
+                plan, rf"SEARCH {queryset.model._meta.db_table} USING (COVERING )?INDEX ({name}|sqlite_autoindex_)"
+            )
+        else:
+            self.assertIn(name, plan)
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.content_type = ContentType.objects.get_for_model(Host)
+        cls.proxy = Proxy.objects.create(name="proxy")
+        cls.host = Host.objects.create(name="host", linked_proxy=cls.proxy)
+
+    def test_generic_kvp(self):
+        self.assertUsesIndex(
+            GenericKVP.objects.filter(content_type=self.content_type, object_id=self.host.id),
+            "generickvp_referent_key_uniq"
+        )
+
+    def test_ordered_list_item(self):
+        self.assertUsesIndex(
+            OrderedListItem.objects.filter(content_type=self.content_type, object_id__in=[1, 2]),
+            "orderedlistitem_referent_idx"
+        )
+
+    def test_scheduled_object(self):
+        self.assertUsesIndex(
+            ScheduledObject.objects.filter(content_type=self.content_type, object_id=self.host.id),
+            "scheduledobject_referent_uniq"
+        )
+
+    def test_observable(self):
+        self.assertUsesIndex(
+            Observable.objects.filter(name="observable", linked_host=self.host), "observable_host_name_uniq"
+        )
+
+    def test_acl(self):
+        self.assertUsesIndex(ACLModel.objects.filter(name="API:POST:/api/v1/authenticate"), "aclmodel_name_allow_uniq")
+
+
+class ConstraintTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.proxy = Proxy.objects.create(name="proxy")
+        cls.host = Host.objects.create(name="host", linked_proxy=cls.proxy)
+
+    def test_observable_name_unique_per_host(self):
+        Observable.objects.create(name="observable", linked_host=self.host, linked_proxy=self.proxy)
+        with self.assertRaises(IntegrityError):
+            Observable.objects.create(name="observable", linked_host=self.host, linked_proxy=self.proxy)
+
+    def test_one_value_per_variable(self):
+        key = Label.objects.create(label="key")
+        content_type = ContentType.objects.get_for_model(Host)
+        GenericKVP.objects.create(key=key, value=key, content_type=content_type, object_id=self.host.id)
+        with self.assertRaises(IntegrityError):
+            GenericKVP.objects.create(
+                key=key, value=Label.objects.create(label="value"), content_type=content_type, object_id=self.host.id
+            )
+
+
+class StateMachineTests(TestCase):
+
+    def test_alternating_problem_becomes_hard(self):
+        machine = StateMachine()
+        self.assertEqual(machine.push("ok", 3), [("state", "", "ok")])
+        self.assertEqual(machine.push("warning", 3), [])
+        self.assertEqual(machine.push("critical", 3), [])
+        self.assertEqual(machine.push("warning", 3), [("state", "ok", "warning")])
+        self.assertEqual(machine.attempt, 3)
+
+    def test_ok_resets_attempts(self):
+        machine = StateMachine()
+        for x in ("ok", "critical", "warning", "ok", "critical"):
+            machine.push(x, 3)
+        self.assertEqual((machine.attempt, machine.hard_state), (1, "ok"))
+
+
+class UpdateStatesTests(TestCase):
+
+    def test_transitions_of_written_rows_only(self):
+        chost = ContentType.objects.get_for_model(Host).id
+        # Stored concurrently by another process with a newer result
+        CurrentState.objects.create(content_type_id=chost, object_id=1, state="ok", last_check=20)
+        transitions = state.update_states([(chost, 1, None, "critical", "", 10), (chost, 2, None, "ok", "", 10)])
+        self.assertEqual([(x.object_id, x.state) for x in transitions], [(2, "ok")])
+        self.assertEqual(dict(CurrentState.objects.values_list("object_id", "state")), {1: "ok", 2: "ok"})
+
+
+class SearchTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.proxy = Proxy.objects.create(name="proxy")
+        cls.host = Host.objects.create(name="web-abcx", comment="cxyz", linked_proxy=cls.proxy)
+        cls.other = Host.objects.create(name="db", comment="Runs WEB-ABCX backups", linked_proxy=cls.proxy)
+
+    def test_trigrams_of_different_attributes_do_not_match(self):
+        self.assertEqual(list(search(Host, "bcxy")), [])
+
+    def test_substring_ranked_by_attribute(self):
+        self.assertEqual(list(search(Host, "Web-Abc")), [self.host.id, self.other.id])
+
+    def test_candidates_verified_up_to_page(self):
+        with mock.patch("api.search.VERIFY_BATCH_SIZE", 1):
+            found = search(Host, "Web-Abc")
+            self.assertEqual(found[0:1], [self.host.id])
+            self.assertEqual((found.verified, found.count()), (1, 2))
+
+    def test_count_exact_once_verified(self):
+        found = search(Host, "bcxy")
+        self.assertEqual(found.count(), 1)
+        self.assertEqual(found[0:50], [])
+        self.assertEqual(found.count(), 0)
+
+
+class ReferenceTests(TestCase):
+
+    def test_get_current_sees_records_of_other_processes(self):
+        reference.checks.get(0)
+        # Created by another process, without the signals bumping the version in this one
+        check = Check.objects.bulk_create([Check(name="check")])[0]
+        CacheVersion.objects.get_or_create(name="checks")
+        CacheVersion.objects.filter(name="checks").update(version=F("version") + 1)
+        self.assertIsNone(reference.checks.get(check.id))
+        self.assertIsNotNone(reference.checks.get_current(check.id))
+
+
+class RecipientCacheTests(TestCase):
+
+    @staticmethod
+    def version():
+        return CacheVersion.objects.filter(name=notifications.recipients.name).values_list("version", flat=True).first()
+
+    def test_invalidated_by_recipient_changes_only(self):
+        proxy = Proxy.objects.create(name="proxy")
+        version = self.version()
+        host = Host.objects.create(name="host", linked_proxy=proxy)
+        host.address = "127.0.0.1"
+        host.save()
+        contact = Contact.objects.create(name="contact")
+        self.assertEqual(self.version(), version)
+        host.linked_contacts.add(contact)
+        version = self.version()
+        self.assertIsNotNone(version)
+        contact.mail = "contact@example.org"
+        contact.save(update_fields=["mail"])
+        self.assertEqual(self.version(), version + 1)
+
+
+class NotificationRateTests(TestCase):
+
+    def test_limit_is_shared_by_dispatchers(self):
+        first = NotificationDispatcher([], batch_interval=60, rate_limit=3)
+        second = NotificationDispatcher([], batch_interval=60, rate_limit=3)
+        self.assertEqual(first._limit(1, ["a", "b"], 1000), (["a", "b"], 0))
+        self.assertEqual(second._limit(1, ["c", "d"], 1001), (["c"], 0))
+        self.assertEqual(second._limit(1, ["e"], 1002), ([], 0))
+        # A new period reports the suppressed notifications with the next delivery
+        self.assertEqual(first._limit(1, ["f"], 1000 + first.rate_period), (["f"], 2))
+        first.close()
+        second.close()
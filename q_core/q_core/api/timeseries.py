@@ -0,0 +1,101 @@
+"""Cached reads of aggregated time series.
+
+A query is aligned to multiples of its step and split into blocks of BLOCK_STEPS windows. Blocks which can not change
+anymore are kept in a process local LRU cache, so refreshing a dashboard only reads the latest block from InfluxDB.
+Missing blocks next to each other are read with one query.
+"""
+import collections
+import threading
+import time
+
+from q_core import settings
+from utils.influx_db import query_series
+from utils.retention import select_tier
+
+BLOCK_STEPS = 60
+DEFAULT_CACHE_SIZE = 4096
+# Seconds after the end of a block, until late results and the downsampling tasks are expected to be written
+SETTLE_TIME = 120
+
+
+class SeriesCache:
+    """LRU cache of blocks, a block is a mapping of field -> list of [timestamp, value]"""
+
+    def __init__(self, maxsize=DEFAULT_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.blocks = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _get(self, key):
+        with self.lock:
+            block = self.blocks.get(key)
+            if block is not None:
+                self.blocks.move_to_end(key)
+            return block
+
+    def _put(self, key, block):
+        with self.lock:
+            self.blocks[key] = block
+            self.blocks.move_to_end(key)
+            while len(self.blocks) > self.maxsize:
+                self.blocks.popitem(last=False)
+
+    def query(self, measurement, start, stop, step, aggregate="mean", fields=None, percentile=None, now=None):
+        """Returns the aggregated series of a measurement.
+
+        :return: Tuple of the RetentionTier read from, the step used and a mapping of field -> list of
+        [timestamp, value]. The step is raised to the resolution of the tier.
+        """
+        now = now if now is not None else time.time()
+        tier = select_tier(start, step, now=now)
+        step = max(int(step), tier.resolution, 1)
+        start = int(start) // step * step
+        stop = -(-int(stop) // step) * step
+        block_size = step * BLOCK_STEPS
+        settled = now - step - tier.resolution - SETTLE_TIME
+        fields = tuple(sorted(fields)) if fields else None
+        key = (tier.name, measurement, fields, aggregate, percentile, step)
+
+        blocks = {}
+        missing = []
+        for block_start in range(start // block_size * block_size, stop, block_size):
+            block = self._get((*key, block_start)) if block_start + block_size <= settled else None
+            if block is None:
+                self.misses += 1
+                if missing and missing[-1][1] == block_start:
+                    missing[-1][1] = block_start + block_size
+                else:
+                    missing.append([block_start, block_start + block_size])
+            else:
+                self.hits += 1
+                blocks[block_start] = block
+
+        for run_start, run_stop in missing:
+            read = {x: {} for x in range(run_start, run_stop, block_size)}
+            for field, points in query_series(
+                    measurement, run_start, run_stop, step, aggregate, fields, percentile, tier
+            ).items():
+                for point in points:
+                    # The timestamp of a point is the end of its window
+                    window_start = point[0] - step
+                    block = read.get(window_start - (window_start - run_start) % block_size)
+                    if block is not None:
+                        block.setdefault(field, []).append(point)
+            for block_start, block in read.items():
+                if block_start + block_size <= settled:
+                    self._put((*key, block_start), block)
+            blocks.update(read)
+
+        series = {}
+        for block_start in sorted(blocks):
+            for field, points in blocks[block_start].items():
+                series.setdefault(field, []).extend(x for x in points if start < x[0] <= stop)
+        return tier, step, series
+
+    def metrics(self) -> dict:
+        return {"blocks": len(self.blocks), "hits": self.hits, "misses": self.misses}
+
+
+cache = SeriesCache(getattr(settings, "SERIES_CACHE_SIZE", DEFAULT_CACHE_SIZE))
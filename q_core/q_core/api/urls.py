@@ -30,6 +30,10 @@ urlpatterns = [
     path("contactgroups/<str:sid>", ContactGroupView.as_view()),
     path("proxies", ProxyView.as_view()),
     path("proxies/<str:sid>", ProxyView.as_view()),
+    path("effectiveconfigs/<str:context>/<str:sid>", EffectiveConfigView.as_view()),
+    path("states/summary", StateSummaryView.as_view()),
+    path("states/problems", ProblemView.as_view()),
+    path("scheduledobjects/<str:sid>/series", SeriesView.as_view()),
 
     # Routine API
     path("updateDeclaration", UpdateDeclarationView.as_view()),
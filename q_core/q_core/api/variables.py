@@ -0,0 +1,66 @@
+from django.contrib.contenttypes.models import ContentType
+
+from api import reference
+from api.models import Label, GenericKVP
+
+
+def resolve_labels(names) -> dict:
+    """Returns a mapping of label -> label id for every name, creating the missing labels.
+
+    Labels are taken from the label cache first. The remaining ones are fetched with one query, missing ones are
+    inserted with one bulk insert.
+    """
+    names = set(names)
+    labels = reference.labels.lookup(names)
+    uncached = names - labels.keys()
+    if not uncached:
+        return labels
+    labels.update(Label.objects.filter(label__in=uncached).values_list("label", "id"))
+    missing = names - labels.keys()
+    if missing:
+        Label.objects.bulk_create([Label(label=x) for x in missing], ignore_conflicts=True)
+        labels.update(Label.objects.filter(label__in=missing).values_list("label", "id"))
+        # Case insensitive collations may return a stored label differing in case from the requested one
+        unmatched = names - labels.keys()
+        if unmatched:
+            folded = {x.lower(): y for x, y in labels.items()}
+            labels.update({x: folded[x.lower()] for x in unmatched})
+    reference.labels.add({x: labels[x] for x in uncached})
+    return labels
+
+
+def set_variables(obj, variables: dict, overwrite=False):
+    """Writes the variables of obj in a constant number of queries.
+
+    Every key holds a single value, so the value of an existing key is replaced.
+
+    :param obj: Model instance with a GenericRelation to GenericKVP
+    :param variables: Dict of key -> value
+    :param overwrite: If True, variables of obj which are not in variables are removed
+    """
+    content_type = ContentType.objects.get_for_model(obj)
+    variables = {str(x): str(y) for x, y in variables.items()}
+    labels = resolve_labels([*variables.keys(), *variables.values()])
+    wanted = {labels[x]: labels[y] for x, y in variables.items()}
+
+    existing = {
+        x.key_id: x for x in GenericKVP.objects.filter(content_type=content_type, object_id=obj.id).only(
+            "id", "key_id", "value_id"
+        )
+    }
+    stale = [x.id for x in existing.values() if overwrite and x.key_id not in wanted]
+    if stale:
+        GenericKVP.objects.filter(id__in=stale).delete()
+
+    changed = []
+    for kvp in existing.values():
+        if kvp.key_id in wanted and kvp.value_id != wanted[kvp.key_id]:
+            kvp.value_id = wanted[kvp.key_id]
+            changed.append(kvp)
+    if changed:
+        GenericKVP.objects.bulk_update(changed, ["value"])
+
+    GenericKVP.objects.bulk_create([
+        GenericKVP(key_id=key_id, value_id=value_id, content_type=content_type, object_id=obj.id)
+        for key_id, value_id in wanted.items() if key_id not in existing
+    ])
@@ -1,6 +1,8 @@
+import logging
 import secrets
 import string
 import json
+import time
 from collections import ChainMap
 
 from django.contrib.auth import authenticate, login, logout
@@ -11,10 +13,19 @@ from django.db.models import Max
 from django.http import JsonResponse, HttpResponse, QueryDict
 from django.views import View
 
-from api.models import AccountModel, ACLModel, Check, Host, Observable, TimePeriod, SchedulingInterval, GenericKVP, \
-    Label, Day, Period, DayTimePeriod, GlobalVariable, Contact, ContactGroup, ObservableTemplate, HostTemplate, Proxy, \
-    OrderedListItem
+from api.models import AccountModel, ACLModel, Check, Host, Observable, TimePeriod, Day, \
+    Period, DayTimePeriod, GlobalVariable, Contact, ContactGroup, ObservableTemplate, HostTemplate, Proxy, OrderedListItem, \
+    EffectiveConfig, ScheduledObject
+from api import reference, state, timeseries
 from api.description import export
+from api.search import search
+from api.variables import set_variables
+
+logger = logging.getLogger("api")
+
+# Maximum number of windows a series query may return per field
+SERIES_MAX_POINTS = 2000
+SERIES_AGGREGATES = {"avg": "mean", "mean": "mean", "min": "min", "max": "max", "percentile": "percentile"}
 
 
 def get_variable_list(parameter):
@@ -27,6 +38,13 @@ def get_variable_list(parameter):
             return parameter
 
 
+def check_param_max_attempts(max_attempts) -> bool:
+    """max_attempts has to be a positive integer, or empty for the default of the state machine"""
+    if not max_attempts:
+        return True
+    return not isinstance(max_attempts, bool) and isinstance(max_attempts, int) and max_attempts > 0
+
+
 class CheckMixinView(View):
     """Base View for REST API requests.
 
@@ -154,6 +172,7 @@ class CheckOptionalMixinView(CheckMixinView):
                 return JsonResponse({"success": False, "message": "Parameter p is required but missing"}, status=400)
             current_page = params["p"]
             values = None
+            ranked = None
             if "values" in params:
                 values = get_variable_list(params.getlist("values"))
                 if any([x not in self.api_class.allowed_values for x in values]):
@@ -177,13 +196,12 @@ class CheckOptionalMixinView(CheckMixinView):
                         items = self.api_class.objects.get(id=str(params["filter"]))
             else:
                 if "query" in params and params["query"]:
-                    if "name" not in self.api_class.allowed_values.keys():
+                    if not hasattr(self.api_class, "search_fields"):
                         return JsonResponse({"success": False, "message": "Object does not support query"}, status=400)
                     query = str(params.get("query"))
-                    if "values" in params:
-                        items = self.api_class.objects.filter(name__icontains=query).only(*values.values())
-                    else:
-                        items = self.api_class.objects.filter(name__icontains=query)
+                    # Matches are verified up to the requested page, objects are loaded per page
+                    ranked = search(self.api_class, query)
+                    items = ranked
                 else:
                     if "values" in params:
                         items = self.api_class.objects.all().only(*values.values())
@@ -194,6 +212,16 @@ class CheckOptionalMixinView(CheckMixinView):
 
             page = paginator.get_page(current_page)
             page_items = page.object_list
+            if ranked is not None:
+                if "values" in params:
+                    found = self.api_class.objects.filter(id__in=page_items).only(*values.values()).in_bulk()
+                else:
+                    found = self.api_class.objects.filter(id__in=page_items).in_bulk()
+                page_items = [found[x] for x in page_items if x in found]
+                # Includes the candidates after the page, which were not verified
+                object_count = ranked.count()
+            else:
+                object_count = paginator.count
 
             if "values" in params:
                 data = [x.to_dict(values=values.keys()) for x in page_items]
@@ -208,8 +236,8 @@ class CheckOptionalMixinView(CheckMixinView):
             "message": "Request was successful",
             "data": data,
             "pagination": {
-                "page_count": paginator.num_pages,
-                "object_count": paginator.count,
+                "page_count": max(-(-object_count // paginator.per_page), 1),
+                "object_count": object_count,
                 "objects_per_page": paginator.per_page,
                 "current_page": page.number
             }
@@ -360,14 +388,13 @@ class ObservableView(CheckOptionalMixinView):
             observable.comment = params["comment"]
         if "linked_check" in params:
             if params["linked_check"]:
-                try:
-                    linked_check = Check.objects.get(id=params["linked_check"])
-                    observable.linked_check = linked_check
-                except Check.DoesNotExist:
+                linked_check = reference.checks.get_current(params["linked_check"])
+                if linked_check is None:
                     return JsonResponse(
                         {"success": False, "message": f"Check with id {params['linked_check']} does not exist"},
                         status=404
                     )
+                observable.linked_check_id = linked_check.id
             else:
                 observable.linked_check = None
         if "observable_templates" in params:
@@ -464,22 +491,34 @@ class ObservableView(CheckOptionalMixinView):
                 observable.linked_contact_groups.clear()
         if "scheduling_interval" in params:
             if params["scheduling_interval"]:
-                scheduling_interval, _ = SchedulingInterval.objects.get_or_create(
-                    interval=params["scheduling_interval"])
-                observable.scheduling_interval = scheduling_interval
+                observable.scheduling_interval_id = reference.scheduling_intervals.get_or_create(
+                    params["scheduling_interval"]
+                ).id
             else:
                 observable.scheduling_interval = None
+        if "retry_interval" in params:
+            if params["retry_interval"]:
+                observable.retry_interval_id = reference.scheduling_intervals.get_or_create(
+                    params["retry_interval"]
+                ).id
+            else:
+                observable.retry_interval = None
+        if "max_attempts" in params:
+            if not check_param_max_attempts(params["max_attempts"]):
+                return JsonResponse(
+                    {"success": False, "message": "Parameter max_attempts has to be a positive integer"}, status=400
+                )
+            observable.max_attempts = params["max_attempts"] or None
         if "scheduling_period" in params:
             if params["scheduling_period"]:
-                try:
-                    scheduling_period = TimePeriod.objects.get(id=params["scheduling_period"])
-                    observable.scheduling_period = scheduling_period
-                except TimePeriod.DoesNotExist:
+                scheduling_period = reference.time_periods.get_current(params["scheduling_period"])
+                if scheduling_period is None:
                     return JsonResponse(
                         {"success": False,
                          "message": f"TimePeriod with id {params['scheduling_period']} does not exist"},
                         status=404
                     )
+                observable.scheduling_period_id = scheduling_period.id
             else:
                 observable.scheduling_period = None
         if "disabled" in params:
@@ -487,30 +526,21 @@ class ObservableView(CheckOptionalMixinView):
             observable.disabled = disabled
         if "notification_period" in params:
             if params["notification_period"]:
-                try:
-                    notification_period = TimePeriod.objects.get(id=params["notification_period"])
-                    observable.notification_period = notification_period
-                except TimePeriod.DoesNotExist:
+                notification_period = reference.time_periods.get_current(params["notification_period"])
+                if notification_period is None:
                     return JsonResponse(
                         {"success": False,
                          "message": f"TimePeriod with id {params['notification_period']} does not exist"},
                         status=404
                     )
+                observable.notification_period_id = notification_period.id
             else:
                 observable.notification_period = None
         if "variables" in params:
-            if not isinstance(params["variables"], dict) and not isinstance(params["variables"], str):
+            if not isinstance(params["variables"], dict) and params["variables"] != "":
                 return JsonResponse({"success": False, "message": "Parameter variables has to be a dict"}, status=400)
             if params["variables"]:
-                if overwrite:
-                    observable.variable.clear()
-                for key, value in params["variables"].items():
-                    key_label, _ = Label.objects.get_or_create(label=key)
-                    value_label, _ = Label.objects.get_or_create(label=value)
-                    GenericKVP.objects.get_or_create(
-                        key=key_label, value=value_label, object_id=observable.id,
-                        content_type=ContentType.objects.get_for_model(Observable)
-                    )
+                set_variables(observable, params["variables"], overwrite=overwrite)
             else:
                 observable.variables.clear()
 
@@ -573,6 +603,12 @@ class ObservableView(CheckOptionalMixinView):
                 )
         if "name" in params:
             metric.name = params["name"]
+        if Observable.objects.filter(name=metric.name, linked_host_id=metric.linked_host_id).exclude(
+                id=metric.id
+        ).exists():
+            return JsonResponse(
+                {"success": False, "message": "Metric with this name already exists"}, status=409
+            )
 
         ret = self.optional(metric, params, overwrite=True)
         if isinstance(ret, JsonResponse):
@@ -594,14 +630,13 @@ class ObservableTemplateView(CheckOptionalMixinView):
             observable_template.comment = params["comment"]
         if "linked_check" in params:
             if params["linked_check"]:
-                try:
-                    linked_check = Check.objects.get(id=params["linked_check"])
-                    observable_template.linked_check = linked_check
-                except Check.DoesNotExist:
+                linked_check = reference.checks.get_current(params["linked_check"])
+                if linked_check is None:
                     return JsonResponse(
                         {"success": False, "message": f"Check with id {params['linked_check']} does not exist"},
                         status=404
                     )
+                observable_template.linked_check_id = linked_check.id
             else:
                 observable_template.linked_check = None
         if "observable_templates" in params:
@@ -691,52 +726,55 @@ class ObservableTemplateView(CheckOptionalMixinView):
                 observable_template.linked_contact_groups.clear()
         if "scheduling_interval" in params:
             if params["scheduling_interval"]:
-                scheduling_interval, _ = SchedulingInterval.objects.get_or_create(
-                    interval=params["scheduling_interval"])
-                observable_template.scheduling_interval = scheduling_interval
+                observable_template.scheduling_interval_id = reference.scheduling_intervals.get_or_create(
+                    params["scheduling_interval"]
+                ).id
             else:
                 observable_template.scheduling_interval = None
+        if "retry_interval" in params:
+            if params["retry_interval"]:
+                observable_template.retry_interval_id = reference.scheduling_intervals.get_or_create(
+                    params["retry_interval"]
+                ).id
+            else:
+                observable_template.retry_interval = None
+        if "max_attempts" in params:
+            if not check_param_max_attempts(params["max_attempts"]):
+                return JsonResponse(
+                    {"success": False, "message": "Parameter max_attempts has to be a positive integer"}, status=400
+                )
+            observable_template.max_attempts = params["max_attempts"] or None
         if "scheduling_period" in params:
             if params["scheduling_period"]:
-                try:
-                    scheduling_period = TimePeriod.objects.get(id=params["scheduling_period"])
-                    observable_template.scheduling_period = scheduling_period
-                except TimePeriod.DoesNotExist:
+                scheduling_period = reference.time_periods.get_current(params["scheduling_period"])
+                if scheduling_period is None:
                     return JsonResponse(
                         {"success": False,
                          "message": f"TimePeriod with id {params['scheduling_period']} does not exist"},
                         status=404
                     )
+                observable_template.scheduling_period_id = scheduling_period.id
             else:
                 observable_template.scheduling_period = None
         if "notification_period" in params:
             if params["notification_period"]:
-                try:
-                    notification_period = TimePeriod.objects.get(id=params["notification_period"])
-                    observable_template.notification_period = notification_period
-                except TimePeriod.DoesNotExist:
+                notification_period = reference.time_periods.get_current(params["notification_period"])
+                if notification_period is None:
                     return JsonResponse(
                         {"success": False,
                          "message": f"TimePeriod with id {params['notification_period']} does not exist"},
                         status=404
                     )
+                observable_template.notification_period_id = notification_period.id
             else:
                 observable_template.notification_period = None
         if "variables" in params:
-            if not isinstance(params["variables"], dict) and not isinstance(params["variables"], str):
+            if not isinstance(params["variables"], dict) and params["variables"] != "":
                 return JsonResponse({"success": False, "message": "Parameter variables has to be a dict"}, status=400)
             if not params["variables"]:
                 observable_template.variables.clear()
             else:
-                if overwrite:
-                    observable_template.variables.clear()
-                for key, value in params["variables"].items():
-                    key_label, _ = Label.objects.get_or_create(label=key)
-                    value_label, _ = Label.objects.get_or_create(label=value)
-                    GenericKVP.objects.get_or_create(
-                        key=key_label, value=value_label, object_id=observable_template.id,
-                        content_type=ContentType.objects.get_for_model(ObservableTemplate)
-                    )
+                set_variables(observable_template, params["variables"], overwrite=overwrite)
 
     def save_post(self, params, *args, **kwargs):
         # Create check
@@ -790,14 +828,13 @@ class HostView(CheckOptionalMixinView):
             host.address = params["address"]
         if "linked_check" in params:
             if params["linked_check"]:
-                try:
-                    check = Check.objects.get(id=params["linked_check"])
-                    host.linked_check = check
-                except Check.DoesNotExist:
+                check = reference.checks.get_current(params["linked_check"])
+                if check is None:
                     return JsonResponse(
                         {"success": False, "message": f"Check with id {params['linked_check']} does not exist"},
                         status=404
                     )
+                host.linked_check_id = check.id
             else:
                 host.linked_check = None
         if "disabled" in params:
@@ -903,50 +940,53 @@ class HostView(CheckOptionalMixinView):
                 host.linked_contact_groups.clear()
         if "scheduling_interval" in params:
             if params["scheduling_interval"]:
-                scheduling_interval, _ = SchedulingInterval.objects.get_or_create(
-                    interval=params["scheduling_interval"])
-                host.scheduling_interval = scheduling_interval
+                host.scheduling_interval_id = reference.scheduling_intervals.get_or_create(
+                    params["scheduling_interval"]
+                ).id
             else:
                 host.scheduling_interval = None
+        if "retry_interval" in params:
+            if params["retry_interval"]:
+                host.retry_interval_id = reference.scheduling_intervals.get_or_create(
+                    params["retry_interval"]
+                ).id
+            else:
+                host.retry_interval = None
+        if "max_attempts" in params:
+            if not check_param_max_attempts(params["max_attempts"]):
+                return JsonResponse(
+                    {"success": False, "message": "Parameter max_attempts has to be a positive integer"}, status=400
+                )
+            host.max_attempts = params["max_attempts"] or None
         if "scheduling_period" in params:
             if params["scheduling_period"]:
-                try:
-                    scheduling_period = TimePeriod.objects.get(id=params["scheduling_period"])
-                    host.scheduling_period = scheduling_period
-                except TimePeriod.DoesNotExist:
+                scheduling_period = reference.time_periods.get_current(params["scheduling_period"])
+                if scheduling_period is None:
                     return JsonResponse(
                         {"success": False,
                          "message": f"TimePeriod with id {params['scheduling_period']} does not exist"},
                         status=404
                     )
+                host.scheduling_period_id = scheduling_period.id
             else:
                 host.scheduling_period = None
         if "notification_period" in params:
             if params["notification_period"]:
-                try:
-                    notification_period = TimePeriod.objects.get(id=params["notification_period"])
-                    host.notification_period = notification_period
-                except TimePeriod.DoesNotExist:
+                notification_period = reference.time_periods.get_current(params["notification_period"])
+                if notification_period is None:
                     return JsonResponse(
                         {"success": False,
                          "message": f"TimePeriod with id {params['notification_period']} does not exist"},
                         status=404
                     )
+                host.notification_period_id = notification_period.id
             else:
                 host.notification_period = None
         if "variables" in params:
-            if overwrite:
-                host.variables.clear()
-            if not isinstance(params["variables"], dict) and not isinstance(params["variables"], str):
+            if not isinstance(params["variables"], dict) and params["variables"] != "":
                 return JsonResponse({"success": False, "message": "Parameter variables has to be a dict"}, status=400)
             if params["variables"]:
-                for key, value in params["variables"].items():
-                    key_label, _ = Label.objects.get_or_create(label=key)
-                    value_label, _ = Label.objects.get_or_create(label=value)
-                    GenericKVP.objects.get_or_create(
-                        key=key_label, value=value_label, object_id=host.id,
-                        content_type=ContentType.objects.get_for_model(Host)
-                    )
+                set_variables(host, params["variables"], overwrite=overwrite)
             else:
                 host.variables.clear()
 
@@ -1020,14 +1060,13 @@ class HostTemplateView(CheckOptionalMixinView):
             host_template.address = params["address"]
         if "linked_check" in params:
             if params["linked_check"]:
-                try:
-                    check = Check.objects.get(id=params["linked_check"])
-                    host_template.linked_check = check
-                except Check.DoesNotExist:
+                check = reference.checks.get_current(params["linked_check"])
+                if check is None:
                     return JsonResponse(
                         {"success": False, "message": f"Check with id {params['linked_check']} does not exist"},
                         status=404
                     )
+                host_template.linked_check_id = check.id
             else:
                 host_template.linked_check = None
         if "host_templates" in params:
@@ -1131,50 +1170,53 @@ class HostTemplateView(CheckOptionalMixinView):
                 host_template.linked_contact_groups.clear()
         if "scheduling_interval" in params:
             if params["scheduling_interval"]:
-                scheduling_interval, _ = SchedulingInterval.objects.get_or_create(
-                    interval=params["scheduling_interval"])
-                host_template.scheduling_interval = scheduling_interval
+                host_template.scheduling_interval_id = reference.scheduling_intervals.get_or_create(
+                    params["scheduling_interval"]
+                ).id
             else:
                 host_template.scheduling_interval = None
+        if "retry_interval" in params:
+            if params["retry_interval"]:
+                host_template.retry_interval_id = reference.scheduling_intervals.get_or_create(
+                    params["retry_interval"]
+                ).id
+            else:
+                host_template.retry_interval = None
+        if "max_attempts" in params:
+            if not check_param_max_attempts(params["max_attempts"]):
+                return JsonResponse(
+                    {"success": False, "message": "Parameter max_attempts has to be a positive integer"}, status=400
+                )
+            host_template.max_attempts = params["max_attempts"] or None
         if "scheduling_period" in params:
             if params["scheduling_period"]:
-                try:
-                    scheduling_period = TimePeriod.objects.get(id=params["scheduling_period"])
-                    host_template.scheduling_period = scheduling_period
-                except TimePeriod.DoesNotExist:
+                scheduling_period = reference.time_periods.get_current(params["scheduling_period"])
+                if scheduling_period is None:
                     return JsonResponse(
                         {"success": False,
                          "message": f"TimePeriod with id {params['scheduling_period']} does not exist"},
                         status=404
                     )
+                host_template.scheduling_period_id = scheduling_period.id
             else:
                 host_template.scheduling_period = None
         if "notification_period" in params:
             if params["notification_period"]:
-                try:
-                    notification_period = TimePeriod.objects.get(id=params["notification_period"])
-                    host_template.notification_period = notification_period
-                except TimePeriod.DoesNotExist:
+                notification_period = reference.time_periods.get_current(params["notification_period"])
+                if notification_period is None:
                     return JsonResponse(
                         {"success": False,
                          "message": f"TimePeriod with id {params['notification_period']} does not exist"},
                         status=404
                     )
+                host_template.notification_period_id = notification_period.id
             else:
                 host_template.notification_period = None
         if "variables" in params:
-            if overwrite:
-                host_template.variables.clear()
-            if not isinstance(params["variables"], dict) and not isinstance(params["variables"], str):
+            if not isinstance(params["variables"], dict) and params["variables"] != "":
                 return JsonResponse({"success": False, "message": "Parameter variables has to be a dict"}, status=400)
             if params["variables"]:
-                for key, value in params["variables"].items():
-                    key_label, _ = Label.objects.get_or_create(label=key)
-                    value_label, _ = Label.objects.get_or_create(label=value)
-                    GenericKVP.objects.get_or_create(
-                        key=key_label, value=value_label, object_id=host_template.id,
-                        content_type=ContentType.objects.get_for_model(HostTemplate)
-                    )
+                set_variables(host_template, params["variables"], overwrite=overwrite)
             else:
                 host_template.variables.clear()
 
@@ -1340,12 +1382,7 @@ class GlobalVariableView(CheckOptionalMixinView):
                 status=409
             )
         variable = GlobalVariable.objects.create()
-        key_label, _ = Label.objects.get_or_create(label=params["key"])
-        value_label, _ = Label.objects.get_or_create(label=params["value"])
-        kvp, _ = GenericKVP.objects.get_or_create(
-            key=key_label, value=value_label, object_id=variable.id,
-            content_type=ContentType.objects.get_for_model(GlobalVariable)
-        )
+        set_variables(variable, {params["key"]: params["value"]})
         self.optional(params, variable)
         variable.save()
         return JsonResponse(
@@ -1360,22 +1397,21 @@ class GlobalVariableView(CheckOptionalMixinView):
                 {"success": False, "message": f"GlobalVariable with id {kwargs['sid']} does not exist"},
                 status=404
             )
-        kvp = variable.variable.first()
+        kvp = variable.variable.select_related("key", "value").first()
+        key, value = kvp.key.label, kvp.value.label
         if "key" in params:
             if not GlobalVariable.objects.filter(variable__key__label=params["key"]).exists() \
-                    or params["key"] == variable.variable.first().key.label:
-                key_label, _ = Label.objects.get_or_create(label=params["key"])
-                kvp.key = key_label
+                    or params["key"] == key:
+                key = params["key"]
             else:
                 return JsonResponse(
                     {"success": False, "message": f"GlobalVariable with name {params['key']} already exists"},
                     status=409
                 )
         if "value" in params:
-            value_label, _ = Label.objects.get_or_create(label=params["value"])
-            kvp.value = value_label
+            value = params["value"]
         self.optional(params, variable)
-        kvp.save()
+        set_variables(variable, {key: value}, overwrite=True)
         variable.save()
         return JsonResponse(
             {"success": True, "message": f"GlobalVariable with id {kwargs['sid']} was changed successful"}
@@ -1425,29 +1461,20 @@ class ContactView(CheckOptionalMixinView):
         for period in ["linked_host_notification_period", "linked_observable_notification_period"]:
             if period in params:
                 if params[period]:
-                    try:
-                        tp = TimePeriod.objects.get(id=params[period])
-                        contact.__setattr__(period, tp)
-                    except TimePeriod.DoesNotExist:
+                    tp = reference.time_periods.get_current(params[period])
+                    if tp is None:
                         return JsonResponse(
                             {"success": False, "message": f"TimePeriod with id {params[period]} does not exist"},
                             status=404
                         )
+                    contact.__setattr__(f"{period}_id", tp.id)
                 else:
                     contact.__setattr__(period, None)
         if "variables" in params:
-            if not isinstance(params["variables"], dict) and not isinstance(params["variables"], str):
+            if not isinstance(params["variables"], dict) and params["variables"] != "":
                 return JsonResponse({"success": False, "message": f"Parameter variables has to be a dict"}, status=400)
             if params["variables"]:
-                if overwrite:
-                    contact.variables.clear()
-                for key, value in params["variables"].items():
-                    key_label, _ = Label.objects.get_or_create(label=key)
-                    value_label, _ = Label.objects.get_or_create(label=value)
-                    GenericKVP.objects.get_or_create(
-                        key=key_label, value=value_label, object_id=contact.id,
-                        content_type=ContentType.objects.get_for_model(Contact)
-                    )
+                set_variables(contact, params["variables"], overwrite=overwrite)
             else:
                 contact.variables.clear()
 
@@ -1623,6 +1650,140 @@ class ProxyView(CheckOptionalMixinView):
         return JsonResponse({"success": True, "message": "Changes were successful"})
 
 
+class EffectiveConfigView(CheckMixinView):
+    contexts = {
+        "hosts": Host,
+        "observables": Observable
+    }
+
+    def __init__(self):
+        super(EffectiveConfigView, self).__init__()
+
+    def cleaned_get(self, params, *args, **kwargs):
+        if kwargs["context"] not in self.contexts:
+            return JsonResponse(
+                {"success": False, "message": f"Context has to be one of {', '.join(self.contexts)}"}, status=400
+            )
+        try:
+            config = EffectiveConfig.objects.get(
+                content_type=ContentType.objects.get_for_model(self.contexts[kwargs["context"]]),
+                object_id=kwargs["sid"]
+            )
+        except (EffectiveConfig.DoesNotExist, ValueError):
+            return JsonResponse(
+                {"success": False, "message": f"No configuration for {kwargs['context']} with id {kwargs['sid']}"},
+                status=404
+            )
+        return JsonResponse({"success": True, "data": config.to_dict()})
+
+
+class StateMixinView(CheckMixinView):
+    """Base view for queries of the current states, parses the common filters"""
+
+    def __init__(self):
+        super(StateMixinView, self).__init__()
+
+    @staticmethod
+    def get_filters(params):
+        filters = {}
+        for x in ["proxy", "host"]:
+            if x in params:
+                try:
+                    filters[x] = int(params[x])
+                except ValueError:
+                    return JsonResponse({"success": False, "message": f"Parameter {x} must be of type int"}, status=400)
+        if "label" in params:
+            filters["label"] = params["label"]
+        return filters
+
+
+class StateSummaryView(StateMixinView):
+    def cleaned_get(self, params, *args, **kwargs):
+        filters = self.get_filters(params)
+        if isinstance(filters, JsonResponse):
+            return filters
+        return JsonResponse({"success": True, "data": state.store.summary(**filters)})
+
+
+class ProblemView(StateMixinView):
+    def cleaned_get(self, params, *args, **kwargs):
+        filters = self.get_filters(params)
+        if isinstance(filters, JsonResponse):
+            return filters
+        if "state" in params:
+            filters["states"] = get_variable_list(params.getlist("state"))
+        if "limit" in params:
+            try:
+                filters["limit"] = int(params["limit"])
+            except ValueError:
+                return JsonResponse({"success": False, "message": "Parameter limit must be of type int"}, status=400)
+        return JsonResponse({"success": True, "data": [x.to_dict() for x in state.store.problems(**filters)]})
+
+
+class SeriesView(CheckMixinView):
+    """Aggregated time series of a ScheduledObject.
+
+    Parameters are start and stop as unix timestamps, step in seconds, aggregate as one of avg, min, max and
+    percentile, percentile from 0 to 100 and fields. Stop defaults to now, start to one hour before stop and step to
+    the smallest multiple of 60 seconds returning at most SERIES_MAX_POINTS windows.
+    """
+
+    def __init__(self):
+        super(SeriesView, self).__init__()
+
+    def cleaned_get(self, params, *args, **kwargs):
+        try:
+            scheduled_object = ScheduledObject.objects.get(id=int(kwargs["sid"]))
+        except (ValueError, ScheduledObject.DoesNotExist):
+            return JsonResponse(
+                {"success": False, "message": f"ScheduledObject with id {kwargs['sid']} does not exist"}, status=404
+            )
+        values = {}
+        for x in ["start", "stop", "step", "percentile"]:
+            if x in params:
+                try:
+                    values[x] = float(params[x])
+                except ValueError:
+                    return JsonResponse({"success": False, "message": f"Parameter {x} must be a number"}, status=400)
+        stop = values.get("stop", time.time())
+        start = values.get("start", stop - 3600)
+        if start >= stop:
+            return JsonResponse({"success": False, "message": "Parameter start must be before stop"}, status=400)
+        step = values.get("step", -(-(stop - start) // (SERIES_MAX_POINTS * 60)) * 60)
+        if step <= 0 or (stop - start) / step > SERIES_MAX_POINTS:
+            return JsonResponse({
+                "success": False, "message": f"Parameter step must result in at most {SERIES_MAX_POINTS} windows"
+            }, status=400)
+        aggregate = SERIES_AGGREGATES.get(params.get("aggregate", "avg"))
+        if aggregate is None:
+            return JsonResponse({
+                "success": False, "message": f"Parameter aggregate must be one of {', '.join(SERIES_AGGREGATES)}"
+            }, status=400)
+        percentile = values.get("percentile")
+        if aggregate == "percentile" and (percentile is None or not 0 <= percentile <= 100):
+            return JsonResponse(
+                {"success": False, "message": "Parameter percentile must be between 0 and 100"}, status=400
+            )
+        fields = get_variable_list(params.getlist("fields")) if "fields" in params else None
+        try:
+            tier, step, series = timeseries.cache.query(
+                scheduled_object.measurement, start, stop, step, aggregate, fields,
+                percentile if aggregate == "percentile" else None
+            )
+        except Exception as err:
+            logger.error(f"Could not query series of {scheduled_object.measurement}: {err}")
+            return JsonResponse({"success": False, "message": "Time series database is not available"}, status=502)
+        return JsonResponse({
+            "success": True,
+            "data": {
+                "measurement": scheduled_object.measurement,
+                "tier": tier.name,
+                "step": step,
+                "series": series
+            }
+        })
+
+
 class UpdateDeclarationView(CheckMixinView):
     def __init__(self):
         super(UpdateDeclarationView, self).__init__()
@@ -0,0 +1,78 @@
+import time
+
+from django.contrib.contenttypes.models import ContentType
+
+from api import reference, state
+from api.models import Host, Observable
+from utils.influx_db import get_writer, to_line_protocol
+
+# Fields every datapoint has, datasets with one of these names are ignored
+RESERVED_FIELDS = {"state", "output", "execution_time", "cpu_time", "max_rss"}
+
+
+def _content_types() -> dict:
+    """Returns a mapping of result context -> content type id. get_for_model is cached by django."""
+    observable = ContentType.objects.get_for_model(Observable).id
+    return {
+        "host": ContentType.objects.get_for_model(Host).id,
+        "observable": observable,
+        "metric": observable,
+    }
+
+
+def to_datapoint(proxy_id, result: dict, content_types: dict):
+    """Converts a check result to a line of line protocol and its state update.
+
+    :param proxy_id: Id of the submitting proxy
+    :param result: Check result as sent by the scheduler
+    :param content_types: Mapping of context -> content type id
+    :return: Tuple of line and (content type id, object id, proxy id, state, output, timestamp) or None, if the result
+    is malformed or does not belong to a scheduled object
+    """
+    if not isinstance(result, dict) or result.get("context") not in content_types:
+        return None
+    content_type_id = content_types[result["context"]]
+    measurement = reference.scheduled_objects.get(content_type_id, result.get("object_id"))
+    if measurement is None:
+        return None
+    meta = result.get("meta") if isinstance(result.get("meta"), dict) else {}
+    fields = [
+        ("state", str(result.get("state", "unknown"))),
+        ("output", str(result.get("output", ""))),
+    ]
+    if isinstance(meta.get("process_execution_time"), (int, float)):
+        fields.append(("execution_time", float(meta["process_execution_time"])))
+    # Resource usage of check commands, to find the expensive ones
+    if isinstance(meta.get("cpu_user_time"), (int, float)) and isinstance(meta.get("cpu_system_time"), (int, float)):
+        fields.append(("cpu_time", float(meta["cpu_user_time"] + meta["cpu_system_time"])))
+    if isinstance(meta.get("max_rss"), int) and not isinstance(meta["max_rss"], bool):
+        fields.append(("max_rss", meta["max_rss"]))
+    datasets = result.get("datasets")
+    for x in datasets if isinstance(datasets, list) else []:
+        if not isinstance(x, dict):
+            continue
+        name = x.get("label", x.get("name"))
+        value = x.get("value")
+        if name and name not in RESERVED_FIELDS and isinstance(value, (int, float)) and not isinstance(value, bool):
+            fields.append((name, value))
+    timestamp = meta.get("process_end_time")
+    if not isinstance(timestamp, (int, float)):
+        timestamp = time.time()
+    line = to_line_protocol(measurement, [("proxy", proxy_id)], fields, timestamp)
+    return line, (content_type_id, int(result["object_id"]), proxy_id, fields[0][1], fields[1][1], timestamp)
+
+
+def ingest(proxy_id, results: list) -> (int, int):
+    """Queues the datapoints of results at the batching writer and stores the latest states.
+
+    Lookups are answered from the process local caches and the states are stored with a constant number of queries,
+    so no query is executed per result.
+
+    :return: Number of accepted and rejected results
+    """
+    content_types = _content_types()
+    accepted = [x for x in [to_datapoint(proxy_id, x, content_types) for x in results] if x is not None]
+    if accepted:
+        get_writer().write_lines([x[0] for x in accepted])
+        state.update_states([x[1] for x in accepted])
+    return len(accepted), len(results) - len(accepted)
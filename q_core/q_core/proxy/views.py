@@ -1,4 +1,5 @@
 import base64
+import hashlib
 import json
 import logging
 
@@ -10,7 +11,9 @@ from django.views.decorators.csrf import csrf_exempt
 
 import rc_protocol
 
-from api.models import Proxy
+from api import reference
+from proxy import result
+from proxy.ingest import ingest
 
 logger = logging.getLogger(__name__)
 
@@ -23,48 +26,55 @@ class AuthenticationView(View):
         if "HTTP_AUTHENTICATION" not in request.META:
             return JsonResponse({"success": False, "message": "No authentication header is given"}, status=401)
         auth = request.META["HTTP_AUTHENTICATION"]
-        decoded = base64.urlsafe_b64decode(auth).decode("utf-8")
-        proxy_id = decoded.split(":")[0]
-        checksum = decoded.split(":")[1]
         try:
-            if not Proxy.objects.filter(disabled=False, id=proxy_id).exists():
-                return JsonResponse(
-                    {"success": False, "message": f"Proxy with id {proxy_id} does not exist or is disabled"},
-                    status=403
-                )
-            proxy = Proxy.objects.get(id=proxy_id)
-
-            # Only POST and PUT have a body to decode
-            if request.META["REQUEST_METHOD"] == "POST" or request.META["REQUEST_METHOD"] == "PUT":
-                # Decode json
-                try:
-                    # If request.body is None or an empty string, json.loads fails
-                    decoded = json.loads(request.body if request.body else "{}")
-                except json.JSONDecodeError:
-                    return {"success": False, "message": "Json could not be decoded", "status": 400}
-            elif request.META["REQUEST_METHOD"] == "GET" or request.META["REQUEST_METHOD"] == "DELETE":
-                # Set decoded to urlencoded parameters
-                decoded = request.GET
+            proxy_id, checksum = base64.urlsafe_b64decode(auth).decode("utf-8").split(":", 1)
+        except (ValueError, UnicodeDecodeError):
+            return JsonResponse({"success": False, "message": "Authentication header is malformed"}, status=401)
 
+        # Proxies are taken from the process local cache to not query the database on every submission
+        proxy = reference.proxies.get(proxy_id)
+        if proxy is None or proxy.disabled:
+            return JsonResponse(
+                {"success": False, "message": f"Proxy with id {proxy_id} does not exist or is disabled"},
+                status=403
+            )
+
+        # Bodies of results are passed on undecoded, the checksum covers their hash
+        if request.content_type == result.RESULT_CONTENT_TYPE:
             if not rc_protocol.validate_checksum(
-                request=decoded,
+                request={"body": hashlib.sha512(request.body).hexdigest()},
                 checksum=checksum,
-                shared_secret=proxy.web_secret,
+                shared_secret=proxy.core_secret,
                 salt=request.path.split("/")[-1],
                 use_time_component=True
             ):
-                return JsonResponse(
-                    {"success": False, "message": f"Checksum test failed"},
-                    status=403
-                )
-
-        except Proxy.DoesNotExist:
-            # Proxy should exist as the if above should check this
+                return JsonResponse({"success": False, "message": f"Checksum test failed"}, status=403)
+            return proxy.id, request.body
+
+        # Only POST and PUT have a body to decode
+        if request.META["REQUEST_METHOD"] == "POST" or request.META["REQUEST_METHOD"] == "PUT":
+            # Decode json
+            try:
+                # If request.body is None or an empty string, json.loads fails
+                decoded = json.loads(request.body if request.body else "{}")
+            except json.JSONDecodeError:
+                return JsonResponse({"success": False, "message": "Json could not be decoded"}, status=400)
+        else:
+            # Set decoded to urlencoded parameters
+            decoded = request.GET
+
+        if not isinstance(decoded, dict) or not rc_protocol.validate_checksum(
+            request=decoded,
+            checksum=checksum,
+            shared_secret=proxy.core_secret,
+            salt=request.path.split("/")[-1],
+            use_time_component=True
+        ):
             return JsonResponse(
-                {"success": False, "message": f"Could not retrieve proxy with id {proxy_id}"},
-                status=500
+                {"success": False, "message": f"Checksum test failed"},
+                status=403
             )
-        return proxy_id, decoded
+        return proxy.id, decoded
 
     def get(self, request, *args, **kwargs):
         ret = self._check_auth(request)
@@ -101,3 +111,26 @@ class AuthenticationView(View):
 
     def save_delete(self, request, proxy_id, decoded, *args, **kwargs):
         return NotImplemented
+
+
+class SubmitView(AuthenticationView):
+    def save_post(self, request, proxy_id, decoded, *args, **kwargs):
+        """Accepts check results as lines of JSON, or as {"results": [...]} or a single check result"""
+        invalid = 0
+        if isinstance(decoded, bytes):
+            results = []
+            for line in result.split_lines(decoded):
+                try:
+                    results.append(result.decode(line))
+                except result.SchemaError as err:
+                    invalid += 1
+                    logger.debug(f"Invalid result of proxy {proxy_id}: {err}")
+        else:
+            results = decoded["results"] if "results" in decoded else [decoded]
+            if not isinstance(results, list):
+                return JsonResponse({"success": False, "message": "results has to be a list"}, status=400)
+        accepted, rejected = ingest(proxy_id, results)
+        rejected += invalid
+        if rejected:
+            logger.warning(f"Rejected {rejected} results of proxy {proxy_id}")
+        return JsonResponse({"success": True, "data": {"accepted": accepted, "rejected": rejected}})
@@ -85,10 +85,22 @@ DATABASES = {
     'default': {
     },
     'influxdb': {
+        # "influxdb" or "embedded" to store the results in DIRECTORY without an InfluxDB, see utils/embedded_tsdb.py
+        # 'BACKEND': 'influxdb',
+        # 'DIRECTORY': '/var/lib/q/tsdb/',
+        # 'RETENTION': 2592000,
         'URI': '',
         'ORG': '',
         'TOKEN': '',
-        'BUCKET': ''
+        'BUCKET': '',
+        # Optional settings of the batching writer, see utils/influx_db.py for the defaults
+        # 'BATCH_SIZE': 5000,
+        # 'FLUSH_INTERVAL': 1.0,
+        # 'OVERFLOW_DIRECTORY': '/var/lib/q/influxdb-overflow/',
+        # 'OVERFLOW_MAX_BYTES': 268435456,
+        # Retention tiers as (name, resolution, retention) in seconds, see utils/retention.py. Apply changes with
+        # manage.py setupretention
+        # 'RETENTION_TIERS': [("raw", 0, 604800), ("5m", 300, 7776000), ("1h", 3600, 0)],
     }
 }
 
@@ -142,6 +154,23 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 DESCRIPTION_DIRECTORY = "/etc/q-scheduler/"
 
+STATE_SNAPSHOT_PATH = "/var/lib/q/state-snapshot.json.gz"
+
+# Number of blocks of aggregated series cached per process, see api/timeseries.py
+SERIES_CACHE_SIZE = 4096
+
+# Sinks which receive the notifications of state changes, no notifications are sent without a sink
+NOTIFICATIONS = {
+    "SINKS": [
+        # {"CLASS": "api.notifications.FileSink", "PATH": "/var/log/q-core/notifications.log"},
+        # {"CLASS": "api.notifications.SmtpSink", "HOST": "localhost", "PORT": 25, "SENDER": "q@localhost"},
+    ],
+    # Optional
+    # "BATCH_INTERVAL": 10,
+    # "RATE_LIMIT": 20,
+    # "RATE_PERIOD": 3600,
+}
+
 logging.basicConfig(
     filename="/var/log/q-core/q-core.log",
     format='%(asctime)s :: %(levelname)s: %(message)s',
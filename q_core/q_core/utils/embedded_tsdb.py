@@ -0,0 +1,469 @@
+"""Embedded storage of check results for deployments without InfluxDB.
+
+The store takes the line protocol of the results like the InfluxWriter. Every numeric field of a measurement is a
+series, points of all proxies are merged, tags and string fields are not stored.
+
+Points are collected per series in memory and sealed by a background thread every flush_interval seconds into
+compressed chunks. Timestamps are stored as zigzag varints of their delta of deltas, values with the XOR compression of
+Gorilla. Chunks are appended to one file per series and day, so ranges outside the retention are removed by deleting
+whole files. Files are read through mmap and are shared by all processes, appends are serialised with flock.
+"""
+import atexit
+import fcntl
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+from urllib.parse import quote, unquote
+
+logger = logging.getLogger("embedded_tsdb")
+
+DEFAULT_DIRECTORY = "/var/lib/q/tsdb/"
+DEFAULT_FLUSH_INTERVAL = 10.0
+DEFAULT_RETENTION = 30 * 86400
+CHUNK_POINTS = 1024
+PARTITION_SECONDS = 86400
+RETENTION_CHECK_INTERVAL = 3600.0
+# Seconds between the logged metrics of the store of a process
+METRICS_LOG_INTERVAL = 60.0
+
+# Magic, first timestamp, last timestamp, number of points and length of the payload
+CHUNK_HEADER = struct.Struct("<4sqqII")
+CHUNK_MAGIC = b"QTSC"
+FLOAT = struct.Struct(">d")
+UINT = struct.Struct(">Q")
+
+
+def _unescape_until(line: str, position: int, stops: str):
+    """Reads an escaped token of line protocol until one of stops, returns the token and the position of the stop"""
+    token = []
+    while position < len(line) and line[position] not in stops:
+        if line[position] == "\\" and position + 1 < len(line):
+            position += 1
+        token.append(line[position])
+        position += 1
+    return "".join(token), position
+
+
+def _parse_value(value: str):
+    if value.endswith("i") and value[:-1].lstrip("-").isdigit():
+        return int(value[:-1])
+    if value in ("true", "false"):
+        return value == "true"
+    return float(value)
+
+
+def parse_line(line: str):
+    """Parses a line of line protocol.
+
+    :return: Tuple of measurement, dict of tags, dict of fields and the timestamp
+    """
+    measurement, position = _unescape_until(line, 0, ", ")
+    tags = {}
+    while position < len(line) and line[position] == ",":
+        key, position = _unescape_until(line, position + 1, "=")
+        value, position = _unescape_until(line, position + 1, ", ")
+        tags[key] = value
+    fields = {}
+    while position < len(line) and line[position] in ", ":
+        if line[position] == " " and fields:
+            break
+        key, position = _unescape_until(line, position + 1, "=")
+        position += 1
+        if line[position:position + 1] == '"':
+            value = []
+            position += 1
+            while line[position] != '"':
+                if line[position] == "\\":
+                    position += 1
+                value.append(line[position])
+                position += 1
+            fields[key] = "".join(value)
+            position += 1
+        else:
+            end = position
+            while end < len(line) and line[end] not in ", ":
+                end += 1
+            fields[key] = _parse_value(line[position:end])
+            position = end
+    timestamp = line[position:].strip()
+    return measurement, tags, fields, int(timestamp) if timestamp else int(time.time())
+
+
+def _zigzag(value: int) -> int:
+    return value * 2 if value >= 0 else -value * 2 - 1
+
+
+def _unzigzag(value: int) -> int:
+    return value // 2 if not value & 1 else -(value + 1) // 2
+
+
+def _write_varint(out: bytearray, value: int):
+    while value >= 0x80:
+        out.append(value & 0x7f | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _read_varint(data, position: int):
+    value = 0
+    shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, position
+        shift += 7
+
+
+def encode_chunk(timestamps: list, values: list) -> bytes:
+    """Encodes sorted timestamps and float values.
+
+    The payload is the length of the timestamp section, the timestamps as delta of deltas and the values as bits
+    of the Gorilla XOR encoding.
+    """
+    stamps = bytearray()
+    previous, delta = 0, 0
+    for x in timestamps:
+        _write_varint(stamps, _zigzag(x - previous - delta))
+        delta = x - previous
+        previous = x
+
+    bits = []
+    previous = UINT.unpack(FLOAT.pack(values[0]))[0]
+    bits.append(f"{previous:064b}")
+    leading, trailing = -1, 0
+    for value in values[1:]:
+        current = UINT.unpack(FLOAT.pack(value))[0]
+        xor = current ^ previous
+        previous = current
+        if not xor:
+            bits.append("0")
+            continue
+        current_leading = min(64 - xor.bit_length(), 31)
+        current_trailing = (xor & -xor).bit_length() - 1
+        if leading >= 0 and current_leading >= leading and current_trailing >= trailing:
+            length = 64 - leading - trailing
+            bits.append(f"10{xor >> trailing:0{length}b}")
+        else:
+            leading, trailing = current_leading, current_trailing
+            length = 64 - leading - trailing
+            bits.append(f"11{leading:05b}{length % 64:06b}{xor >> trailing:0{length}b}")
+    bits = "".join(bits)
+    bits += "0" * (-len(bits) % 8)
+    packed = int(bits, 2).to_bytes(len(bits) // 8, "big")
+
+    out = bytearray()
+    _write_varint(out, len(stamps))
+    return bytes(out + stamps + packed)
+
+
+def decode_chunk(data, count: int):
+    """Decodes a payload of encode_chunk, returns the list of timestamps and the list of values"""
+    length, position = _read_varint(data, 0)
+    end = position + length
+    timestamps = []
+    previous, delta = 0, 0
+    while position < end:
+        value, position = _read_varint(data, position)
+        delta += _unzigzag(value)
+        previous += delta
+        timestamps.append(previous)
+
+    bits = bin(int.from_bytes(data[end:], "big"))[2:].zfill((len(data) - end) * 8)
+    previous = int(bits[:64], 2)
+    values = [FLOAT.unpack(UINT.pack(previous))[0]]
+    position = 64
+    leading, trailing = 0, 0
+    for _ in range(count - 1):
+        if bits[position] == "0":
+            position += 1
+        else:
+            if bits[position + 1] == "1":
+                leading = int(bits[position + 2:position + 7], 2)
+                length = int(bits[position + 7:position + 13], 2) or 64
+                trailing = 64 - leading - length
+                position += 13
+            else:
+                length = 64 - leading - trailing
+                position += 2
+            previous ^= int(bits[position:position + length], 2) << trailing
+            position += length
+        values.append(FLOAT.unpack(UINT.pack(previous))[0])
+    return timestamps, values
+
+
+class SeriesFile:
+    """Append only file of the chunks of one series and partition.
+
+    The index of the chunks is read from their headers and extended whenever the file grew.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # List of (first timestamp, last timestamp, count, payload offset, payload length)
+        self.index = []
+        self.size = 0
+        self.map = None
+
+    def _refresh(self):
+        try:
+            size = os.path.getsize(self.path)
+        except FileNotFoundError:
+            self.index, self.size, self.map = [], 0, None
+            return
+        if size == self.size:
+            return
+        if size < self.size:
+            # The file was removed by the retention and written again
+            self.index, self.size = [], 0
+        with open(self.path, "rb") as fh:
+            self.map = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        position = self.size
+        while position + CHUNK_HEADER.size <= size:
+            magic, first, last, count, length = CHUNK_HEADER.unpack_from(self.map, position)
+            if magic != CHUNK_MAGIC or position + CHUNK_HEADER.size + length > size:
+                logger.error(f"Corrupt chunk in {self.path} at {position}, ignoring the rest of the file")
+                break
+            self.index.append((first, last, count, position + CHUNK_HEADER.size, length))
+            position += CHUNK_HEADER.size + length
+        self.size = size
+
+    def append(self, timestamps: list, values: list):
+        payload = encode_chunk(timestamps, values)
+        header = CHUNK_HEADER.pack(CHUNK_MAGIC, timestamps[0], timestamps[-1], len(timestamps), len(payload))
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, "ab") as fh:
+            fcntl.flock(fh, fcntl.LOCK_EX)
+            try:
+                fh.write(header + payload)
+                fh.flush()
+            finally:
+                fcntl.flock(fh, fcntl.LOCK_UN)
+        return CHUNK_HEADER.size + len(payload)
+
+    def scan(self, start, stop):
+        """Yields (timestamp, value) of all points with start <= timestamp < stop"""
+        self._refresh()
+        for first, last, count, offset, length in self.index:
+            if last < start or first >= stop:
+                continue
+            timestamps, values = decode_chunk(self.map[offset:offset + length], count)
+            for x in range(count):
+                if start <= timestamps[x] < stop:
+                    yield timestamps[x], values[x]
+
+
+def _aggregate(values: list, aggregate, percentile):
+    if aggregate == "mean":
+        return sum(values) / len(values)
+    if aggregate == "min":
+        return min(values)
+    if aggregate == "max":
+        return max(values)
+    values = sorted(values)
+    return values[min(int(len(values) * percentile / 100), len(values) - 1)]
+
+
+class EmbeddedStore:
+    """Embedded replacement of the InfluxWriter, additionally answering range queries"""
+
+    def __init__(self, directory=DEFAULT_DIRECTORY, flush_interval=DEFAULT_FLUSH_INTERVAL,
+                 retention=DEFAULT_RETENTION):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.retention = retention
+
+        # (measurement, field) -> (list of timestamps, list of values) of the points not sealed yet
+        self.heads = {}
+        self.files = {}
+        self.condition = threading.Condition()
+        self.flush_lock = threading.Lock()
+        self.running = True
+        self.retention_checked = 0.0
+
+        self.points_written = 0
+        self.points_dropped = 0
+        self.bytes_written = 0
+        self.flushes = 0
+        self.flush_errors = 0
+        self.last_flush_latency = 0.0
+        self.flush_latency_sum = 0.0
+        self.metrics_logged = time.monotonic()
+
+        self.thread = threading.Thread(target=self._run, name="embedded-tsdb", daemon=True)
+        self.thread.start()
+
+    def write(self, measurement, tags, fields, timestamp):
+        self.write_points([(measurement, fields, int(timestamp))])
+
+    def write_lines(self, lines):
+        points = []
+        for line in lines:
+            try:
+                measurement, _, fields, timestamp = parse_line(line)
+            except (ValueError, IndexError):
+                with self.condition:
+                    self.points_dropped += 1
+                logger.error(f"Could not parse line {line!r}")
+                continue
+            points.append((measurement, fields.items(), timestamp))
+        self.write_points(points)
+
+    def write_points(self, points):
+        """Queues points given as (measurement, iterable of (field, value), timestamp)"""
+        full = False
+        with self.condition:
+            for measurement, fields, timestamp in points:
+                for field, value in fields:
+                    if isinstance(value, bool) or not isinstance(value, (int, float)):
+                        continue
+                    timestamps, values = self.heads.setdefault((measurement, field), ([], []))
+                    timestamps.append(int(timestamp))
+                    values.append(float(value))
+                    full = full or len(timestamps) >= CHUNK_POINTS
+            if full:
+                self.condition.notify()
+
+    def _run(self):
+        while self.running:
+            with self.condition:
+                self.condition.wait(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as err:
+                logger.exception(f"Unexpected error while sealing chunks: {err}")
+            self._log_metrics()
+
+    def _file(self, measurement, field, partition) -> SeriesFile:
+        key = (measurement, field, partition)
+        if key not in self.files:
+            self.files[key] = SeriesFile(os.path.join(
+                self.directory, quote(measurement, safe=""), quote(field, safe=""), f"{partition}.chunks"
+            ))
+        return self.files[key]
+
+    def flush(self):
+        """Seals all queued points into chunks"""
+        with self.flush_lock:
+            with self.condition:
+                heads, self.heads = self.heads, {}
+            if not heads:
+                self._apply_retention()
+                return
+            start = time.monotonic()
+            for (measurement, field), (timestamps, values) in heads.items():
+                points = sorted(zip(timestamps, values))
+                partitions = {}
+                for x in points:
+                    partitions.setdefault(x[0] // PARTITION_SECONDS * PARTITION_SECONDS, []).append(x)
+                for partition, partition_points in partitions.items():
+                    for i in range(0, len(partition_points), CHUNK_POINTS):
+                        chunk = partition_points[i:i + CHUNK_POINTS]
+                        try:
+                            written = self._file(measurement, field, partition).append(
+                                [x[0] for x in chunk], [x[1] for x in chunk]
+                            )
+                            with self.condition:
+                                self.bytes_written += written
+                                self.points_written += len(chunk)
+                        except OSError as err:
+                            with self.condition:
+                                self.flush_errors += 1
+                                self.points_dropped += len(chunk)
+                            logger.error(f"Could not write {len(chunk)} points of {measurement} {field}: {err}")
+            with self.condition:
+                self.last_flush_latency = time.monotonic() - start
+                self.flush_latency_sum += self.last_flush_latency
+                self.flushes += 1
+            self._apply_retention()
+
+    def _apply_retention(self):
+        """Removes partitions which ended before the retention, at most every RETENTION_CHECK_INTERVAL seconds"""
+        if not self.retention or time.monotonic() - self.retention_checked < RETENTION_CHECK_INTERVAL:
+            return
+        self.retention_checked = time.monotonic()
+        oldest = time.time() - self.retention
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                partition = name[:-len(".chunks")]
+                if name.endswith(".chunks") and partition.isdigit() and int(partition) + PARTITION_SECONDS < oldest:
+                    try:
+                        os.remove(os.path.join(root, name))
+                    except FileNotFoundError:
+                        pass
+        self.files = {x: y for x, y in self.files.items() if x[2] + PARTITION_SECONDS >= oldest}
+
+    def fields(self, measurement) -> list:
+        try:
+            return sorted(unquote(x) for x in os.listdir(os.path.join(self.directory, quote(measurement, safe=""))))
+        except FileNotFoundError:
+            return []
+
+    def scan(self, measurement, field, start, stop):
+        """Yields (timestamp, value) of a series with start <= timestamp < stop, sealed chunks first"""
+        first = int(start) // PARTITION_SECONDS * PARTITION_SECONDS
+        for partition in range(first, int(stop), PARTITION_SECONDS):
+            yield from self._file(measurement, field, partition).scan(start, stop)
+        with self.condition:
+            head = self.heads.get((measurement, field))
+            head = list(zip(*head)) if head else []
+        yield from (x for x in head if start <= x[0] < stop)
+
+    def query_series(self, measurement, start, stop, step, aggregate="mean", fields=None, percentile=None) -> dict:
+        """Aggregates series to windows of step seconds aligned to multiples of step, like the flux queries of
+        utils/influx_db.py. Every point has the end of its window as timestamp."""
+        step = max(int(step), 1)
+        series = {}
+        for field in fields if fields else self.fields(measurement):
+            windows = {}
+            for timestamp, value in self.scan(measurement, field, start, stop):
+                windows.setdefault(timestamp // step * step, []).append(value)
+            if windows:
+                series[field] = [
+                    [x + step, _aggregate(windows[x], aggregate, percentile)] for x in sorted(windows)
+                ]
+        return series
+
+    def metrics(self) -> dict:
+        with self.condition:
+            return {
+                "queue_depth": sum(len(x[0]) for x in self.heads.values()),
+                "points_written": self.points_written,
+                "points_dropped": self.points_dropped,
+                "bytes_written": self.bytes_written,
+                "flushes": self.flushes,
+                "flush_errors": self.flush_errors,
+                "last_flush_latency": self.last_flush_latency,
+                "average_flush_latency": self.flush_latency_sum / self.flushes if self.flushes else 0.0,
+            }
+
+    def _log_metrics(self):
+        """Logs the metrics every METRICS_LOG_INTERVAL seconds, every process has its own store"""
+        if time.monotonic() - self.metrics_logged < METRICS_LOG_INTERVAL:
+            return
+        self.metrics_logged = time.monotonic()
+        logger.info(f"Store of process {os.getpid()}: " + ", ".join(
+            f"{x}={round(y, 4) if isinstance(y, float) else y}" for x, y in self.metrics().items()
+        ))
+
+    def close(self):
+        """Seals the remaining points and stops the background thread"""
+        self.running = False
+        with self.condition:
+            self.condition.notify()
+        self.thread.join(timeout=self.flush_interval + 1)
+        self.flush()
+
+
+def create_store(config: dict) -> EmbeddedStore:
+    store = EmbeddedStore(
+        directory=config.get("DIRECTORY", DEFAULT_DIRECTORY),
+        flush_interval=config.get("FLUSH_INTERVAL", DEFAULT_FLUSH_INTERVAL),
+        retention=config.get("RETENTION", DEFAULT_RETENTION),
+    )
+    atexit.register(store.close)
+    return store
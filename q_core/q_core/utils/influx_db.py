@@ -1,19 +1,427 @@
-from influxdb_client import Point, InfluxDBClient, WritePrecision
+"""Writing and reading of datapoints to and from InfluxDB.
+
+Every process holds one InfluxWriter, which collects points in memory and writes them in batches from a background
+thread. Batches are sent as gzip compressed line protocol over a long lived client. If InfluxDB is unavailable,
+batches are retried and then spilled to a size bounded overflow directory, from where they are replayed once writes
+succeed again. Queue depth, flush latency and the written, spilled and dropped points are logged every
+METRICS_LOG_INTERVAL seconds by every process.
+
+Reads go to the retention tier fitting the requested range and resolution, see utils/retention.py.
+
+With BACKEND "embedded" no InfluxDB is used, points are written to and read from the store of utils/embedded_tsdb.py.
+"""
+import atexit
+import collections
+import datetime
+import gzip
+import logging
+import os
+import threading
+import time
+import uuid
+
+from influxdb_client import InfluxDBClient, WritePrecision
 from influxdb_client.client.write_api import SYNCHRONOUS
 
 from q_core import settings
+from utils.embedded_tsdb import create_store
+from utils.retention import ROLLUP_AGGREGATES, STRING_FIELDS, select_tier
+
+logger = logging.getLogger("influxdb")
+
+DEFAULT_BATCH_SIZE = 5000
+DEFAULT_FLUSH_INTERVAL = 1.0
+DEFAULT_MAX_QUEUE_SIZE = 100000
+DEFAULT_MAX_RETRIES = 3
+DEFAULT_OVERFLOW_DIRECTORY = "/var/lib/q/influxdb-overflow/"
+DEFAULT_OVERFLOW_MAX_BYTES = 256 * 1024 * 1024
+# Seconds between the logged metrics of the writer of a process
+METRICS_LOG_INTERVAL = 60.0
+
+
+def _escape(value: str, characters: str) -> str:
+    value = value.replace("\\", "\\\\")
+    for x in characters:
+        value = value.replace(x, f"\\{x}")
+    return value
+
+
+def _format_field(value) -> str:
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, int):
+        return f"{value}i"
+    if isinstance(value, float):
+        return repr(value)
+    return '"' + str(value).replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def _format_timestamp(timestamp) -> int:
+    if isinstance(timestamp, datetime.datetime):
+        return int(timestamp.timestamp())
+    return int(timestamp)
+
+
+def create_client() -> InfluxDBClient:
+    config = settings.DATABASES["influxdb"]
+    return InfluxDBClient(url=config["URI"], token=config["TOKEN"], org=config["ORG"], enable_gzip=True)
+
+
+def to_line_protocol(measurement, tags, fields, timestamp) -> str:
+    """Formats a point as line protocol with precision of seconds.
+
+    :param measurement: Name of the measurement
+    :param tags: Iterable of (key, value)
+    :param fields: Iterable of (key, value), at least one is required
+    :param timestamp: Unix timestamp or datetime
+    """
+    line = _escape(str(measurement), ", ")
+    for key, value in sorted(tags):
+        if value is None or value == "":
+            continue
+        line += f",{_escape(str(key), ',= ')}={_escape(str(value), ',= ')}"
+    line += " " + ",".join(
+        f"{_escape(str(key), ',= ')}={_format_field(value)}" for key, value in fields if value is not None
+    )
+    return f"{line} {_format_timestamp(timestamp)}"
+
+
+class InfluxWriter:
+    """Batching writer for InfluxDB.
+
+    Points are queued by write() and flushed by a background thread as soon as batch_size points are queued or
+    flush_interval seconds have passed. write() never blocks on the network. If the queue grows larger than
+    max_queue_size, because InfluxDB is slower than the producers, the oldest batch is moved to the overflow directory.
+    """
+
+    def __init__(self, url, token, org, bucket, batch_size=DEFAULT_BATCH_SIZE, flush_interval=DEFAULT_FLUSH_INTERVAL,
+                 max_queue_size=DEFAULT_MAX_QUEUE_SIZE, max_retries=DEFAULT_MAX_RETRIES,
+                 overflow_directory=DEFAULT_OVERFLOW_DIRECTORY, overflow_max_bytes=DEFAULT_OVERFLOW_MAX_BYTES):
+        self.bucket = bucket
+        self.org = org
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue_size = max_queue_size
+        self.max_retries = max_retries
+        self.overflow_directory = overflow_directory
+        self.overflow_max_bytes = overflow_max_bytes
+
+        self.client = InfluxDBClient(url=url, token=token, org=org, enable_gzip=True)
+        self.write_api = self.client.write_api(write_options=SYNCHRONOUS)
+
+        self.queue = collections.deque()
+        self.condition = threading.Condition()
+        self.flush_lock = threading.Lock()
+        self.running = True
+
+        self.points_written = 0
+        self.points_overflowed = 0
+        self.points_dropped = 0
+        self.flushes = 0
+        self.flush_errors = 0
+        self.last_flush_latency = 0.0
+        self.flush_latency_sum = 0.0
+        self.metrics_logged = time.monotonic()
+
+        self.thread = threading.Thread(target=self._run, name="influxdb-writer", daemon=True)
+        self.thread.start()
+
+    def write(self, measurement, tags, fields, timestamp):
+        self.write_lines([to_line_protocol(measurement, tags, fields, timestamp)])
+
+    def write_lines(self, lines):
+        """Queues already formatted lines of line protocol"""
+        spill = None
+        with self.condition:
+            self.queue.extend(lines)
+            if len(self.queue) > self.max_queue_size:
+                spill = [self.queue.popleft() for _ in range(min(self.batch_size, len(self.queue)))]
+            if len(self.queue) >= self.batch_size:
+                self.condition.notify()
+        if spill:
+            self._overflow(spill)
+
+    def _take_batch(self) -> list:
+        with self.condition:
+            return [self.queue.popleft() for _ in range(min(self.batch_size, len(self.queue)))]
+
+    def _run(self):
+        while self.running:
+            with self.condition:
+                if len(self.queue) < self.batch_size:
+                    self.condition.wait(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as err:
+                logger.exception(f"Unexpected error while flushing points: {err}")
+            self._log_metrics()
+
+    def flush(self):
+        """Writes all queued points. Called by the background thread, may be called to force a write."""
+        with self.flush_lock:
+            batch = self._take_batch()
+            while batch:
+                if not self._send(batch):
+                    self._overflow(batch)
+                    return
+                batch = self._take_batch()
+            self._replay_overflow()
+
+    def _send(self, batch: list) -> bool:
+        for attempt in range(self.max_retries):
+            start = time.monotonic()
+            try:
+                self.write_api.write(bucket=self.bucket, org=self.org, record=batch, write_precision=WritePrecision.S)
+            except Exception as err:
+                with self.condition:
+                    self.flush_errors += 1
+                logger.warning(f"Writing {len(batch)} points failed (attempt {attempt + 1}): {err}")
+                if attempt + 1 < self.max_retries:
+                    time.sleep(min(2 ** attempt, 10))
+                continue
+            with self.condition:
+                self.last_flush_latency = time.monotonic() - start
+                self.flush_latency_sum += self.last_flush_latency
+                self.flushes += 1
+                self.points_written += len(batch)
+            return True
+        return False
+
+    def _overflow_files(self) -> list:
+        try:
+            files = [os.path.join(self.overflow_directory, x) for x in os.listdir(self.overflow_directory)]
+        except FileNotFoundError:
+            return []
+        return sorted(x for x in files if x.endswith(".lp.gz"))
+
+    @staticmethod
+    def _size(path) -> int:
+        try:
+            return os.path.getsize(path)
+        except FileNotFoundError:
+            return 0
+
+    def overflow_bytes(self) -> int:
+        return sum(self._size(x) for x in self._overflow_files())
+
+    def _overflow(self, batch: list):
+        """Stores a batch on disk. The oldest files are dropped if the directory would exceed its size limit."""
+        data = gzip.compress("\n".join(batch).encode("utf-8"))
+        try:
+            os.makedirs(self.overflow_directory, exist_ok=True)
+            files = self._overflow_files()
+            used = sum(self._size(x) for x in files)
+            while files and used + len(data) > self.overflow_max_bytes:
+                oldest = files.pop(0)
+                used -= self._size(oldest)
+                lines = self._count_lines(oldest)
+                try:
+                    os.remove(oldest)
+                except FileNotFoundError:
+                    continue
+                with self.condition:
+                    self.points_dropped += lines
+                logger.error(f"Overflow directory is full, dropped {oldest}")
+            if len(data) > self.overflow_max_bytes:
+                raise OSError("Batch is larger than the overflow limit")
+            path = os.path.join(self.overflow_directory, f"{time.time_ns()}-{uuid.uuid4().hex}.lp.gz")
+            with open(path + ".tmp", "wb") as fh:
+                fh.write(data)
+            os.replace(path + ".tmp", path)
+            with self.condition:
+                self.points_overflowed += len(batch)
+        except OSError as err:
+            with self.condition:
+                self.points_dropped += len(batch)
+            logger.error(f"Could not write {len(batch)} points to the overflow directory: {err}")
+
+    @staticmethod
+    def _count_lines(path) -> int:
+        try:
+            with gzip.open(path, "rb") as fh:
+                return sum(1 for _ in fh)
+        except OSError:
+            return 0
+
+    def _replay_overflow(self):
+        """Sends the batches of the overflow directory, oldest first.
+
+        The directory is shared by all processes, so a file is claimed by renaming it before it is read.
+        """
+        for path in self._overflow_files():
+            claimed = f"{path}.{os.getpid()}"
+            try:
+                os.rename(path, claimed)
+            except FileNotFoundError:
+                continue
+            try:
+                with gzip.open(claimed, "rt", encoding="utf-8") as fh:
+                    batch = fh.read().splitlines()
+            except OSError as err:
+                logger.error(f"Could not read overflow file {path}, dropping it: {err}")
+                os.remove(claimed)
+                continue
+            if not self._send(batch):
+                os.rename(claimed, path)
+                return
+            os.remove(claimed)
+
+    def metrics(self) -> dict:
+        with self.condition:
+            metrics = {
+                "queue_depth": len(self.queue),
+                "points_written": self.points_written,
+                "points_overflowed": self.points_overflowed,
+                "points_dropped": self.points_dropped,
+                "flushes": self.flushes,
+                "flush_errors": self.flush_errors,
+                "last_flush_latency": self.last_flush_latency,
+                "average_flush_latency": self.flush_latency_sum / self.flushes if self.flushes else 0.0,
+            }
+        metrics["overflow_bytes"] = self.overflow_bytes()
+        return metrics
+
+    def _log_metrics(self):
+        """Logs the metrics every METRICS_LOG_INTERVAL seconds, every process has its own writer"""
+        if time.monotonic() - self.metrics_logged < METRICS_LOG_INTERVAL:
+            return
+        self.metrics_logged = time.monotonic()
+        logger.info(f"Writer of process {os.getpid()}: " + ", ".join(
+            f"{x}={round(y, 4) if isinstance(y, float) else y}" for x, y in self.metrics().items()
+        ))
+
+    def close(self):
+        """Flushes the remaining points and stops the background thread"""
+        self.running = False
+        with self.condition:
+            self.condition.notify()
+        self.thread.join(timeout=self.flush_interval + 1)
+        self.flush()
+        self.client.close()
+
+
+_writer = None
+_writer_pid = None
+_writer_lock = threading.Lock()
+
+
+def is_embedded() -> bool:
+    return settings.DATABASES["influxdb"].get("BACKEND", "influxdb") == "embedded"
+
+
+def get_writer():
+    """Returns the writer of this process, it is created on first use.
+
+    Workers forked from a parent which already had a writer get their own one, as threads do not survive a fork.
+    """
+    global _writer, _writer_pid
+    with _writer_lock:
+        if _writer is None or _writer_pid != os.getpid():
+            config = settings.DATABASES["influxdb"]
+            if is_embedded():
+                _writer = create_store(config)
+                _writer_pid = os.getpid()
+                return _writer
+            _writer = InfluxWriter(
+                url=config["URI"],
+                token=config["TOKEN"],
+                org=config["ORG"],
+                bucket=config["BUCKET"],
+                batch_size=config.get("BATCH_SIZE", DEFAULT_BATCH_SIZE),
+                flush_interval=config.get("FLUSH_INTERVAL", DEFAULT_FLUSH_INTERVAL),
+                max_queue_size=config.get("MAX_QUEUE_SIZE", DEFAULT_MAX_QUEUE_SIZE),
+                max_retries=config.get("MAX_RETRIES", DEFAULT_MAX_RETRIES),
+                overflow_directory=config.get("OVERFLOW_DIRECTORY", DEFAULT_OVERFLOW_DIRECTORY),
+                overflow_max_bytes=config.get("OVERFLOW_MAX_BYTES", DEFAULT_OVERFLOW_MAX_BYTES),
+            )
+            _writer_pid = os.getpid()
+            atexit.register(_writer.close)
+        return _writer
 
 
 def insert_point(measurement, tags, fields, timestamp):
-    client = InfluxDBClient(
-        url=settings.DATABASES["influxdb"]["URI"],
-        token=settings.DATABASES["influxdb"]["TOKEN"],
+    """Queues a single point, it is written with the next batch"""
+    get_writer().write(measurement, tags, fields, timestamp)
+
+
+def _flux_string(value) -> str:
+    return '"' + str(value).replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def build_query(tier, measurement, start, stop, step, aggregate="mean", fields=None, percentile=None) -> str:
+    """Returns the flux query aggregating a measurement to windows of step seconds.
+
+    Series of all proxies are merged. On rollup tiers the series of the matching aggregate is read, percentiles are
+    computed from the means of the rollup.
+
+    :param tier: RetentionTier to read from
+    :param aggregate: One of mean, min, max and percentile
+    :param fields: List of fields or None for all numeric fields
+    :param percentile: Percentile from 0 to 100, required for the percentile aggregate
+    """
+    if aggregate == "percentile":
+        if percentile is None or not 0 <= percentile <= 100:
+            raise ValueError("Percentile has to be between 0 and 100")
+        fn = f"(column, tables=<-) => tables |> quantile(q: {percentile / 100!r}, column: column)"
+    elif aggregate in ROLLUP_AGGREGATES:
+        fn = aggregate
+    else:
+        raise ValueError(f"Unknown aggregate {aggregate}")
+    if fields:
+        field_filter = " or ".join(f"r._field == {_flux_string(x)}" for x in fields)
+    else:
+        field_filter = " and ".join(f"r._field != {_flux_string(x)}" for x in STRING_FIELDS)
+    query = (
+        f"from(bucket: {_flux_string(tier.bucket)})\n"
+        f"    |> range(start: {int(start)}, stop: {int(stop)})\n"
+        f"    |> filter(fn: (r) => r._measurement == {_flux_string(measurement)})\n"
+        f"    |> filter(fn: (r) => {field_filter})\n"
+    )
+    if tier.is_rollup:
+        rollup = aggregate if aggregate in ROLLUP_AGGREGATES else "mean"
+        query += f'    |> filter(fn: (r) => r.aggregate == "{rollup}")\n'
+    query += (
+        f'    |> group(columns: ["_field"])\n'
+        f"    |> aggregateWindow(every: {max(int(step), 1)}s, fn: {fn}, createEmpty: false)\n"
+    )
+    return query
+
+
+_client = None
+_client_pid = None
+
+
+def get_client() -> InfluxDBClient:
+    """Returns the client used for reads by this process"""
+    global _client, _client_pid
+    with _writer_lock:
+        if _client is None or _client_pid != os.getpid():
+            _client = create_client()
+            _client_pid = os.getpid()
+            atexit.register(_client.close)
+        return _client
+
+
+def query_series(measurement, start, stop, step, aggregate="mean", fields=None, percentile=None, tier=None) -> dict:
+    """Reads the aggregated series of a measurement.
+
+    Windows are aligned to multiples of step, every point has the end of its window as timestamp.
+
+    :param start: Unix timestamp
+    :param stop: Unix timestamp
+    :param step: Requested resolution in seconds
+    :param tier: RetentionTier to read from, defaults to the coarsest tier fitting range and step
+    :return: Mapping of field -> list of [timestamp, value]
+    """
+    if is_embedded():
+        return get_writer().query_series(measurement, start, stop, step, aggregate, fields, percentile)
+    tier = tier if tier is not None else select_tier(start, step)
+    tables = get_client().query_api().query(
+        build_query(tier, measurement, start, stop, step, aggregate, fields, percentile),
         org=settings.DATABASES["influxdb"]["ORG"]
     )
-    write_api = client.write_api(write_options=SYNCHRONOUS)
-    point = Point(measurement)
-    [point.tag(x[0], x[1]) for x in tags]
-    [point.field(x[0], x[1]) for x in fields]
-    point.time(timestamp, write_precision=WritePrecision.S)
-    write_api.write(bucket=settings.DATABASES["influxdb"]["BUCKET"], record=point)
-    client.close()
+    series = {}
+    for table in tables:
+        for record in table.records:
+            series.setdefault(record.get_field(), []).append([int(record.get_time().timestamp()), record.get_value()])
+    return series
@@ -0,0 +1,108 @@
+"""Retention tiers of the check results.
+
+Raw results are written to the configured bucket. Every further tier is a bucket with a coarser resolution, which is
+filled by an InfluxDB task downsampling the previous tier. A rollup stores the mean, min and max of every window as
+separate series, distinguished by the tag "aggregate".
+
+Buckets and tasks are created by the setupretention management command. Reads choose the coarsest tier which still
+has the requested resolution and holds the requested range, see select_tier.
+"""
+import time
+
+from q_core import settings
+
+# Name, resolution and retention in seconds, 0 as retention keeps data forever
+DEFAULT_TIERS = [
+    ("raw", 0, 7 * 86400),
+    ("5m", 300, 90 * 86400),
+    ("1h", 3600, 0),
+]
+
+ROLLUP_AGGREGATES = ("mean", "min", "max")
+# Fields without numeric values, they are not downsampled
+STRING_FIELDS = ("state", "output")
+
+
+class RetentionTier:
+    __slots__ = ("name", "bucket", "resolution", "retention")
+
+    def __init__(self, name, bucket, resolution, retention):
+        self.name = name
+        self.bucket = bucket
+        self.resolution = resolution
+        self.retention = retention
+
+    @property
+    def is_rollup(self) -> bool:
+        return self.resolution > 0
+
+    def holds(self, start, now) -> bool:
+        """Checks if points from start on are still retained"""
+        return not self.retention or start >= now - self.retention
+
+    def __repr__(self):
+        return f"RetentionTier({self.name}, {self.bucket}, {self.resolution}s, {self.retention}s)"
+
+
+def get_tiers() -> list:
+    """Returns the configured tiers ordered by resolution, the first one is the raw bucket"""
+    config = settings.DATABASES["influxdb"]
+    if config.get("BACKEND", "influxdb") == "embedded":
+        # The embedded store only holds raw points
+        return [RetentionTier("raw", "", 0, config.get("RETENTION", 0))]
+    tiers = [
+        RetentionTier(name, config["BUCKET"] if not resolution else f"{config['BUCKET']}_{name}", resolution, retention)
+        for name, resolution, retention in config.get("RETENTION_TIERS", DEFAULT_TIERS)
+    ]
+    return sorted(tiers, key=lambda x: x.resolution)
+
+
+def select_tier(start, step, tiers=None, now=None) -> RetentionTier:
+    """Returns the coarsest tier with a resolution of at most step, which holds points from start on.
+
+    If no tier has a fine enough resolution for the range, the finest tier holding the range is used.
+
+    :param start: Unix timestamp of the first requested point
+    :param step: Requested resolution in seconds
+    """
+    tiers = tiers if tiers is not None else get_tiers()
+    now = now if now is not None else time.time()
+    holding = [x for x in tiers if x.holds(start, now)] or tiers[-1:]
+    fitting = [x for x in holding if x.resolution <= step]
+    return fitting[-1] if fitting else holding[0]
+
+
+def _duration(seconds: int) -> str:
+    return f"{int(seconds)}s"
+
+
+def downsampling_task(tier: RetentionTier, source: RetentionTier, org: str) -> str:
+    """Returns the flux script of the task filling tier from source"""
+    every = _duration(tier.resolution)
+    string_fields = " and ".join(f'r._field != "{x}"' for x in STRING_FIELDS)
+    pipelines = []
+    for aggregate in ROLLUP_AGGREGATES:
+        pipeline = "data"
+        if source.is_rollup:
+            pipeline += f' |> filter(fn: (r) => r.aggregate == "{aggregate}")'
+        pipeline += (
+            f" |> aggregateWindow(every: {every}, fn: {aggregate}, createEmpty: false)"
+            f' |> set(key: "aggregate", value: "{aggregate}")'
+        )
+        pipelines.append(pipeline)
+    pipelines = ",\n    ".join(pipelines)
+    return f"""option task = {{name: "{task_name(tier)}", every: {every}, offset: 1m}}
+
+data = from(bucket: "{source.bucket}")
+    |> range(start: -{every})
+    |> filter(fn: (r) => {string_fields})
+
+union(tables: [
+    {pipelines}
+])
+    |> to(bucket: "{tier.bucket}", org: "{org}", tagColumns: ["proxy", "aggregate"])
+"""
+
+
+def task_name(tier: RetentionTier) -> str:
+    return f"q-downsample-{tier.name}"
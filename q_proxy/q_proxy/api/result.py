@@ -0,0 +1,135 @@
+"""Schema of check results.
+
+The same module is part of q-scheduler, q-proxy and q-core, keep the copies in sync.
+
+Results are sent as lines of JSON between scheduler, proxy and core. Every hop validates the lines with the compiled
+validator of RESULT_SCHEMA and passes the validated bytes on as they are.
+"""
+import json
+
+RESULT_CONTENT_TYPE = "application/x-ndjson"
+MAX_RESULT_BYTES = 8192
+MAX_OUTPUT_LENGTH = 4096
+STATES = ("ok", "warning", "critical", "unknown")
+CONTEXTS = ("host", "metric", "observable")
+
+
+class SchemaError(ValueError):
+    pass
+
+
+def _number(value, path):
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise SchemaError(f"{path} has to be a number")
+
+
+def _integer(value, path):
+    if isinstance(value, bool) or not isinstance(value, int):
+        raise SchemaError(f"{path} has to be an integer")
+
+
+def _string(max_length=None):
+    def validate(value, path):
+        if not isinstance(value, str):
+            raise SchemaError(f"{path} has to be a string")
+        if max_length is not None and len(value) > max_length:
+            raise SchemaError(f"{path} is longer than {max_length} characters")
+    return validate
+
+
+def _enum(*values):
+    allowed = frozenset(values)
+
+    def validate(value, path):
+        if not isinstance(value, str) or value not in allowed:
+            raise SchemaError(f"{path} has to be one of {', '.join(values)}")
+    return validate
+
+
+def _list(item):
+    def validate(value, path):
+        if not isinstance(value, list):
+            raise SchemaError(f"{path} has to be a list")
+        for i, x in enumerate(value):
+            item(x, f"{path}[{i}]")
+    return validate
+
+
+def _object(required: dict, optional: dict = None, one_of=()):
+    """Compiles a validator of a dict with exactly the given keys.
+
+    :param required: Mapping of key -> validator of the keys which have to be present
+    :param optional: Mapping of key -> validator of the keys which may be present
+    :param one_of: Keys of which exactly one has to be present
+    """
+    validators = {**required, **(optional or {})}
+    required = frozenset(required)
+    one_of = frozenset(one_of)
+
+    def validate(value, path):
+        if not isinstance(value, dict):
+            raise SchemaError(f"{path} has to be an object")
+        keys = value.keys()
+        if not required <= keys:
+            raise SchemaError(f"{path} is missing {', '.join(sorted(required - keys))}")
+        if one_of and len(one_of & keys) != 1:
+            raise SchemaError(f"{path} needs exactly one of {', '.join(sorted(one_of))}")
+        for key, x in value.items():
+            if key not in validators:
+                raise SchemaError(f"{path}.{key} is not allowed")
+            validators[key](x, f"{path}.{key}")
+    return validate
+
+
+DATASET_SCHEMA = _object(
+    {"value": _number},
+    {"label": _string(255), "name": _string(255), "unit": _string(32)},
+    one_of=("label", "name")
+)
+# Output of a check plugin
+PLUGIN_SCHEMA = _object(
+    {"state": _enum(*STATES), "output": _string(MAX_OUTPUT_LENGTH)},
+    {"datasets": _list(DATASET_SCHEMA)}
+)
+# Result as sent by the scheduler
+RESULT_SCHEMA = _object({
+    "object_id": _integer,
+    "context": _enum(*CONTEXTS),
+    "state": _enum(*STATES),
+    "output": _string(MAX_OUTPUT_LENGTH),
+    "datasets": _list(DATASET_SCHEMA),
+    "meta": _object(
+        {"process_end_time": _number, "process_execution_time": _number},
+        # Resource usage of check commands, see the sandbox of the scheduler
+        {
+            "cpu_user_time": _number,
+            "cpu_system_time": _number,
+            "max_rss": _integer,
+            "limit_exceeded": _enum("wall_time", "cpu_time", "memory", "output"),
+        }
+    ),
+})
+
+
+def decode(data: bytes, schema=RESULT_SCHEMA) -> dict:
+    """Decodes and validates one result. Raises SchemaError before decoding oversized or non object data."""
+    data = data.strip()
+    if len(data) > MAX_RESULT_BYTES:
+        raise SchemaError(f"Result is larger than {MAX_RESULT_BYTES} bytes")
+    if not data.startswith(b"{"):
+        raise SchemaError("Result has to be an object")
+    try:
+        decoded = json.loads(data)
+    except (ValueError, UnicodeDecodeError) as err:
+        raise SchemaError(f"Result is no valid JSON: {err}")
+    schema(decoded, "result")
+    return decoded
+
+
+def encode(result: dict) -> bytes:
+    return json.dumps(result, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+def split_lines(body: bytes) -> list:
+    """Returns the non empty lines of a body of results"""
+    return [x for x in body.split(b"\n") if x.strip()]
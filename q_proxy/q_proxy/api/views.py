@@ -1,18 +1,45 @@
 import base64
+import hashlib
 import json
 import logging
 import os
 
 import httpx
+import rc_protocol
 from django.http import JsonResponse
 from django.views import View
 
+from api import result
 from api.models import CheckResultModel, ConfigurationModel
 from q_proxy import settings
 
 logger = logging.getLogger(__name__)
 
 
+def get_authentication(config, data: dict, endpoint: str) -> str:
+    """Returns the value of the Authentication header for a request of data to endpoint of q-core"""
+    checksum = rc_protocol.get_checksum(data, config.web_secret, salt=endpoint)
+    return base64.urlsafe_b64encode(f"{config.proxy_id}:{checksum}".encode("utf-8")).decode("utf-8")
+
+
+def get_body_authentication(config, body: bytes, endpoint: str) -> str:
+    """Returns the value of the Authentication header for a raw body, the checksum covers the hash of the body"""
+    return get_authentication(config, {"body": hashlib.sha512(body).hexdigest()}, endpoint)
+
+
+def submit_results(config, lines: list, timeout=3) -> httpx.Response:
+    """Sends validated results to q-core as they are, one result per line"""
+    body = b"\n".join(lines)
+    return httpx.post(
+        f"https://{config.web_address}:{config.web_port}/proxy/api/v1/submit", timeout=timeout, content=body,
+        cert=("/var/lib/q/certs/q-proxy-fullchain.pem", "/var/lib/q/certs/q-proxy-privkey.pem"),
+        headers={
+            "Authentication": get_body_authentication(config, body, "submit"),
+            "Content-Type": result.RESULT_CONTENT_TYPE
+        }
+    )
+
+
 def _check_auth(request):
     # Check Authorization Header
     if "HTTP_AUTHENTICATION" not in request.META:
@@ -51,31 +78,29 @@ class UpdateDeclarationView(View):
 
 class SubmitView(View):
     def post(self, request, *args, **kwargs):
+        """Accepts results of the scheduler, one per line. They are validated and passed on to q-core unchanged."""
+        lines = result.split_lines(request.body)
         try:
-            decoded = json.loads(request.body)
-        except json.JSONDecodeError:
-            return JsonResponse({"success": False, "message": "JSON decode error"})
+            [result.decode(x) for x in lines]
+        except result.SchemaError as err:
+            logger.warning(f"Rejected results of the scheduler: {err}")
+            return JsonResponse({"success": False, "message": str(err)}, status=400)
+        if not lines:
+            return JsonResponse({"success": True})
         try:
-            if len(ConfigurationModel.objects.all()) == 0:
+            c = ConfigurationModel.objects.first()
+            if c is None:
                 logger.warning(f"No Configuration found in database, saving to backlog")
-                CheckResultModel.objects.create(json=json.dumps(decoded))
+                CheckResultModel.objects.bulk_create([CheckResultModel(json=x.decode("utf-8")) for x in lines])
                 return JsonResponse({"success": True, "message": "Data was saved to backlog"})
-            c = ConfigurationModel.objects.first()
-            ret = httpx.post(
-                f"https://{c.web_address}:{c.web_port}/proxy/api/v1/submit", timeout=3, json=decoded,
-                cert=("/var/lib/q/certs/q-proxy-fullchain.pem", "/var/lib/q/certs/q-proxy-privkey.pem"),
-                headers={
-                    "Authentication":
-                        base64.urlsafe_b64encode(f"{c.proxy_id}:{c.web_secret}".encode("utf-8")).decode("utf-8")
-                }
-            )
+            ret = submit_results(c, lines)
             if ret.status_code != 200:
                 logger.debug(ret.text)
                 logger.warning(f"Could not reach q-web, saving to backlog")
-                CheckResultModel.objects.create(json=json.dumps(decoded))
+                CheckResultModel.objects.bulk_create([CheckResultModel(json=x.decode("utf-8")) for x in lines])
                 return JsonResponse({"success": True, "message": "Data was saved to backlog"})
-        except httpx.ConnectTimeout or ConfigurationModel.DoesNotExist:
+        except httpx.TransportError:
             logger.warning(f"Could not reach q-web, saving to backlog")
-            CheckResultModel.objects.create(json=json.dumps(decoded))
+            CheckResultModel.objects.bulk_create([CheckResultModel(json=x.decode("utf-8")) for x in lines])
             return JsonResponse({"success": True, "message": "Data was saved to backlog"})
         return JsonResponse({"success": True})
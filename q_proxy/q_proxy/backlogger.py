@@ -1,23 +1,20 @@
 #!/usr/bin/env python3
-import base64
-import json
 import os
 
 import django
-import httpx
-
-
-def callback(config, cr):
-    ret = httpx.post(
-        f"https://{config.web_address}:{config.web_port}/proxy/api/v1/submit", timeout=3, json=json.loads(cr.json),
-        cert=("/var/lib/q/certs/q-proxy-fullchain.pem", "/var/lib/q/certs/q-proxy-privkey.pem"),
-        headers={
-            "Authentication":
-                base64.urlsafe_b64encode(f"{config.proxy_id}:{config.web_secret}".encode("utf-8")).decode("utf-8")
-        }
-    )
+
+# Number of results sent to q-core in one request
+BATCH_SIZE = 500
+
+
+def callback(config, batch):
+    from api.views import submit_results
+
+    # Results were validated before they were saved, they are sent as they are
+    ret = submit_results(config, [x.json.encode("utf-8") for x in batch], timeout=10)
     if ret.status_code == 200:
-        cr.delete()
+        from api.models import CheckResultModel
+        CheckResultModel.objects.filter(id__in=[x.id for x in batch]).delete()
     else:
         print(ret.status_code, ret.text)
 
@@ -29,8 +26,8 @@ def main():
     from api.models import ConfigurationModel, CheckResultModel
     c = ConfigurationModel.objects.first()
     backlog = list(CheckResultModel.objects.all())
-    for x in backlog:
-        callback(c, x)
+    for i in range(0, len(backlog), BATCH_SIZE):
+        callback(c, backlog[i:i + BATCH_SIZE])
 
 
 if __name__ == '__main__':
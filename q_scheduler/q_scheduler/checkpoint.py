@@ -0,0 +1,132 @@
+"""Checkpoint of the state of the checks for warm restarts.
+
+For every check the time it is due next, its last state and the number of consecutive non ok results are kept in a
+memory mapped file of fixed size records, so recording them is a write to memory. The file is flushed every interval
+seconds and left to the page cache in between, which keeps the state of a crashed scheduler as well.
+
+On start the records of the previous file are read, a file with a record for every current check is written next to
+it and renamed over it. Checks keep their phase in their scheduling interval this way, instead of all running at
+once after a restart.
+
+    header      magic, version, record size, number of records
+    record      check id, next due unix time, attempts, state + 1 (0 if it never returned), context
+"""
+import asyncio
+import logging
+import mmap
+import os
+import struct
+
+import result
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"QSCP"
+VERSION = 1
+HEADER = struct.Struct("<4sHHI")
+RECORD = struct.Struct("<QdHBB")
+# Fields of a record, which change while the scheduler runs, and their offset
+DUE = struct.Struct("<d")
+DUE_OFFSET = 8
+RESULT = struct.Struct("<HB")
+RESULT_OFFSET = 16
+DEFAULT_INTERVAL = 60
+
+
+def get_options(config) -> dict:
+    """Returns the keyword arguments of Checkpoint set in the scheduler config"""
+    return {"path": config.checkpoint_path, "interval": config.checkpoint_interval}
+
+
+def shard_path(path: str, index: int) -> str:
+    """Returns the path of the checkpoint of a shard"""
+    return f"{path}.{index}"
+
+
+def _key(check) -> tuple:
+    return result.CONTEXTS.index(check.context), check.id
+
+
+def _read(path: str) -> dict:
+    """Returns the records of the checkpoint at path as (context, id) -> (due, state, attempts)"""
+    try:
+        with open(path, "rb") as fh, mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            magic, version, size, count = HEADER.unpack_from(mm)
+            if magic != MAGIC or version != VERSION or size != RECORD.size or \
+                    len(mm) < HEADER.size + count * RECORD.size:
+                logger.warning(f"Ignoring invalid checkpoint {path}")
+                return {}
+            records = {}
+            for check_id, due, attempts, state, context in RECORD.iter_unpack(
+                    mm[HEADER.size:HEADER.size + count * RECORD.size]):
+                records[context, check_id] = (due, result.STATES[state - 1] if state else None, attempts)
+            return records
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError, IndexError, struct.error) as err:
+        logger.warning(f"Could not read checkpoint {path}: {err}")
+        return {}
+
+
+class Checkpoint:
+    """Memory mapped state of checks
+
+    :param path: File of the checkpoint
+    :param checks: Checks which are scheduled, the state of other checks of the previous file is dropped
+    :param interval: Seconds between flushes of the file
+    :raises OSError: If the file could not be written
+    """
+
+    def __init__(self, path: str, checks: list, interval=DEFAULT_INTERVAL):
+        self.path = path
+        self.interval = interval
+        previous = _read(path)
+        self.slots = {}
+        self.restored = {}
+        for x in checks:
+            key = _key(x)
+            if key in self.slots:
+                continue
+            self.slots[key] = len(self.slots)
+            if key in previous:
+                self.restored[key] = previous[key]
+
+        tmp = f"{path}.tmp"
+        with open(tmp, "w+b") as fh:
+            fh.truncate(HEADER.size + max(len(self.slots), 1) * RECORD.size)
+            self.mm = mmap.mmap(fh.fileno(), 0)
+        HEADER.pack_into(self.mm, 0, MAGIC, VERSION, RECORD.size, len(self.slots))
+        for (context, check_id), slot in self.slots.items():
+            due, state, attempts = self.restored.get((context, check_id), (0.0, None, 0))
+            RECORD.pack_into(
+                self.mm, HEADER.size + slot * RECORD.size, check_id, due, attempts,
+                result.STATES.index(state) + 1 if state else 0, context
+            )
+        self.mm.flush()
+        os.replace(tmp, path)
+        logger.info(f"Restored the state of {len(self.restored)} of {len(self.slots)} check(s) from {path}")
+
+    def get(self, check):
+        """Returns the restored (due, state, attempts) of the check or None"""
+        return self.restored.get(_key(check))
+
+    def set_due(self, check, due: float):
+        DUE.pack_into(self.mm, HEADER.size + self.slots[_key(check)] * RECORD.size + DUE_OFFSET, due)
+
+    def set_result(self, check, state: str, attempts: int):
+        RESULT.pack_into(
+            self.mm, HEADER.size + self.slots[_key(check)] * RECORD.size + RESULT_OFFSET, min(attempts, 0xFFFF),
+            result.STATES.index(state) + 1
+        )
+
+    def flush(self):
+        self.mm.flush()
+
+    async def run(self):
+        """Flushes the file every interval"""
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                self.flush()
+            except OSError as err:
+                logger.error(f"Could not flush checkpoint {self.path}: {err}")
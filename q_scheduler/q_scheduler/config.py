@@ -6,3 +6,28 @@ class SchedulerConfig(Config):
         super().__init__()
         self.declaration_path = "/var/lib/q/declaration.json"
         self.workers = 10
+        # Number of scheduler processes the checks are split over, 0 starts one per core
+        self.shards = 1
+        # Persistent plugins: processes per plugin, requests before a process is replaced and answer timeout
+        self.plugin_processes = 2
+        self.plugin_max_requests = 1000
+        self.plugin_timeout = 30
+        # Concurrently running checks per host and per check type, 0 for no limit
+        self.host_concurrency = 4
+        self.check_type_concurrency = 0
+        # Critical results after which the checks of the observables of a host without max_attempts are deferred
+        self.host_down_attempts = 2
+        # Address of the metrics endpoint, "host:port" or "unix:/path", empty to disable it. Shards serve on the
+        # following ports or on the path with their index appended
+        self.metrics_address = ""
+        # Limits of check commands, 0 disables a limit: seconds, CPU seconds, bytes of memory and bytes of output.
+        # With a delegated cgroup v2 directory as cgroup root, every check runs in a child cgroup limiting its memory
+        self.check_wall_time = 60
+        self.check_cpu_time = 0
+        self.check_memory = 0
+        self.check_output_bytes = 8192
+        self.check_cgroup_root = ""
+        # File the state of the checks is kept in for warm restarts, empty to disable it, and seconds between its
+        # flushes. Shards append their index to the path
+        self.checkpoint_path = "/var/lib/q/scheduler-state"
+        self.checkpoint_interval = 60
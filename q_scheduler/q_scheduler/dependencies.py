@@ -0,0 +1,67 @@
+"""Dependencies of observables on their host.
+
+While a host is down, the checks of its observables would only run into their timeouts. Once the host check returned
+max_attempts critical results in a row, host_down_attempts for hosts without max_attempts, the checks of its observables
+are deferred instead of queued. Deferred checks are kept once per observable and queued as soon as the host check is no
+longer critical.
+"""
+import logging
+
+logger = logging.getLogger(__name__)
+
+HOST_DOWN_STATES = ("critical",)
+DEFAULT_DOWN_ATTEMPTS = 2
+
+
+class DependencyTracker:
+    def __init__(self, down_attempts=DEFAULT_DOWN_ATTEMPTS):
+        self.down_attempts = down_attempts
+        # Host id -> number of consecutive down results
+        self.failures = {}
+        # Host id -> max_attempts of the host
+        self.thresholds = {}
+        # Host id -> {check id: check}
+        self.deferred = {}
+        self.suppressed = 0
+
+    def is_down(self, host_id) -> bool:
+        return self.failures.get(host_id, 0) >= self.thresholds.get(host_id, self.down_attempts)
+
+    def defer(self, check) -> bool:
+        """Defers the check, if its host is down. Returns True if it was deferred."""
+        if check.context == "host" or check.linked_host is None or not self.is_down(check.linked_host):
+            return False
+        self.deferred.setdefault(check.linked_host, {})[check.id] = check
+        self.suppressed += 1
+        return True
+
+    def update(self, check, state: str) -> list:
+        """Records the result of a check. Returns the deferred checks, which have to be run now."""
+        if check.context != "host":
+            return []
+        if check.max_attempts:
+            self.thresholds[check.id] = check.max_attempts
+        if state in HOST_DOWN_STATES:
+            self.failures[check.id] = self.failures.get(check.id, 0) + 1
+            if self.failures[check.id] == self.thresholds.get(check.id, self.down_attempts):
+                logger.info(f"Host {check.id} is down, deferring the checks of its observables")
+            return []
+        if self.is_down(check.id):
+            logger.info(f"Host {check.id} recovered")
+        self.failures.pop(check.id, None)
+        return list(self.deferred.pop(check.id, {}).values())
+
+    def restore(self, check, state: str, attempts: int):
+        """Restores the consecutive down results of a host from a checkpoint, attempts counts every non ok result"""
+        if check.context != "host" or state not in HOST_DOWN_STATES or not attempts:
+            return
+        if check.max_attempts:
+            self.thresholds[check.id] = check.max_attempts
+        self.failures[check.id] = attempts
+
+    def metrics(self) -> dict:
+        return {
+            "hosts_down": sum(1 for x in self.failures if self.is_down(x)),
+            "deferred": sum(len(x) for x in self.deferred.values()),
+            "suppressed": self.suppressed,
+        }
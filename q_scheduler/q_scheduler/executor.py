@@ -1,32 +1,306 @@
 import asyncio
+import logging
+import os
+import shlex
+import time
+from collections import deque
 
 import httpx
 
+import metrics
+import plugins
+import probes
+import result
+import sandbox
+from dependencies import DependencyTracker, DEFAULT_DOWN_ATTEMPTS
+from retries import RetryTracker
+from plugins import PluginManager
+from probes import ProbeRunner
 from worker import Worker
 
+logger = logging.getLogger(__name__)
+
+SUBMIT_URL = "https://127.0.0.1:8443/scheduler/api/v1/submit"
+CERT = ("/var/lib/q/certs/q-scheduler-fullchain.pem", "/var/lib/q/certs/q-scheduler-privkey.pem")
+
+# Seconds of execution time a host may use per round of the deficit round robin
+QUANTUM = 1.0
+# Bounds of the expected execution time of a check type, which is the cost of a check
+MIN_COST = 0.01
+MAX_COST = 10.0
+# Weight of the last execution in the expected execution time
+COST_SMOOTHING = 0.2
+
+QUEUE_WAIT = metrics.registry.histogram(
+    "q_scheduler_queue_wait_seconds", "Time from a check being due to its start", ("check_type",)
+)
+CHECK_DURATION = metrics.registry.histogram(
+    "q_scheduler_check_duration_seconds", "Execution time of checks including the submission", ("check_type",)
+)
+CHECK_RESULTS = metrics.registry.counter(
+    "q_scheduler_check_results_total", "Results of checks by state", ("check_type", "state")
+)
+CHECK_ERRORS = metrics.registry.counter(
+    "q_scheduler_check_errors_total", "Checks which failed without a result", ("check_type",)
+)
+SUBMIT_DURATION = metrics.registry.histogram("q_scheduler_submit_seconds", "Time to submit results to the proxy")
+SUBMIT_ERRORS = metrics.registry.counter("q_scheduler_submit_errors_total", "Failed submissions to the proxy")
+
+
+def get_options(config) -> dict:
+    """Returns the keyword arguments of ExecutorPool set in the scheduler config"""
+    return {
+        "plugin_options": plugins.get_options(config),
+        "host_concurrency": config.host_concurrency,
+        "check_type_concurrency": config.check_type_concurrency,
+        "host_down_attempts": config.host_down_attempts,
+        "limits": sandbox.get_limits(config),
+    }
+
+
+def host_key(check) -> str:
+    """Returns the host a check runs against, checks without a host are their own target"""
+    if check.context == "host":
+        return f"host:{check.id}"
+    if getattr(check, "linked_host", None) is not None:
+        return f"host:{check.linked_host}"
+    return f"{check.context}:{check.id}"
+
+
+def check_type(command: str) -> str:
+    """Returns the type of a check command, which is the probe scheme or the executable"""
+    if probes.is_probe(command):
+        return command.partition("://")[0]
+    if plugins.is_persistent(command):
+        command = command[len(plugins.PERSISTENT_PREFIX):]
+    try:
+        parts = shlex.split(command)
+    except ValueError:
+        parts = command.split()
+    return os.path.basename(parts[0]) if parts else ""
+
+
+class TargetQueue:
+    """Queued checks and statistics of one host"""
+
+    __slots__ = ("tasks", "deficit", "running", "dispatched", "wait_total", "wait_max")
+
+    def __init__(self):
+        self.tasks = deque()
+        self.deficit = 0.0
+        self.running = 0
+        self.dispatched = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
 
 class ExecutorPool:
-    def __init__(self, workers):
-        self.queue = []
+    """Runs the queued checks with a fixed number of workers.
+
+    Checks are queued per host and dispatched by deficit round robin, with the expected execution time of the check
+    type as cost. So a host with many or slow checks gets no larger share of the workers than any other host. A host
+    or check type, which reached its concurrency limit, is skipped until one of its checks finished.
+
+    :param workers: Number of concurrently running checks
+    :param submit: Coroutine function taking the encoded result, defaults to posting it to the proxy
+    :param plugin_options: Keyword arguments of the PluginManager of persistent plugins
+    :param host_concurrency: Maximum of concurrently running checks per host, 0 for no limit
+    :param check_type_concurrency: Maximum of concurrently running checks per check type, 0 for no limit
+    :param host_down_attempts: Critical results of a host without max_attempts after which its observables are
+    deferred, see dependencies
+    :param limits: Keyword arguments of the sandbox.Limits of check commands
+    """
+
+    def __init__(self, workers, submit=None, plugin_options=None, host_concurrency=0, check_type_concurrency=0,
+                 host_down_attempts=DEFAULT_DOWN_ATTEMPTS, limits=None):
         self.workers = workers
-        self.client = httpx.AsyncClient(
-            cert=("/var/lib/q/certs/q-scheduler-fullchain.pem", "/var/lib/q/certs/q-scheduler-privkey.pem")
+        self.dependencies = DependencyTracker(host_down_attempts)
+        self.retries = RetryTracker()
+        self.host_concurrency = host_concurrency
+        self.check_type_concurrency = check_type_concurrency
+        self.targets = {}
+        # Hosts with queued checks in round robin order
+        self.active = deque()
+        self.check_types = {}
+        self.running_types = {}
+        self.costs = {}
+        self.changed = asyncio.Event()
+        self.busy = 0
+        self.plugins = PluginManager(**(plugin_options or {}))
+        self.probes = ProbeRunner()
+        self.limits = sandbox.Limits(**(limits or {}))
+        # Set by the scheduler to record the results in its checkpoint
+        self.checkpoint = None
+        if submit is None:
+            self.client = httpx.AsyncClient(cert=CERT)
+            submit = self.post_result
+        self.submit = submit
+        self._register_metrics()
+
+    async def post_result(self, check_result: bytes):
+        start = time.monotonic()
+        try:
+            await self.client.post(
+                SUBMIT_URL, content=check_result, timeout=10, headers={"Content-Type": result.RESULT_CONTENT_TYPE}
+            )
+        finally:
+            SUBMIT_DURATION.observe(time.monotonic() - start)
+
+    def _register_metrics(self):
+        registry = metrics.registry
+        registry.gauge("q_scheduler_workers", "Number of workers", (), lambda: {(): self.workers})
+        registry.gauge("q_scheduler_workers_busy", "Workers running a check", (), lambda: {(): self.busy})
+        registry.gauge(
+            "q_scheduler_queued_checks", "Checks waiting for a worker", (),
+            lambda: {(): sum(len(x.tasks) for x in list(self.targets.values()))}
+        )
+        registry.gauge(
+            "q_scheduler_host_wait_seconds_total", "Summed queue wait of the checks of a host", ("host",),
+            lambda: {(key,): x.wait_total for key, x in list(self.targets.items())}, "counter"
+        )
+        registry.gauge(
+            "q_scheduler_host_starvation_seconds", "Wait of the oldest queued check of a host", ("host",),
+            lambda: {(key,): x["starvation_seconds"] for key, x in self.metrics().items() if x["queued"]}
+        )
+        registry.gauge(
+            "q_scheduler_hosts_down", "Hosts whose observables are deferred", (),
+            lambda: {(): self.dependencies.metrics()["hosts_down"]}
         )
+        registry.gauge(
+            "q_scheduler_deferred_checks", "Checks deferred until their host is up", (),
+            lambda: {(): self.dependencies.metrics()["deferred"]}
+        )
+        registry.gauge(
+            "q_scheduler_retries_total", "Retries of non ok checks", (),
+            lambda: {(): self.retries.retried}, "counter"
+        )
+        registry.gauge(
+            "q_scheduler_plugin_restarts_total", "Replaced persistent plugin processes", ("plugin",),
+            lambda: {(key,): x.restarts for key, x in list(self.plugins.pools.items())}, "counter"
+        )
+
+    def _check_type(self, task) -> str:
+        if task.linked_check not in self.check_types:
+            self.check_types[task.linked_check] = check_type(task.linked_check)
+        return self.check_types[task.linked_check]
 
     def append_task(self, task):
-        self.queue.append(task)
+        if self.dependencies.defer(task):
+            return
+        key = host_key(task)
+        target = self.targets.get(key)
+        if target is None:
+            target = self.targets[key] = TargetQueue()
+        if not target.tasks:
+            self.active.append(key)
+        target.tasks.append((time.monotonic(), task))
+        self.changed.set()
+
+    def restore(self, check, state: str, attempts: int):
+        """Restores the state of a check from the checkpoint"""
+        self.retries.restore(check, state, attempts)
+        self.dependencies.restore(check, state, attempts)
+
+    def _retry(self, task):
+        self.retries.retrying(task)
+        self.append_task(task)
+
+    def _limited(self, target: TargetQueue, task) -> bool:
+        if self.host_concurrency and target.running >= self.host_concurrency:
+            return True
+        return bool(self.check_type_concurrency) and \
+            self.running_types.get(self._check_type(task), 0) >= self.check_type_concurrency
+
+    def _next_task(self):
+        """Returns the key and the next task by deficit round robin, None if every queued host is limited"""
+        skipped = 0
+        while self.active and skipped < len(self.active):
+            key = self.active[0]
+            target = self.targets[key]
+            enqueued, task = target.tasks[0]
+            if self._limited(target, task):
+                self.active.rotate(-1)
+                skipped += 1
+                continue
+            # Until a check type ran once, its checks cost a whole quantum
+            cost = self.costs.get(self._check_type(task), QUANTUM)
+            if target.deficit < cost:
+                # The host used its share of this round
+                target.deficit += QUANTUM
+                self.active.rotate(-1)
+                continue
+            target.deficit -= cost
+            target.tasks.popleft()
+            if not target.tasks:
+                self.active.popleft()
+                target.deficit = 0.0
+            wait = time.monotonic() - enqueued
+            QUEUE_WAIT.observe(wait, (self._check_type(task),))
+            target.dispatched += 1
+            target.wait_total += wait
+            target.wait_max = max(target.wait_max, wait)
+            return key, task
+        return None
 
     async def worker(self):
         while True:
-            if self.queue:
-                task = self.queue.pop()
-                await Worker(task, self.client).run()
+            selected = self._next_task()
+            if selected is None:
+                self.changed.clear()
+                await self.changed.wait()
+                continue
+            key, task = selected
+            target = self.targets[key]
+            name = self._check_type(task)
+            target.running += 1
+            self.running_types[name] = self.running_types.get(name, 0) + 1
+            self.busy += 1
+            start = time.monotonic()
+            try:
+                worker = Worker(task, self.submit, self.plugins, self.probes, self.limits)
+                check_result, encoded = await worker.execute()
+                CHECK_RESULTS.inc((name, check_result["state"]))
+                for x in self.dependencies.update(task, check_result["state"]):
+                    self.append_task(x)
+                retry = self.retries.update(task, check_result["state"])
+                if self.checkpoint is not None:
+                    self.checkpoint.set_result(
+                        task, check_result["state"], self.retries.attempts.get((task.context, task.id), 0)
+                    )
+                if retry is not None:
+                    asyncio.get_running_loop().call_later(retry, self._retry, task)
+            except Exception as err:
+                CHECK_ERRORS.inc((name,))
+                logger.exception(f"Check {task.context} {task.id} failed: {err}")
             else:
-                await asyncio.sleep(0.1)
+                # The state of the check is recorded whether or not its result reaches the proxy
+                try:
+                    await self.submit(encoded)
+                except Exception as err:
+                    SUBMIT_ERRORS.inc()
+                    logger.error(f"Could not submit the result of {task.context} {task.id}: {err}")
+            finally:
+                elapsed = time.monotonic() - start
+                CHECK_DURATION.observe(elapsed, (name,))
+                elapsed = min(max(elapsed, MIN_COST), MAX_COST)
+                self.costs[name] = self.costs.get(name, elapsed) * (1 - COST_SMOOTHING) + elapsed * COST_SMOOTHING
+                target.running -= 1
+                self.running_types[name] -= 1
+                self.busy -= 1
+                self.changed.set()
+
+    def metrics(self) -> dict:
+        """Returns queue statistics per host. starvation is the time the oldest queued check of the host waits."""
+        now = time.monotonic()
+        return {key: {
+            "queued": len(x.tasks),
+            "running": x.running,
+            "dispatched": x.dispatched,
+            "wait_seconds_total": round(x.wait_total, 3),
+            "wait_seconds_max": round(x.wait_max, 3),
+            "starvation_seconds": round(now - x.tasks[0][0], 3) if x.tasks else 0.0,
+        } for key, x in self.targets.items()}
 
     async def run(self):
         worker_list = [asyncio.create_task(self.worker()) for _ in range(self.workers)]
         await asyncio.wait(worker_list)
-
-
-
@@ -1,14 +1,25 @@
-import datetime
-
-
-def get_weekday():
-    mapping = {
-        0: "Monday",
-        1: "Tuesday",
-        2: "Wednesday",
-        3: "Thursday",
-        4: "Friday",
-        5: "Saturday",
-        6: "Sunday"
-    }
-    return mapping[datetime.datetime.utcnow().weekday()]
+import logging
+import time
+
+LOG_FILE = "/var/log/q-scheduler/scheduler.log"
+
+MINUTES_PER_DAY = 1440
+MINUTES_PER_WEEK = 7 * MINUTES_PER_DAY
+# The unix epoch was a thursday
+EPOCH_MINUTE_OF_WEEK = 3 * MINUTES_PER_DAY
+
+
+def minute_of_week(timestamp: float) -> int:
+    """Returns the minute of the week in UTC of a unix timestamp, 0 is monday 00:00"""
+    return (int(timestamp) // 60 + EPOCH_MINUTE_OF_WEEK) % MINUTES_PER_WEEK
+
+
+def configure_logging():
+    """Configures the log of the scheduler. Called by main and by every shard, as spawned shards do not run main."""
+    logging.basicConfig(
+        filename=LOG_FILE,
+        format='%(asctime)s :: %(levelname)s: %(message)s',
+        datefmt='%d-%m-%Y %H:%M:%S',
+        level=logging.DEBUG
+    )
+    logging.Formatter.converter = time.gmtime
@@ -0,0 +1,132 @@
+"""Streaming loader of the declaration.
+
+The declaration is read in chunks and every entry of the hosts and observables lists is decoded on its own and
+converted to a Check right away, so the decoded JSON of the whole declaration is never held in memory. Scheduling
+periods are keyed by their integer id.
+"""
+import json
+import re
+
+from objects import Check, SchedulingPeriod
+
+CHUNK_SIZE = 1 << 20
+# Lists of checks in the declaration and the context of their results. Declarations of older cores name the
+# observables metrics
+CHECK_LISTS = {"hosts": "host", "observables": "metric", "metrics": "metric"}
+
+_scan = json.JSONDecoder().scan_once
+_whitespace = re.compile(r"[ \t\n\r]*")
+_separator = re.compile(r"[ \t\n\r]*([,:\]}])[ \t\n\r]*")
+
+
+class Declaration:
+    __slots__ = ("scheduling_periods", "checks")
+
+    def __init__(self, scheduling_periods: dict, checks: list):
+        self.scheduling_periods = scheduling_periods
+        self.checks = checks
+
+
+class _Reader:
+    """Decodes consecutive JSON values from a file object, reading further chunks when a value is incomplete"""
+
+    def __init__(self, fh):
+        self.fh = fh
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self) -> bool:
+        if self.eof:
+            return False
+        chunk = self.fh.read(CHUNK_SIZE)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self) -> str:
+        """Skips whitespace and returns the next character, "" at the end of the file"""
+        while True:
+            self.pos = _whitespace.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                return ""
+
+    def expect(self, characters: str) -> str:
+        """Consumes the next character, which has to be one of characters, and the whitespace around it"""
+        match = _separator.match(self.buffer, self.pos)
+        if match is not None and match.end() < len(self.buffer) and match.group(1) in characters:
+            self.pos = match.end()
+            return match.group(1)
+        character = self.peek()
+        if not character or character not in characters:
+            raise ValueError(f"Expected one of {characters!r} instead of {character!r} in the declaration")
+        self.pos += 1
+        self.peek()
+        return character
+
+    def value(self):
+        while True:
+            try:
+                value, end = _scan(self.buffer, self.pos)
+            except (StopIteration, json.JSONDecodeError):
+                value, end = None, None
+            # A number at the end of the buffer may continue in the next chunk
+            if end is not None and (end < len(self.buffer) or self.eof):
+                self.pos = end
+                return value
+            start = self.pos
+            self.pos = _whitespace.match(self.buffer, self.pos).end()
+            if self.pos != start or self._fill():
+                continue
+            if end is not None:
+                self.pos = end
+                return value
+            raise ValueError(f"Invalid value at {self.buffer[self.pos:self.pos + 32]!r} in the declaration")
+
+
+def _items(reader: _Reader):
+    """Yields the values of a list"""
+    reader.expect("[")
+    if reader.peek() == "]":
+        reader.pos += 1
+        return
+    while True:
+        yield reader.value()
+        if reader.expect(",]") == "]":
+            return
+
+
+def load_declaration(path: str, accept=None) -> Declaration:
+    """Loads the declaration at path.
+
+    :param accept: Optional function taking the name of the list and the decoded entry, only checks for which it
+    returns True are loaded
+    :raises ValueError: If the declaration is no valid JSON
+    """
+    scheduling_periods = {}
+    checks = []
+    with open(path, encoding="utf-8") as fh:
+        reader = _Reader(fh)
+        reader.expect("{")
+        if reader.peek() == "}":
+            return Declaration(scheduling_periods, checks)
+        while True:
+            key = reader.value()
+            reader.expect(":")
+            if key in CHECK_LISTS and reader.peek() == "[":
+                context = CHECK_LISTS[key]
+                for x in _items(reader):
+                    if accept is None or accept(key, x):
+                        checks.append(Check(**x, context=context))
+            elif key == "scheduling_periods":
+                scheduling_periods = {int(x): SchedulingPeriod(**y) for x, y in reader.value().items()}
+            else:
+                reader.value()
+            if reader.expect(",}") == "}":
+                break
+    return Declaration(scheduling_periods, checks)
@@ -1,16 +1,18 @@
 import asyncio
-import json
 import logging
 import os
-import time
 from signal import signal, SIGINT
 
 import certifi
 
+import checkpoint
+import executor
+import metrics
 from config import SchedulerConfig
-from objects import SchedulingPeriod, Check
-from executor import ExecutorPool
-from scheduler import Scheduler
+from helper import configure_logging
+from loader import load_declaration
+from scheduler import start_scheduler
+from shard import Supervisor
 
 logger = logging.getLogger("scheduler")
 
@@ -31,47 +33,29 @@ def handle_sigkill(signal_received, frame):
     exit(0)
 
 
-async def start_scheduler(declaration, config):
-    scheduling_periods = {}
-    checks = []
-    for x in declaration["scheduling_periods"]:
-        scheduling_periods[x] = SchedulingPeriod(**declaration["scheduling_periods"][x])
-    for x in declaration["hosts"]:
-        checks.append(Check(**x, context="host"))
-    for x in declaration["metrics"]:
-        checks.append(Check(**x, context="metric"))
-    # If no checks are scheduled, run forever to not cause the systemd unit to fail
-    if not checks:
-        while True:
-            await asyncio.sleep(5)
-
-    ex_pool = ExecutorPool(config.workers)
-    s = Scheduler(checks, scheduling_periods, ex_pool)
-    asyncio.create_task(ex_pool.run())
-    await asyncio.create_task(s.run())
-
-
 def main():
     append_ca_bundle()
     config = SchedulerConfig.from_json("/etc/q-scheduler/q-scheduler.json")
+    if config.shards != 1:
+        Supervisor(config).run()
+        return
     if os.path.exists(config["declaration_path"]) and os.path.isfile(config["declaration_path"]):
         try:
-            with open(config.declaration_path) as fh:
-                declaration = json.load(fh)
-                asyncio.get_event_loop().run_until_complete(start_scheduler(declaration, config))
-        except json.JSONDecodeError:
+            declaration = load_declaration(config.declaration_path)
+        except ValueError:
             logging.info("Could not decode json")
+            return
+        if config.metrics_address:
+            metrics.serve(config.metrics_address)
+        asyncio.get_event_loop().run_until_complete(start_scheduler(
+            declaration, config.workers, options=executor.get_options(config),
+            checkpoint_options=checkpoint.get_options(config)
+        ))
     else:
         logging.error(f"Description was not found at {config.declaration_path}")
 
 
 if __name__ == '__main__':
-    logging.basicConfig(
-        filename="/var/log/q-scheduler/scheduler.log",
-        format='%(asctime)s :: %(levelname)s: %(message)s',
-        datefmt='%d-%m-%Y %H:%M:%S',
-        level=logging.DEBUG
-    )
-    logging.Formatter.converter = time.gmtime
+    configure_logging()
     signal(SIGINT, handle_sigkill)
     main()
@@ -0,0 +1,187 @@
+"""Metrics of the scheduler in the Prometheus text format.
+
+Counters and histograms are plain lists and dicts, which are only written by the thread running the event loop. The
+endpoint renders them from its own thread without locking, so a scrape may see an update of a histogram half applied,
+which is fine for monitoring and costs the hot path nothing.
+
+The endpoint is enabled with metrics_address in the config, either "host:port" or "unix:/path/of/socket".
+"""
+import bisect
+import logging
+import os
+import socketserver
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _labels(names, values, extra="") -> str:
+    pairs = [f'{x}="{_escape(y)}"' for x, y in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    __slots__ = ("name", "help", "labelnames", "values")
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.values = {}
+
+    def inc(self, labels=(), value=1):
+        self.values[labels] = self.values.get(labels, 0) + value
+
+    def render(self, lines: list):
+        lines.append(f"# HELP {self.name} {self.help}")
+        lines.append(f"# TYPE {self.name} counter")
+        for labels, value in list(self.values.items()):
+            lines.append(f"{self.name}{_labels(self.labelnames, labels)} {_number(value)}")
+
+
+class Gauge:
+    """Metric whose values are read from callback on every scrape, callback returns a mapping of labels -> value.
+
+    kind may be "counter" for counts which are maintained by another component.
+    """
+
+    __slots__ = ("name", "help", "labelnames", "callback", "kind")
+
+    def __init__(self, name, help, labelnames, callback, kind="gauge"):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.callback = callback
+        self.kind = kind
+
+    def render(self, lines: list):
+        lines.append(f"# HELP {self.name} {self.help}")
+        lines.append(f"# TYPE {self.name} {self.kind}")
+        for labels, value in list(self.callback().items()):
+            lines.append(f"{self.name}{_labels(self.labelnames, labels)} {_number(value)}")
+
+
+class Histogram:
+    __slots__ = ("name", "help", "labelnames", "buckets", "values")
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = buckets
+        # labels -> [count per bucket..., count above the last bucket, sum]
+        self.values = {}
+
+    def observe(self, value, labels=()):
+        counts = self.values.get(labels)
+        if counts is None:
+            counts = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def render(self, lines: list):
+        lines.append(f"# HELP {self.name} {self.help}")
+        lines.append(f"# TYPE {self.name} histogram")
+        for labels, counts in list(self.values.items()):
+            counts = list(counts)
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                le = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, labels, le)} {cumulative}")
+            cumulative += counts[-2]
+            le = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{_labels(self.labelnames, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {_number(counts[-1])}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, labels)} {cumulative}")
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+
+    def counter(self, name, help, labelnames=()) -> Counter:
+        return self.metrics.setdefault(name, Counter(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self.metrics.setdefault(name, Histogram(name, help, labelnames, buckets))
+
+    def gauge(self, name, help, labelnames, callback, kind="gauge") -> Gauge:
+        """Registers a gauge, an existing gauge of the same name is replaced"""
+        self.metrics[name] = Gauge(name, help, labelnames, callback, kind)
+        return self.metrics[name]
+
+    def render(self) -> str:
+        lines = []
+        for x in list(self.metrics.values()):
+            try:
+                x.render(lines)
+            except Exception as err:
+                logger.error(f"Could not render {x.name}: {err}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = super().get_request()
+        # BaseHTTPRequestHandler expects a host and port
+        return request, ("unix", 0)
+
+
+def shard_address(address: str, index: int) -> str:
+    """Returns the address of the endpoint of a shard, the supervisor uses address itself"""
+    if address.startswith("unix:"):
+        return f"{address}.{index}"
+    host, _, port = address.rpartition(":")
+    return f"{host}:{int(port) + 1 + index}"
+
+
+def serve(address: str):
+    """Serves the metrics at address from a daemon thread"""
+    if address.startswith("unix:"):
+        path = address[len("unix:"):]
+        if os.path.exists(path):
+            os.unlink(path)
+        server = _UnixHTTPServer(path, _Handler)
+    else:
+        host, _, port = address.rpartition(":")
+        server = ThreadingHTTPServer((host or "127.0.0.1", int(port)), _Handler)
+        server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logger.info(f"Serving metrics at {address}")
+    return server
@@ -1,14 +1,95 @@
+import sys
+from array import array
+
+from helper import MINUTES_PER_DAY, MINUTES_PER_WEEK, minute_of_week
+
+WEEKDAYS = ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"]
+
+
+def _minute(value) -> int:
+    """Converts a time of the form HHMM to the minute of the day, 2400 is the last minute"""
+    value = int(value)
+    return min(value // 100 * 60 + value % 100, MINUTES_PER_DAY - 1)
+
+
 class SchedulingPeriod:
+    """Time period compiled to one flag per minute of the week.
+
+    For every minute the distance to the next minute inside the period is precomputed, so membership and the start of
+    the next window are both single lookups. Start and stop time of a period are included.
+    """
+
+    __slots__ = ("id", "name", "time_periods", "minutes", "waits")
+
     def __init__(self, id, name, comment, time_periods):
         self.id = id
         self.name = name
         self.time_periods = time_periods
+        self.minutes = self._compile(time_periods)
+        self.waits = self._waits(self.minutes)
+
+    @staticmethod
+    def _compile(time_periods: dict) -> bytearray:
+        minutes = bytearray(MINUTES_PER_WEEK)
+        for day, periods in time_periods.items():
+            if day.lower() not in WEEKDAYS:
+                continue
+            offset = WEEKDAYS.index(day.lower()) * MINUTES_PER_DAY
+            for period in periods:
+                start, stop = _minute(period["start_time"]), _minute(period["stop_time"])
+                if start <= stop:
+                    minutes[offset + start:offset + stop + 1] = b"\x01" * (stop - start + 1)
+        return minutes
+
+    @staticmethod
+    def _waits(minutes: bytearray):
+        """Returns the number of minutes from every minute to the next one inside the period, None for an empty one"""
+        if not any(minutes):
+            return None
+        waits = array("L", [0] * MINUTES_PER_WEEK)
+        distance = 0
+        # Two passes backwards, so minutes after the last window of the week see the first one of the next week
+        for i in range(2 * MINUTES_PER_WEEK - 1, -1, -1):
+            distance = 0 if minutes[i % MINUTES_PER_WEEK] else distance + 1
+            waits[i % MINUTES_PER_WEEK] = distance
+        return waits
+
+    def contains(self, timestamp: float) -> bool:
+        return bool(self.minutes[minute_of_week(timestamp)])
+
+    def next_window(self, timestamp: float):
+        """Returns the seconds until the next window of the period starts, 0 inside of a window and None if the period
+        is empty"""
+        if self.waits is None:
+            return None
+        wait = self.waits[minute_of_week(timestamp)]
+        return wait * 60 - timestamp % 60 if wait else 0
 
 
 class Check:
-    def __init__(self, id, linked_check, scheduling_period, scheduling_interval, context):
+    """Scheduled check of a host or an observable.
+
+    Many checks share the executable and the leading arguments of their command. The command is split before its last
+    argument and the prefix is interned, so equal prefixes are stored once.
+    """
+
+    __slots__ = (
+        "id", "context", "prefix", "suffix", "scheduling_period", "scheduling_interval", "linked_host",
+        "retry_interval", "max_attempts"
+    )
+
+    def __init__(self, id, linked_check, scheduling_period, scheduling_interval, context, linked_host=None,
+                 retry_interval=None, max_attempts=None):
         self.id = id
-        self.linked_check = linked_check
-        self.scheduling_period = scheduling_period
+        self.context = sys.intern(context)
+        prefix, separator, self.suffix = linked_check.rpartition(" ")
+        self.prefix = sys.intern(prefix + separator)
+        self.scheduling_period = int(scheduling_period)
         self.scheduling_interval = scheduling_interval
-        self.context = context
+        self.linked_host = linked_host
+        self.retry_interval = retry_interval
+        self.max_attempts = max_attempts
+
+    @property
+    def linked_check(self) -> str:
+        return self.prefix + self.suffix
@@ -0,0 +1,153 @@
+"""Persistent check plugins.
+
+Checks whose linked_check starts with "persistent:" are not started per execution. The rest of the command is split
+into the executable and its arguments. Per executable a pool of plugin processes is kept, which read one request per
+line on stdin and answer with one line on stdout:
+
+    request:  {"id": 1, "arguments": ["--host", "example.org"]}
+    response: {"id": 1, "state": "ok", "output": "...", "datasets": [...]}
+
+The response has to match the plugin result schema. A process is replaced when it exits, times out or answered
+max_requests requests.
+
+Plugin processes do not run within the check limits of the sandbox. They serve many checks, so their cpu time and
+memory would add up over all of their requests. timeout and max_requests bound them instead.
+"""
+import asyncio
+import json
+import logging
+import shlex
+
+import result
+
+logger = logging.getLogger(__name__)
+
+PERSISTENT_PREFIX = "persistent:"
+DEFAULT_POOL_SIZE = 2
+DEFAULT_MAX_REQUESTS = 1000
+DEFAULT_TIMEOUT = 30.0
+
+
+class PluginError(RuntimeError):
+    pass
+
+
+def get_options(config) -> dict:
+    """Returns the keyword arguments of PluginManager set in the scheduler config"""
+    return {
+        "size": config.plugin_processes,
+        "max_requests": config.plugin_max_requests,
+        "timeout": config.plugin_timeout,
+    }
+
+
+def is_persistent(command: str) -> bool:
+    return command.startswith(PERSISTENT_PREFIX)
+
+
+def split_command(command: str):
+    """Returns the executable and the arguments of a persistent command"""
+    parts = shlex.split(command[len(PERSISTENT_PREFIX):])
+    if not parts:
+        raise PluginError("No plugin given")
+    return parts[0], parts[1:]
+
+
+class PluginProcess:
+    def __init__(self, executable: str):
+        self.executable = executable
+        self.process = None
+        self.requests = 0
+
+    async def start(self):
+        self.process = await asyncio.create_subprocess_exec(
+            self.executable, stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE,
+            limit=result.MAX_RESULT_BYTES * 2
+        )
+
+    @property
+    def alive(self) -> bool:
+        return self.process is not None and self.process.returncode is None
+
+    async def request(self, arguments: list, timeout: float) -> dict:
+        self.requests += 1
+        request_id = self.requests
+        self.process.stdin.write(json.dumps({"id": request_id, "arguments": arguments}).encode("utf-8") + b"\n")
+        await self.process.stdin.drain()
+        line = await asyncio.wait_for(self.process.stdout.readline(), timeout)
+        if not line:
+            raise PluginError(f"Plugin {self.executable} exited with {await self.process.wait()}")
+        try:
+            response = json.loads(line)
+        except ValueError:
+            raise PluginError(f"Response of plugin {self.executable} is no valid JSON")
+        if not isinstance(response, dict) or response.pop("id", None) != request_id:
+            raise PluginError(f"Plugin {self.executable} answered out of order")
+        return response
+
+    def stop(self):
+        if self.alive:
+            self.process.kill()
+
+
+class PluginPool:
+    """Processes of one plugin. At most size requests run concurrently, further requests wait for a free process."""
+
+    def __init__(self, executable: str, size=DEFAULT_POOL_SIZE, max_requests=DEFAULT_MAX_REQUESTS,
+                 timeout=DEFAULT_TIMEOUT):
+        self.executable = executable
+        self.max_requests = max_requests
+        self.timeout = timeout
+        self.idle = []
+        self.slots = asyncio.Semaphore(size)
+        self.restarts = 0
+
+    async def request(self, arguments: list) -> dict:
+        async with self.slots:
+            plugin = self.idle.pop() if self.idle else None
+            if plugin is None or not plugin.alive:
+                plugin = PluginProcess(self.executable)
+                await plugin.start()
+            try:
+                response = await plugin.request(arguments, self.timeout)
+            except asyncio.TimeoutError:
+                plugin.stop()
+                self.restarts += 1
+                raise PluginError(f"Plugin {self.executable} did not answer within {self.timeout}s")
+            except (PluginError, ConnectionError, ValueError) as err:
+                plugin.stop()
+                self.restarts += 1
+                raise PluginError(str(err))
+            if plugin.requests >= self.max_requests:
+                plugin.stop()
+            else:
+                self.idle.append(plugin)
+            return response
+
+
+class PluginManager:
+    def __init__(self, size=DEFAULT_POOL_SIZE, max_requests=DEFAULT_MAX_REQUESTS, timeout=DEFAULT_TIMEOUT):
+        self.size = size
+        self.max_requests = max_requests
+        self.timeout = timeout
+        self.pools = {}
+
+    async def run(self, command: str) -> dict:
+        """Runs a persistent command and returns the validated plugin result
+
+        :raises result.SchemaError: If the plugin can not be run or its answer is invalid
+        """
+        try:
+            executable, arguments = split_command(command)
+        except ValueError as err:
+            raise result.SchemaError(f"Command could not be parsed: {err}")
+        except PluginError as err:
+            raise result.SchemaError(str(err))
+        if executable not in self.pools:
+            self.pools[executable] = PluginPool(executable, self.size, self.max_requests, self.timeout)
+        try:
+            response = await self.pools[executable].request(arguments)
+        except (PluginError, OSError) as err:
+            raise result.SchemaError(str(err))
+        result.PLUGIN_SCHEMA(response, "result")
+        return response
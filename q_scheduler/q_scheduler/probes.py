@@ -0,0 +1,232 @@
+"""Built-in network probes.
+
+Checks whose linked_check is an URI of one of the following schemes are run inside the event loop instead of a
+subprocess:
+
+    tcp://host:port                 Connects to the port
+    ping://host                     Sends ICMP echo requests, needs net.ipv4.ping_group_range to include the group
+    dns://server:port/name          Queries server for name, without a server the first nameserver of resolv.conf
+    http://... and https://...      Requests the URL, HTTP connections are shared by all probes
+
+Options are given as fragment of the URI, e.g. "tcp://example.org:22#warning=0.5&critical=2":
+
+    timeout     Seconds until the probe fails, defaults to 10
+    warning     Response time in seconds from which on the state is warning
+    critical    Response time in seconds from which on the state is critical
+    count       Echo requests sent by ping, defaults to 3
+    type        Record type queried by dns, defaults to A
+    status      Expected status code of http, defaults to any status below 400
+
+Probes return the same result as a plugin, the response time is reported as dataset "time".
+"""
+import asyncio
+import random
+import socket
+import struct
+import time
+from urllib.parse import urlsplit, parse_qsl
+
+import httpx
+
+import result
+
+SCHEMES = ("tcp", "ping", "dns", "http", "https")
+DEFAULT_TIMEOUT = 10.0
+DEFAULT_PING_COUNT = 3
+# Connections of the shared HTTP client
+HTTP_MAX_CONNECTIONS = 1000
+HTTP_MAX_KEEPALIVE = 200
+RESOLV_CONF = "/etc/resolv.conf"
+DNS_TYPES = {"A": 1, "NS": 2, "CNAME": 5, "SOA": 6, "PTR": 12, "MX": 15, "TXT": 16, "AAAA": 28, "SRV": 33}
+DNS_RCODES = {1: "FORMERR", 2: "SERVFAIL", 3: "NXDOMAIN", 4: "NOTIMP", 5: "REFUSED"}
+
+
+class ProbeError(Exception):
+    """Raised by probes if the target could not be reached, results in the state critical"""
+
+
+def is_probe(command: str) -> bool:
+    return command.partition("://")[0] in SCHEMES
+
+
+def _parse_options(fragment: str) -> dict:
+    """Returns the options of a probe URI, converted to their types
+
+    :raises ValueError: If an option has an invalid value
+    """
+    options = dict(parse_qsl(fragment))
+    options["timeout"] = float(options.get("timeout", DEFAULT_TIMEOUT))
+    if not 0 < options["timeout"] < float("inf"):
+        raise ValueError(f"timeout has to be a positive number of seconds, not {options['timeout']}")
+    for name in ("warning", "critical"):
+        if name in options:
+            options[name] = float(options[name])
+            if not options[name] >= 0:
+                raise ValueError(f"{name} has to be a number of seconds, not {options[name]}")
+    options["count"] = int(options.get("count", DEFAULT_PING_COUNT))
+    if options["count"] <= 0:
+        raise ValueError(f"count has to be positive, not {options['count']}")
+    if "status" in options:
+        options["status"] = int(options["status"])
+    return options
+
+
+def _time_state(elapsed: float, options: dict) -> str:
+    if "critical" in options and elapsed >= options["critical"]:
+        return "critical"
+    if "warning" in options and elapsed >= options["warning"]:
+        return "warning"
+    return "ok"
+
+
+def _nameserver() -> str:
+    try:
+        with open(RESOLV_CONF) as fh:
+            for line in fh:
+                parts = line.split()
+                if len(parts) > 1 and parts[0] == "nameserver":
+                    return parts[1]
+    except OSError:
+        pass
+    return "127.0.0.1"
+
+
+def _dns_query(query_id: int, name: str, record_type: int) -> bytes:
+    question = b"".join(bytes([len(x)]) + x.encode("idna") for x in name.strip(".").split(".") if x)
+    # Recursion desired, one question
+    header = struct.pack("!HHHHHH", query_id, 0x0100, 1, 0, 0, 0)
+    return header + question + b"\x00" + struct.pack("!HH", record_type, 1)
+
+
+class ProbeRunner:
+    """Runs the built-in probes. Holds the HTTP client, so it has to be used inside a single event loop."""
+
+    def __init__(self):
+        self._client = None
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(limits=httpx.Limits(
+                max_connections=HTTP_MAX_CONNECTIONS, max_keepalive_connections=HTTP_MAX_KEEPALIVE
+            ))
+        return self._client
+
+    async def run(self, command: str) -> dict:
+        """Runs the probe of command and returns its result
+
+        :raises result.SchemaError: If the URI is invalid
+        """
+        try:
+            uri = urlsplit(command.strip())
+            options = _parse_options(uri.fragment)
+            timeout = options["timeout"]
+            probe = getattr(self, f"_probe_{uri.scheme if uri.scheme != 'https' else 'http'}")
+        except (ValueError, AttributeError) as err:
+            raise result.SchemaError(f"Probe {command} is invalid: {err}")
+        start = time.perf_counter()
+        try:
+            output = await asyncio.wait_for(probe(uri, options, timeout), timeout)
+        except asyncio.TimeoutError:
+            return {"state": "critical", "output": f"{uri.scheme} probe timed out after {timeout}s"}
+        except (ProbeError, OSError, httpx.HTTPError) as err:
+            return {"state": "critical", "output": f"{uri.scheme} probe failed: {err}"[:result.MAX_OUTPUT_LENGTH]}
+        except ValueError as err:
+            raise result.SchemaError(f"Probe {command} is invalid: {err}")
+        if isinstance(output, dict):
+            return output
+        elapsed = time.perf_counter() - start
+        return {
+            "state": _time_state(elapsed, options),
+            "output": f"{output} in {elapsed:.3f}s"[:result.MAX_OUTPUT_LENGTH],
+            "datasets": [{"name": "time", "value": round(elapsed, 6), "unit": "s"}],
+        }
+
+    async def _probe_tcp(self, uri, options, timeout):
+        if uri.port is None:
+            raise ValueError("tcp needs a port")
+        _, writer = await asyncio.open_connection(uri.hostname, uri.port)
+        writer.close()
+        await writer.wait_closed()
+        return f"Connected to {uri.hostname}:{uri.port}"
+
+    async def _probe_http(self, uri, options, timeout):
+        response = await self.client.get(uri._replace(fragment="").geturl(), timeout=timeout)
+        expected = options.get("status")
+        if expected is not None and response.status_code != expected:
+            raise ProbeError(f"Status {response.status_code}, expected {expected}")
+        if expected is None and response.status_code >= 400:
+            raise ProbeError(f"Status {response.status_code}")
+        return f"Status {response.status_code}"
+
+    async def _probe_dns(self, uri, options, timeout):
+        record_type = options.get("type", "A").upper()
+        if record_type not in DNS_TYPES:
+            raise ValueError(f"Unknown record type {record_type}")
+        name = uri.path.strip("/")
+        if not name:
+            raise ValueError("dns needs a name")
+        server = (uri.hostname or _nameserver(), uri.port or 53)
+        loop = asyncio.get_running_loop()
+        family, _, _, _, address = (await loop.getaddrinfo(*server, type=socket.SOCK_DGRAM))[0]
+        query_id = random.getrandbits(16)
+        with socket.socket(family, socket.SOCK_DGRAM) as sock:
+            sock.setblocking(False)
+            await loop.sock_connect(sock, address)
+            await loop.sock_sendall(sock, _dns_query(query_id, name, DNS_TYPES[record_type]))
+            while True:
+                response = await loop.sock_recv(sock, 4096)
+                if len(response) >= 12 and struct.unpack("!H", response[:2])[0] == query_id:
+                    break
+        _, flags, _, answers, _, _ = struct.unpack("!HHHHHH", response[:12])
+        rcode = flags & 0x000F
+        if rcode:
+            raise ProbeError(f"{server[0]} answered {DNS_RCODES.get(rcode, rcode)} for {name} {record_type}")
+        if not answers:
+            raise ProbeError(f"{server[0]} has no {record_type} record for {name}")
+        return f"{answers} answer(s) from {server[0]} for {name} {record_type}"
+
+    async def _probe_ping(self, uri, options, timeout):
+        count = options["count"]
+        loop = asyncio.get_running_loop()
+        family, _, _, _, address = (await loop.getaddrinfo(uri.hostname, None, type=socket.SOCK_DGRAM))[0]
+        if family == socket.AF_INET6:
+            protocol, echo_request, echo_reply = socket.IPPROTO_ICMPV6, 128, 129
+        else:
+            protocol, echo_request, echo_reply = socket.IPPROTO_ICMP, 8, 0
+        rtts = []
+        # Unprivileged ICMP sockets, the kernel sets the identifier and the checksum
+        with socket.socket(family, socket.SOCK_DGRAM, protocol) as sock:
+            sock.setblocking(False)
+            await loop.sock_connect(sock, address)
+            for sequence in range(count):
+                start = time.perf_counter()
+                await loop.sock_sendall(sock, struct.pack("!BBHHH", echo_request, 0, 0, 0, sequence) + b"q" * 56)
+                try:
+                    await asyncio.wait_for(self._echo_reply(sock, echo_reply, sequence), timeout / count)
+                except asyncio.TimeoutError:
+                    continue
+                rtts.append(time.perf_counter() - start)
+        if not rtts:
+            raise ProbeError(f"No reply from {uri.hostname}")
+        average = sum(rtts) / len(rtts)
+        loss = 100 * (count - len(rtts)) / count
+        state = _time_state(average, options)
+        if loss and state == "ok":
+            state = "warning"
+        return {
+            "state": state,
+            "output": f"{uri.hostname}: {loss:.0f}% packet loss, rtt avg {average * 1000:.3f}ms",
+            "datasets": [
+                {"name": "time", "value": round(average, 6), "unit": "s"},
+                {"name": "loss", "value": loss, "unit": "%"},
+            ],
+        }
+
+    @staticmethod
+    async def _echo_reply(sock, echo_reply, sequence):
+        loop = asyncio.get_running_loop()
+        while True:
+            packet = await loop.sock_recv(sock, 1024)
+            if len(packet) >= 8 and packet[0] == echo_reply and struct.unpack("!H", packet[6:8])[0] == sequence:
+                return
@@ -0,0 +1,43 @@
+"""Retries of non ok checks.
+
+A check with a retry_interval, whose result is not ok, is run again after retry_interval seconds instead of waiting for
+its next scheduling interval. Retries stop once max_attempts non ok results were returned in a row, as the core
+considers the state hard then, or when the check returns ok again. Checks without retry_interval are not retried.
+"""
+# Same default as the state machine of the core
+DEFAULT_MAX_ATTEMPTS = 3
+
+
+class RetryTracker:
+    def __init__(self):
+        # (context, id) -> number of consecutive non ok results
+        self.attempts = {}
+        self.pending = set()
+        self.retried = 0
+
+    def update(self, check, state: str):
+        """Records the result of a check. Returns the seconds after which it has to be retried or None."""
+        key = (check.context, check.id)
+        if state == "ok":
+            self.attempts.pop(key, None)
+            return None
+        self.attempts[key] = self.attempts.get(key, 0) + 1
+        if not check.retry_interval or key in self.pending:
+            return None
+        if self.attempts[key] >= (check.max_attempts or DEFAULT_MAX_ATTEMPTS):
+            return None
+        self.pending.add(key)
+        self.retried += 1
+        return check.retry_interval
+
+    def restore(self, check, state: str, attempts: int):
+        """Restores the consecutive non ok results of a check from a checkpoint"""
+        if state is not None and state != "ok" and attempts:
+            self.attempts[(check.context, check.id)] = attempts
+
+    def retrying(self, check):
+        """Marks the retry of the check as started"""
+        self.pending.discard((check.context, check.id))
+
+    def metrics(self) -> dict:
+        return {"retrying": len(self.pending), "retried": self.retried}
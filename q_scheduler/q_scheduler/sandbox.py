@@ -0,0 +1,268 @@
+"""Limited execution of check commands.
+
+Commands run in their own session, which is killed once the command exited or exceeded one of its limits:
+
+    wall_time       Seconds until the check is killed
+    cpu_time        CPU seconds of every process of the check, set as RLIMIT_CPU by ulimit
+    memory          Bytes of memory, the memory.max of a cgroup if cgroup_root is set, else RLIMIT_AS of every process
+                    set by ulimit
+    output_bytes    Bytes read from stdout, further output kills the check
+
+0 disables a limit. With cgroup_root, which has to be a delegated cgroup v2 directory, every execution gets its own
+child cgroup, which is removed once the check exited. The shell of the check joins the cgroup and sets the rlimits
+before it executes the command, so no code runs in the forked child of the scheduler.
+
+Stdout is read while the check runs and the exit is awaited through a pidfd, so the resource usage of the check is
+taken from wait4 without blocking a thread. The peak memory of a check is the memory.peak of its cgroup. Without a
+cgroup it is only known if it exceeds the peak of the scheduler, which wait4 reports for every process forked from it.
+"""
+import asyncio
+import functools
+import itertools
+import logging
+import os
+import resource
+import shlex
+import signal
+import subprocess
+
+import result
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WALL_TIME = 60
+READ_SIZE = 65536
+# Seconds between polls of the exit of a check on kernels without pidfd
+EXIT_POLL_INTERVAL = 0.05
+
+_cgroup_ids = itertools.count()
+
+
+def get_limits(config) -> dict:
+    """Returns the keyword arguments of Limits set in the scheduler config"""
+    return {
+        "wall_time": config.check_wall_time,
+        "cpu_time": config.check_cpu_time,
+        "memory": config.check_memory,
+        "output_bytes": config.check_output_bytes,
+        "cgroup_root": config.check_cgroup_root,
+    }
+
+
+class Limits:
+    __slots__ = ("wall_time", "cpu_time", "memory", "output_bytes", "cgroup_root")
+
+    def __init__(self, wall_time=DEFAULT_WALL_TIME, cpu_time=0, memory=0, output_bytes=result.MAX_RESULT_BYTES,
+                 cgroup_root=""):
+        self.wall_time = wall_time
+        self.cpu_time = cpu_time
+        self.memory = memory
+        self.output_bytes = output_bytes
+        self.cgroup_root = cgroup_root
+
+
+class Execution:
+    """Outcome of a command. exceeded is the name of the limit, which killed the command, or None."""
+
+    __slots__ = ("stdout", "exceeded", "meta")
+
+    def __init__(self, stdout, exceeded, meta):
+        self.stdout = stdout
+        self.exceeded = exceeded
+        self.meta = meta
+
+
+def _create_cgroup(limits: Limits):
+    if not limits.cgroup_root:
+        return None
+    path = os.path.join(limits.cgroup_root, f"check-{os.getpid()}-{next(_cgroup_ids)}")
+    try:
+        os.mkdir(path)
+        if limits.memory:
+            with open(os.path.join(path, "memory.max"), "w") as fh:
+                fh.write(str(limits.memory))
+            with open(os.path.join(path, "memory.swap.max"), "w") as fh:
+                fh.write("0")
+    except OSError as err:
+        logger.warning(f"Could not create cgroup {path}, using rlimits: {err}")
+        _remove_cgroup(path)
+        return None
+    return path
+
+
+def _read_cgroup(path: str, name: str) -> dict:
+    values = {}
+    try:
+        with open(os.path.join(path, name)) as fh:
+            for line in fh:
+                parts = line.split()
+                values[parts[0] if len(parts) > 1 else ""] = int(parts[-1])
+    except (OSError, ValueError):
+        pass
+    return values
+
+
+def _remove_cgroup(path: str):
+    try:
+        os.rmdir(path)
+    except FileNotFoundError:
+        pass
+    except OSError:
+        # Processes left behind, cgroup.kill exists since linux 5.14
+        try:
+            with open(os.path.join(path, "cgroup.kill"), "w") as fh:
+                fh.write("1")
+            os.rmdir(path)
+        except OSError as err:
+            logger.warning(f"Could not remove cgroup {path}: {err}")
+
+
+def _wrap(command: str, limits: Limits, cgroup) -> list:
+    """Returns the arguments executing command by the shell after it joined cgroup and set its rlimits.
+
+    Nothing runs between the fork and the exec of the scheduler, so the check can be spawned from a thread.
+    """
+    steps = []
+    if cgroup is not None:
+        steps.append(f"echo $$ > {shlex.quote(os.path.join(cgroup, 'cgroup.procs'))}")
+    elif limits.memory:
+        steps.append(f"ulimit -v {max(limits.memory // 1024, 1)}")
+    if limits.cpu_time:
+        # SIGXCPU at the soft limit, SIGKILL a second later
+        steps.append(f"ulimit -S -t {limits.cpu_time}")
+        steps.append(f"ulimit -H -t {limits.cpu_time + 1}")
+    steps.append('exec /bin/sh -c "$0"')
+    return ["/bin/sh", "-c", " && ".join(steps), command]
+
+
+def _reap(process, cgroup):
+    if process is not None:
+        _kill(process.pid)
+        process.wait()
+        process.stdout.close()
+    if cgroup is not None:
+        _remove_cgroup(cgroup)
+
+
+async def _spawn(command: str, limits: Limits, cgroup):
+    """Starts command in a thread of the default executor, so the fork does not block the event loop"""
+    loop = asyncio.get_running_loop()
+    spawn = loop.run_in_executor(None, functools.partial(
+        subprocess.Popen, _wrap(command, limits, cgroup), stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+        start_new_session=True
+    ))
+    try:
+        return await asyncio.shield(spawn)
+    except asyncio.CancelledError:
+        # The check is started anyway, kill it once it is
+        spawn.add_done_callback(lambda x: loop.run_in_executor(
+            None, _reap, None if x.cancelled() or x.exception() else x.result(), cgroup
+        ))
+        raise
+
+
+async def _wait(pid: int):
+    """Waits for the exit of pid, kills what is left of its session and returns its status and rusage"""
+    loop = asyncio.get_running_loop()
+    try:
+        fd = os.pidfd_open(pid)
+    except (AttributeError, OSError):
+        # WNOWAIT leaves the process to wait4, so waiting stays cancellable
+        while os.waitid(os.P_PID, pid, os.WEXITED | os.WNOHANG | os.WNOWAIT) is None:
+            await asyncio.sleep(EXIT_POLL_INTERVAL)
+    else:
+        exited = loop.create_future()
+        loop.add_reader(fd, lambda: exited.done() or exited.set_result(None))
+        try:
+            await exited
+        finally:
+            loop.remove_reader(fd)
+            os.close(fd)
+    # pid is not reaped yet, so the process group can not have been reused
+    _kill(pid)
+    _, status, rusage = os.wait4(pid, 0)
+    return status, rusage
+
+
+async def _read(stream: asyncio.StreamReader, limit: int) -> (bytes, bool):
+    """Reads stream until its end, returns the output and whether it exceeded limit"""
+    chunks = []
+    size = 0
+    while True:
+        chunk = await stream.read(READ_SIZE)
+        if not chunk:
+            return b"".join(chunks), False
+        size += len(chunk)
+        if limit and size > limit:
+            return b"", True
+        chunks.append(chunk)
+
+
+def _kill(pid: int):
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+async def _communicate(process, stream: asyncio.StreamReader, limits: Limits):
+    """Reads the output of process and waits for its exit, returns stdout, whether it was too long, status and rusage"""
+    stdout, too_long = await _read(stream, limits.output_bytes)
+    if too_long:
+        _kill(process.pid)
+    status, rusage = await _wait(process.pid)
+    return stdout, too_long, status, rusage
+
+
+async def run(command: str, limits: Limits) -> Execution:
+    """Runs command by the shell within limits"""
+    loop = asyncio.get_running_loop()
+    cgroup = _create_cgroup(limits)
+    # ru_maxrss of the check includes the peak memory of the scheduler it was forked from
+    inherited_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    try:
+        process = await _spawn(command, limits, cgroup)
+    except OSError:
+        if cgroup is not None:
+            _remove_cgroup(cgroup)
+        raise
+    stream = asyncio.StreamReader()
+    exceeded = None
+    try:
+        transport, _ = await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(stream), process.stdout)
+        try:
+            # One deadline for the output and the exit, a check may close stdout and keep running
+            stdout, too_long, status, rusage = await asyncio.wait_for(
+                _communicate(process, stream, limits), limits.wall_time or None
+            )
+            if too_long:
+                exceeded = "output"
+        except asyncio.TimeoutError:
+            stdout = b""
+            exceeded = "wall_time"
+            _kill(process.pid)
+            status, rusage = await _wait(process.pid)
+        finally:
+            transport.close()
+    except BaseException:
+        _kill(process.pid)
+        if cgroup is not None:
+            _remove_cgroup(cgroup)
+        raise
+    process.returncode = os.waitstatus_to_exitcode(status)
+
+    cpu = rusage.ru_utime + rusage.ru_stime
+    if not exceeded and limits.cpu_time and cpu >= limits.cpu_time and os.WIFSIGNALED(status):
+        exceeded = "cpu_time"
+    max_rss = rusage.ru_maxrss * 1024 if rusage.ru_maxrss > inherited_rss else None
+    if cgroup is not None:
+        max_rss = _read_cgroup(cgroup, "memory.peak").get("", max_rss)
+        if not exceeded and _read_cgroup(cgroup, "memory.events").get("oom_kill"):
+            exceeded = "memory"
+        _remove_cgroup(cgroup)
+    meta = {"cpu_user_time": round(rusage.ru_utime, 4), "cpu_system_time": round(rusage.ru_stime, 4)}
+    if max_rss is not None:
+        meta["max_rss"] = max_rss
+    if exceeded:
+        meta["limit_exceeded"] = exceeded
+    return Execution(stdout, exceeded, meta)
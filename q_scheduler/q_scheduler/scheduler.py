@@ -1,35 +1,124 @@
 import asyncio
-import datetime
+import heapq
 import logging
+import math
+import time
 
-from helper import get_weekday
+import metrics
+from checkpoint import Checkpoint
+from executor import ExecutorPool
+from helper import MINUTES_PER_WEEK
 
 logger = logging.getLogger(__name__)
 
+# Fractional part of the golden ratio, ids times it are evenly spread over [0, 1)
+PHASE_FACTOR = 0.6180339887498949
+
+TICK_LAG = metrics.registry.histogram(
+    "q_scheduler_tick_lag_seconds",
+    "Delay of the scheduling loops behind the due time of the checks, caused by a busy event loop",
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+)
+
 
 class Scheduler:
-    def __init__(self, checks: list, scheduling_periods: dict, ex_pool):
+    """Schedules checks at their own due time, spread over their scheduling interval.
+
+    The phase of a check in its interval is taken from the checkpoint, if one is given and holds the check, else it
+    is derived from the id of the check. So the checks of an interval do not all run at once, neither on a start nor
+    on a restart.
+    """
+
+    def __init__(self, checks: list, scheduling_periods: dict, ex_pool, checkpoint=None):
         self.checks = checks
         self.scheduling_periods = scheduling_periods
         self.ex_pool = ex_pool
+        self.checkpoint = checkpoint
 
-    async def schedule_interval(self, interval, checks):
-        logger.debug(f"Scheduling with interval {interval} with {len(checks)} check(s)")
-        while True:
-            for x in checks:
-                current_time = int(datetime.datetime.utcnow().strftime("%H%M"))
-                time_period = self.scheduling_periods[str(x.scheduling_period)].time_periods.get(get_weekday())
-                for period in time_period:
-                    if int(period["start_time"]) <= current_time <= int(period["stop_time"]):
-                        self.ex_pool.append_task(x)
-                        break
+    def _first_due(self, check, now: float) -> float:
+        interval = check.scheduling_interval
+        restored = self.checkpoint.get(check) if self.checkpoint is not None else None
+        if restored is None or not restored[0]:
+            return now + interval * (check.id * PHASE_FACTOR % 1.0)
+        due, state, attempts = restored
+        self.ex_pool.restore(check, state, attempts)
+        if due < now:
+            # Missed while the scheduler was stopped, run it at its next due time in its phase
+            due += interval * math.ceil((now - due) / interval)
+        # The interval may have been shortened since the checkpoint was written
+        return min(due, now + interval)
+
+    async def schedule_interval(self, interval, scheduling_period, checks):
+        """Schedules checks sharing interval and scheduling period.
 
-            await asyncio.sleep(interval)
+        Outside of the scheduling period the loop sleeps until the next window starts.
+        """
+        logger.debug(f"Scheduling with interval {interval} in period {scheduling_period.name} "
+                     f"with {len(checks)} check(s)")
+        now = time.time()
+        queue = [(self._first_due(x, now), i, x) for i, x in enumerate(checks)]
+        heapq.heapify(queue)
+        while True:
+            now = time.time()
+            wait = scheduling_period.next_window(now)
+            if wait is None:
+                # Empty period, the declaration is only reloaded with a restart
+                await asyncio.sleep(MINUTES_PER_WEEK * 60)
+                continue
+            if wait:
+                await asyncio.sleep(wait)
+                continue
+            TICK_LAG.observe(max(now - queue[0][0], 0.0))
+            while queue[0][0] <= now:
+                due, i, x = queue[0]
+                self.ex_pool.append_task(x)
+                # Checks missed outside of the window keep their phase
+                due += interval * max(math.ceil((now - due) / interval), 1)
+                heapq.heapreplace(queue, (due, i, x))
+                if self.checkpoint is not None:
+                    self.checkpoint.set_due(x, due)
+            await asyncio.sleep(queue[0][0] - now)
 
     async def run(self):
-        intervals = list(set([x.scheduling_interval for x in self.checks]))
+        groups = {}
+        for x in self.checks:
+            if x.scheduling_period not in self.scheduling_periods:
+                logger.warning(f"Unknown scheduling period {x.scheduling_period} of {x.context} {x.id}")
+                continue
+            groups.setdefault((x.scheduling_interval, x.scheduling_period), []).append(x)
         logger.info(f"Creating event loops..")
         loops = [asyncio.create_task(self.schedule_interval(
-            interval, [x for x in self.checks if x.scheduling_interval == interval],
-        )) for interval in intervals]
+            interval, self.scheduling_periods[scheduling_period], checks,
+        )) for (interval, scheduling_period), checks in groups.items()]
+        if self.checkpoint is not None:
+            loops.append(asyncio.create_task(self.checkpoint.run()))
         await asyncio.wait(loops)
+
+
+async def start_scheduler(declaration, workers, submit=None, options=None, checkpoint_options=None):
+    """Schedules the checks of a declaration until the process is stopped
+
+    :param declaration: Declaration as returned by loader.load_declaration
+    :param workers: Number of concurrently running checks
+    :param submit: Coroutine function taking encoded results, see ExecutorPool
+    :param options: Further keyword arguments of ExecutorPool, see executor.get_options
+    :param checkpoint_options: Keyword arguments of the Checkpoint, see checkpoint.get_options. Without a path no
+    checkpoint is kept.
+    """
+    checks = declaration.checks
+    # If no checks are scheduled, run forever to not cause the systemd unit to fail
+    if not checks:
+        while True:
+            await asyncio.sleep(5)
+
+    ex_pool = ExecutorPool(workers, submit, **(options or {}))
+    checkpoint = None
+    if checkpoint_options and checkpoint_options.get("path"):
+        try:
+            checkpoint = Checkpoint(checks=checks, **checkpoint_options)
+        except OSError as err:
+            logger.error(f"Could not create checkpoint {checkpoint_options['path']}, continuing without: {err}")
+    ex_pool.checkpoint = checkpoint
+    s = Scheduler(checks, declaration.scheduling_periods, ex_pool, checkpoint)
+    asyncio.create_task(ex_pool.run())
+    await asyncio.create_task(s.run())
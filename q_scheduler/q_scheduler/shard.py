@@ -0,0 +1,247 @@
+"""Sharding of the checks over several scheduler processes.
+
+The supervisor splits the checks of the declaration by a consistent hash of their context and id and starts one
+scheduler process per shard. Shards put their encoded results into a shared channel, from which the supervisor submits
+them in batches to the proxy.
+
+The declaration is reloaded, when its file changes or on SIGHUP. All shards are restarted with the new split then.
+Because of the consistent hashing, changing the number of shards only moves the checks of the added or removed shards.
+Every shard keeps its own checkpoint, so checks which moved to another shard start without their previous state.
+"""
+import asyncio
+import bisect
+import hashlib
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from signal import signal, SIGHUP
+
+import httpx
+
+import checkpoint
+import executor
+import metrics
+import result
+from executor import CERT, SUBMIT_URL, SUBMIT_DURATION, SUBMIT_ERRORS
+from helper import configure_logging
+from loader import load_declaration
+from scheduler import start_scheduler
+
+logger = logging.getLogger(__name__)
+
+# Points per shard on the hash ring
+REPLICAS = 64
+SUBMIT_BATCH_SIZE = 500
+SUBMIT_INTERVAL = 0.5
+RELOAD_CHECK_INTERVAL = 5.0
+# Seconds a shard has to stop after its stop event was set, before it is terminated
+STOP_TIMEOUT = 5.0
+STOP_POLL_INTERVAL = 0.2
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.blake2b(value.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    def __init__(self, shards: int, replicas=REPLICAS):
+        points = sorted((_hash(f"shard-{x}-{i}"), x) for x in range(shards) for i in range(replicas))
+        self.keys = [x[0] for x in points]
+        self.shards = [x[1] for x in points]
+
+    def get(self, key) -> int:
+        """Returns the shard of key"""
+        return self.shards[bisect.bisect(self.keys, _hash(str(key))) % len(self.keys)]
+
+
+def shard_key(list_name: str, entry: dict) -> str:
+    """Returns the key of a declaration entry on the hash ring.
+
+    Observables are placed on the shard of their host, as their checks depend on the state of the host.
+    """
+    if list_name == "hosts":
+        return f"hosts:{entry['id']}"
+    if entry.get("linked_host") is not None:
+        return f"hosts:{entry['linked_host']}"
+    return f"observables:{entry['id']}"
+
+
+def shard_filter(index: int, shards: int):
+    """Returns the accept function of load_declaration for the checks of a shard"""
+    ring = HashRing(shards)
+    return lambda list_name, entry: ring.get(shard_key(list_name, entry)) == index
+
+
+def run_shard(index: int, shards: int, path: str, workers: int, channel, stop, options=None, metrics_address="",
+              checkpoint_options=None):
+    """Entry point of a shard process, which loads its part of the declaration at path.
+
+    The shard runs until the stop event is set. It returns then instead of being terminated, so it is never stopped in
+    the middle of putting a result into the channel and the results it put are flushed into the channel on exit.
+    """
+    configure_logging()
+    if metrics_address:
+        metrics.serve(metrics.shard_address(metrics_address, index))
+    declaration = load_declaration(path, shard_filter(index, shards))
+    logger.info(f"Shard {index} schedules {len(declaration.checks)} check(s)")
+
+    async def submit(check_result: bytes):
+        channel.put(check_result)
+
+    if checkpoint_options and checkpoint_options.get("path"):
+        checkpoint_options = dict(checkpoint_options, path=checkpoint.shard_path(checkpoint_options["path"], index))
+
+    async def run():
+        scheduler = asyncio.create_task(start_scheduler(declaration, workers, submit, options, checkpoint_options))
+        while not stop.is_set() and not scheduler.done():
+            await asyncio.sleep(STOP_POLL_INTERVAL)
+        scheduler.cancel()
+        logger.info(f"Shard {index} stopped")
+
+    asyncio.new_event_loop().run_until_complete(run())
+
+
+class Supervisor:
+    def __init__(self, config):
+        self.config = config
+        self.shards = config.shards if config.shards > 0 else os.cpu_count() or 1
+        self.workers = max(1, -(-config.workers // self.shards))
+        # Shards are started while the submit and metrics threads run, a forked shard could inherit a lock held by one
+        # of them, so shards are spawned as fresh interpreters
+        self.context = multiprocessing.get_context("spawn")
+        self.channel = self.context.Queue()
+        # Set to stop the running shards, replaced whenever shards are started
+        self.stop = self.context.Event()
+        self.processes = []
+        self.declaration_mtime = None
+        self.reload_requested = False
+        self.running = True
+
+        self.submitted = 0
+        self.submit_errors = 0
+
+    def _check_declaration(self) -> bool:
+        """Checks that the declaration can be loaded, the shards load their part of it themselves"""
+        path = self.config.declaration_path
+        try:
+            self.declaration_mtime = os.path.getmtime(path)
+            load_declaration(path, accept=lambda list_name, entry: False)
+            return True
+        except FileNotFoundError:
+            logger.error(f"Description was not found at {path}")
+        except ValueError as err:
+            logger.error(f"Could not decode {path}: {err}")
+        return False
+
+    def _start_shard(self, index):
+        process = self.context.Process(
+            target=run_shard,
+            args=(
+                index, self.shards, self.config.declaration_path, self.workers, self.channel, self.stop,
+                executor.get_options(self.config), self.config.metrics_address, checkpoint.get_options(self.config)
+            ),
+            name=f"q-scheduler-shard-{index}", daemon=True
+        )
+        process.start()
+        return process
+
+    def start_shards(self):
+        self.stop = self.context.Event()
+        self.processes = [self._start_shard(x) for x in range(self.shards)]
+        logger.info(f"Started {self.shards} shard(s) with {self.workers} worker(s) each")
+
+    def stop_shards(self):
+        """Stops the shards by their stop event, shards which did not stop within STOP_TIMEOUT are terminated"""
+        self.stop.set()
+        deadline = time.monotonic() + STOP_TIMEOUT
+        for x in self.processes:
+            x.join(max(deadline - time.monotonic(), 0))
+        for index, process in enumerate(self.processes):
+            if process.is_alive():
+                logger.warning(f"Shard {index} did not stop within {STOP_TIMEOUT}s, terminating it")
+                process.terminate()
+                process.join(STOP_TIMEOUT)
+                if process.is_alive():
+                    process.kill()
+        self.processes = []
+
+    def _post(self, client: httpx.Client, batch: list):
+        start = time.monotonic()
+        try:
+            client.post(
+                SUBMIT_URL, content=b"\n".join(batch), timeout=10,
+                headers={"Content-Type": result.RESULT_CONTENT_TYPE}
+            )
+            self.submitted += len(batch)
+        except httpx.HTTPError as err:
+            self.submit_errors += 1
+            SUBMIT_ERRORS.inc()
+            logger.error(f"Could not submit {len(batch)} result(s): {err}")
+        finally:
+            SUBMIT_DURATION.observe(time.monotonic() - start)
+
+    def _register_metrics(self):
+        metrics.registry.gauge(
+            "q_scheduler_shards_alive", "Running shard processes", (),
+            lambda: {(): sum(1 for x in list(self.processes) if x.is_alive())}
+        )
+        metrics.registry.gauge(
+            "q_scheduler_submitted_results_total", "Results submitted to the proxy", (),
+            lambda: {(): self.submitted}, "counter"
+        )
+        metrics.registry.gauge(
+            "q_scheduler_submit_queue_length", "Results of the shards waiting for the submission", (),
+            lambda: {(): self.channel.qsize()}
+        )
+
+    def _submit_loop(self):
+        """Collects the results of all shards and submits them in batches"""
+        with httpx.Client(cert=CERT) as client:
+            while self.running:
+                batch = []
+                deadline = time.monotonic() + SUBMIT_INTERVAL
+                while len(batch) < SUBMIT_BATCH_SIZE:
+                    try:
+                        batch.append(self.channel.get(timeout=max(deadline - time.monotonic(), 0.01)))
+                    except queue.Empty:
+                        break
+                if batch:
+                    self._post(client, batch)
+
+    def _request_reload(self, signal_received, frame):
+        self.reload_requested = True
+
+    def _declaration_changed(self) -> bool:
+        try:
+            return os.path.getmtime(self.config.declaration_path) != self.declaration_mtime
+        except FileNotFoundError:
+            return False
+
+    def run(self):
+        signal(SIGHUP, self._request_reload)
+        if self.config.metrics_address:
+            self._register_metrics()
+            metrics.serve(self.config.metrics_address)
+        threading.Thread(target=self._submit_loop, name="submit", daemon=True).start()
+        try:
+            if self._check_declaration():
+                self.start_shards()
+            while True:
+                time.sleep(RELOAD_CHECK_INTERVAL)
+                if self.reload_requested or self._declaration_changed():
+                    self.reload_requested = False
+                    if self._check_declaration():
+                        logger.info("Declaration changed, rebalancing shards")
+                        self.stop_shards()
+                        self.start_shards()
+                    continue
+                for index, process in enumerate(self.processes):
+                    if not process.is_alive():
+                        logger.error(f"Shard {index} exited with {process.exitcode}, restarting it")
+                        self.processes[index] = self._start_shard(index)
+        finally:
+            self.running = False
+            self.stop_shards()
@@ -1,56 +1,83 @@
-import asyncio
-import json
 import logging
 import time
 from datetime import datetime
 
-from httpx import AsyncClient
-
+import plugins
+import probes
+import result
+import sandbox
 
 logger = logging.getLogger(__name__)
 
 
 class Worker:
-    def __init__(self, check, client: AsyncClient):
+    """Runs a check once and submits its result.
+
+    :param check: Check to run
+    :param submit: Coroutine function taking the encoded result
+    :param plugin_manager: Pools of the persistent plugins
+    :param probe_runner: Runner of the built-in probes
+    :param limits: sandbox.Limits of check commands
+    """
+
+    def __init__(self, check, submit, plugin_manager=None, probe_runner=None, limits=None):
         self.check = check
-        self.client = client
+        self.submit_result = submit
+        self.plugin_manager = plugin_manager
+        self.probe_runner = probe_runner
+        self.limits = limits or sandbox.Limits()
 
-    async def submit_result(self, check_result):
-        await self.client.post(f"https://127.0.0.1:8443/scheduler/api/v1/submit", json=check_result, timeout=10)
+    async def run(self) -> dict:
+        """Runs the check, submits the result and returns it"""
+        check_result, encoded = await self.execute()
+        await self.submit_result(encoded)
+        return check_result
 
-    async def run(self):
+    async def execute(self) -> (dict, bytes):
+        """Runs the check and returns its result and the encoded result, which is to be submitted"""
         logger.debug(f"Starting worker on {self.check.id}:{self.check.context}")
         linked_check = self.check.linked_check.replace("\r\n", " ")
         process_start = time.time()
-        proc = await asyncio.create_subprocess_shell(linked_check, stdout=asyncio.subprocess.PIPE)
-        stdout, _ = await proc.communicate()
-        process_end = time.time()
-        utc_now = datetime.utcnow().timestamp()
-
+        usage = {}
         try:
-            decoded = json.loads(stdout)
+            if plugins.is_persistent(linked_check) and self.plugin_manager is not None:
+                decoded = await self.plugin_manager.run(linked_check)
+            elif probes.is_probe(linked_check) and self.probe_runner is not None:
+                decoded = await self.probe_runner.run(linked_check)
+            else:
+                execution = await sandbox.run(linked_check, self.limits)
+                usage = execution.meta
+                if execution.exceeded:
+                    decoded = {"state": "unknown", "output": f"Check exceeded its {execution.exceeded} limit"}
+                else:
+                    decoded = result.decode(execution.stdout, result.PLUGIN_SCHEMA)
+        except result.SchemaError as err:
             decoded = {
-                **decoded,
-                "object_id": self.check.id,
-                "context": self.check.context,
-                "meta": {
-                    "process_end_time": round(utc_now, 0),
-                    "process_execution_time": round(process_end - process_start, 4)
-                }
-            }
-        except json.JSONDecodeError:
-            await self.submit_result({
-                "object_id": self.check.id,
-                "context": self.check.context,
                 "state": "unknown",
-                "output": "stdout could not be decoded as json",
-                "datasets": [],
-                "meta": {
-                    "process_end_time": round(utc_now, 0),
-                    "process_execution_time": round(process_end - process_start, 4)
-                }
-            })
-            return
-
-        logger.debug(f"Got result from worker on {self.check.id}:{self.check.context}: {decoded}")
-        await self.submit_result(decoded)
+                "output": f"Output of the check does not match the result schema: {err}"[:result.MAX_OUTPUT_LENGTH]
+            }
+        except OSError as err:
+            decoded = {"state": "unknown", "output": f"Could not run the check: {err}"[:result.MAX_OUTPUT_LENGTH]}
+        process_end = time.time()
+        utc_now = datetime.utcnow().timestamp()
+        check_result = {
+            "object_id": self.check.id,
+            "context": self.check.context,
+            "state": decoded["state"],
+            "output": decoded["output"],
+            "datasets": decoded.get("datasets", []),
+            "meta": {
+                "process_end_time": round(utc_now, 0),
+                "process_execution_time": round(process_end - process_start, 4),
+                **usage,
+            }
+        }
+        # The result is encoded once, proxy and core pass the bytes on
+        encoded = result.encode(check_result)
+        if len(encoded) > result.MAX_RESULT_BYTES:
+            check_result.update(
+                state="unknown", output=f"Result is larger than {result.MAX_RESULT_BYTES} bytes", datasets=[]
+            )
+            encoded = result.encode(check_result)
+        logger.debug(f"Got result from worker on {self.check.id}:{self.check.context}: {encoded}")
+        return check_result, encoded